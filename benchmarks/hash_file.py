@@ -0,0 +1,63 @@
+"""
+Compares ``xmm.util.hash_file`` buffer sizes and mmap against the naive 1 KB loop
+
+    python benchmarks/hash_file.py [file] [size_mb]
+
+Without a file a temporary one of ``size_mb`` (default 256) is created. The file is read once
+before timing so every strategy runs against the page cache.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from xmm.util import hash_file  # noqa: E402
+
+
+def naive(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        chunk = 0
+        while chunk != b'':
+            chunk = f.read(1024)
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def timed(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    digest = func(*args, **kwargs)
+    print('{:<24} {:.3f}s {}'.format(name, time.perf_counter() - start, digest))
+
+
+def main():
+    size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    tmp = None
+
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        for _ in range(size_mb):
+            tmp.write(os.urandom(1024 * 1024))
+        tmp.close()
+        filename = tmp.name
+
+    try:
+        naive(filename)
+        timed('1 KB loop', naive, filename)
+        for buffer_size in (64 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+            timed('readinto {} KB'.format(buffer_size // 1024), hash_file, filename,
+                  buffer_size=buffer_size, mmap_threshold=None)
+        timed('mmap', hash_file, filename, mmap_threshold=0)
+        timed('hash_file defaults', hash_file, filename)
+    finally:
+        if tmp:
+            os.remove(tmp.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares peak memory of loading a repository data file at once against ``Repository.iter_packages``
+
+    python benchmarks/iter_packages.py [count]
+
+A temporary data file with ``count`` (default 200000) copies of the packages in ``tests/data/maps.json``
+is generated. Peak memory is measured with ``tracemalloc`` while counting the bsps of every package.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root_dir)
+
+from xmm.map import MapPackage  # noqa: E402
+from xmm.repository import Repository  # noqa: E402
+
+
+def load_all(filename):
+    with open(filename) as f:
+        data = f.read()
+    return [MapPackage(map_package_json=m) for m in json.loads(data)['data']]
+
+
+def iter_packages(filename):
+    repository = Repository(name='benchmark', download_url='', api_data_url='', api_data_file=filename)
+    return repository.iter_packages()
+
+
+def measured(name, func, filename):
+    tracemalloc.start()
+    start = time.perf_counter()
+    bsps = sum(len(m.bsps) for m in func(filename))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<16} {:.3f}s peak {:.1f} MB, {} bsps'.format(name, elapsed, peak / 1024 / 1024, bsps))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    with open(os.path.join(root_dir, 'tests', 'data', 'maps.json')) as f:
+        packages = json.load(f)['data']
+
+    tmp = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    try:
+        tmp.write('{"data": [')
+        for i in range(count):
+            package = dict(packages[i % len(packages)], pk3='{}.pk3'.format(i))
+            tmp.write('{}{}'.format(',' if i else '', json.dumps(package)))
+        tmp.write(']}')
+        tmp.close()
+
+        print('{} packages, {:.1f} MB'.format(count, os.path.getsize(tmp.name) / 1024 / 1024))
+        measured('load at once', load_all, tmp.name)
+        measured('iter_packages', iter_packages, tmp.name)
+    finally:
+        os.remove(tmp.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compares writing a library through the old ``json.loads(m.to_json())`` round trip against ``MapPackage.to_dict``
+
+    python benchmarks/serialize.py [count]
+
+A library of ``count`` (default 50000) packages is built from copies of ``tests/data/maps.json``. Each
+strategy serializes all of them, ``JsonBackend.write`` is timed writing the library to a temporary file.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root_dir)
+
+from xmm.backends import JsonBackend  # noqa: E402
+from xmm.map import MapPackage  # noqa: E402
+from xmm import util  # noqa: E402
+
+
+def round_trip(packages):
+    # what every writer did before to_dict
+    data_out = []
+    for m in packages:
+        data_out.append(json.loads(json.dumps(m, cls=util.ObjectEncoder)))
+    return json.dumps(data_out)
+
+
+def to_dict(packages):
+    return json.dumps([m.to_dict() for m in packages])
+
+
+def timed(name, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    print('{:<24} {:.3f}s'.format(name, time.perf_counter() - start))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    with open(os.path.join(root_dir, 'tests', 'data', 'maps.json')) as f:
+        maps = json.load(f)['data']
+
+    packages = [MapPackage(map_package_json=dict(maps[i % len(maps)], pk3='{}.pk3'.format(i))) for i in range(count)]
+    print('{} packages'.format(count))
+
+    timed('round trip', round_trip, packages)
+    timed('to_dict', to_dict, packages)
+
+    tmp_dir = tempfile.mkdtemp()
+    data_file = os.path.join(tmp_dir, 'library.json')
+    try:
+        backend = JsonBackend(data_file=data_file)
+        timed('JsonBackend.write', backend.write, [], packages)
+    finally:
+        for filename in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, filename))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+from xmm.config import conf
+
+
+def test_config_import_has_no_side_effects(tmpdir):
+    env = dict(os.environ, HOME=str(tmpdir))
+    code = 'import xmm.cli, xmm.config; print(xmm.config.conf.loaded)'
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+
+    assert output.strip() == b'False'
+    assert tmpdir.listdir() == []
+
+
+def test_config_lazy_load():
+    assert 'target_dir' in conf['default']
+    assert conf.loaded
+    assert 'default' in conf.keys()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from xmm import cli
+from xmm import daemon
+from xmm.config import conf
+from xmm.daemon import Daemon
+from xmm.daemon import is_running
+from xmm.daemon import request
+
+os.makedirs(os.path.expanduser('~/.xonotic/data'), exist_ok=True)
+
+
+def test_daemon(tmpdir, capsys):
+    socket_file = str(tmpdir.join('xmm.sock'))
+    daemon = Daemon(socket_file=socket_file)
+
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+
+    try:
+        for _ in range(50):
+            if is_running(socket_file):
+                break
+            time.sleep(0.1)
+
+        assert request({'command': 'ping'}, socket_file)['result']['servers'] == []
+        assert stat.S_IMODE(os.stat(socket_file).st_mode) & 0o077 == 0
+
+        args = {'server': None, 'repository': None, 'string': 'dance', 'gametype': None, 'pk3': None, 'title': None,
+                'author': None, 'shasum': None, 'long': False, 'short': True, 'color': False}
+        response = request({'command': 'search', 'args': args}, socket_file)
+        assert response['ok']
+        assert 'dance.pk3' in response['output']
+        assert 'dance.pk3' in [m['pk3'] for m in response['result']]
+
+        # output goes into the response, not to the daemon's own stdout
+        assert 'dance.pk3' not in capsys.readouterr().out
+
+        # the server stays loaded between requests
+        assert request({'command': 'ping'}, socket_file)['result']['servers'] == ['default']
+
+        response = request({'command': 'export', 'args': {}}, socket_file)
+        assert not response['ok']
+    finally:
+        request({'command': 'stop'}, socket_file)
+        thread.join(5)
+
+    assert not thread.is_alive()
+    assert not os.path.exists(socket_file)
+
+
+def test_forward_to_daemon_failure(tmpdir, monkeypatch):
+    socket_file = tmpdir.join('xmm.sock')
+    socket_file.write('')
+    monkeypatch.setitem(conf['default'], 'daemon_socket', str(socket_file))
+    monkeypatch.setattr(daemon, 'request', lambda message, socket_file: {'ok': False, 'output': '', 'error': 'broken'})
+
+    with pytest.raises(SystemExit) as e:
+        cli.forward_to_daemon(argparse.Namespace(command='list'))
+
+    assert e.value.code == 1
@@ -0,0 +1,77 @@
+import csv
+import io
+import json
+import os
+
+from xmm.exporters import export_packages
+from xmm.exporters import write_packages
+from xmm.map import MapPackage
+from xmm.repository import Repository
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+
+with open(test_maps_file) as f:
+    maps = json.load(f)['data']
+
+
+def packages():
+    for m in maps:
+        yield MapPackage(map_package_json=m)
+
+
+def test_write_packages_json():
+    f = io.StringIO()
+    assert write_packages(packages(), f, format='json') == len(maps)
+    assert json.loads(f.getvalue()) == maps
+
+
+def test_write_packages_ndjson():
+    f = io.StringIO()
+    write_packages(packages(), f, format='ndjson')
+    assert [json.loads(line) for line in f.getvalue().splitlines()] == maps
+
+
+def test_write_packages_csv():
+    f = io.StringIO()
+    write_packages(packages(), f, format='csv')
+    rows = list(csv.DictReader(io.StringIO(f.getvalue())))
+    assert [r['pk3'] for r in rows] == [m['pk3'] for m in maps]
+    assert rows[0]['shasum'] == maps[0]['shasum']
+    assert rows[0]['bsp'] == ' '.join(sorted(maps[0]['bsp']))
+
+
+def test_write_packages_shasums_and_maplist():
+    f = io.StringIO()
+    write_packages(packages(), f, format='shasums')
+    assert f.getvalue().splitlines()[0] == '{} {}'.format(maps[0]['shasum'], maps[0]['pk3'])
+
+    f = io.StringIO()
+    write_packages(packages(), f, format='maplist')
+    assert f.getvalue().splitlines() == [bsp for m in maps for bsp in sorted(m['bsp'])]
+
+
+def test_export_packages_empty_and_newlines(tmpdir):
+    # an empty export still replaces the file
+    shasums_file = tmpdir.join('maps.shasums')
+    shasums_file.write('old\n')
+    assert export_packages([], str(shasums_file), format='shasums') == 0
+    assert shasums_file.read() == ''
+
+    json_file = tmpdir.join('maps.json')
+    export_packages([], str(json_file), format='json')
+    assert json_file.read() == '[]\n'
+
+    # every format ends with a newline
+    for format in ('json', 'ndjson', 'csv', 'shasums', 'maplist'):
+        export_packages(packages(), str(json_file), format=format)
+        assert json_file.read().endswith('\n')
+
+
+def test_repository_export_ndjson(tmpdir):
+    repository = Repository(name='default', download_url='http://dl.repo.url/', api_data_url='http://api.repo.url/maps.json',
+                            api_data_file=test_maps_file)
+    filename = str(tmpdir.join('maps.ndjson'))
+    repository.export_packages(filename=filename, format='ndjson')
+
+    assert [json.loads(line) for line in tmpdir.join('maps.ndjson').readlines()] == maps
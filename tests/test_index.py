@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import zipfile
+
+from xmm.index import PackageIndex
+from xmm.index import SearchIndex
+from xmm.map import MapPackage
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+
+
+def test_index_build_and_load(tmpdir):
+    data_file = str(tmpdir.join('maps.json'))
+    shutil.copyfile(test_maps_file, data_file)
+
+    index = PackageIndex(data_file=data_file)
+    assert index.is_stale()
+    assert index.load() is None
+
+    records = index.get_records()
+    assert os.path.exists(index.index_file)
+    assert not index.is_stale()
+    assert index.load() == records
+
+    with open(data_file) as f:
+        maps = json.load(f)['data']
+
+    assert len(records) == len(maps)
+    for record, m in zip(records, maps):
+        package = MapPackage.from_record(record)
+        assert json.loads(package.to_json()) == m
+
+
+def test_index_rebuilds_when_stale(tmpdir):
+    data_file = str(tmpdir.join('maps.json'))
+    shutil.copyfile(test_maps_file, data_file)
+
+    index = PackageIndex(data_file=data_file)
+    index.build()
+
+    with open(data_file) as f:
+        data = json.load(f)
+    data['data'] = data['data'][:2]
+    with open(data_file, 'w') as f:
+        json.dump(data, f)
+
+    assert index.is_stale()
+    assert len(index.get_records()) == 2
+    assert not index.is_stale()
+
+
+def test_index_ignores_corrupt_file(tmpdir):
+    data_file = str(tmpdir.join('maps.json'))
+    shutil.copyfile(test_maps_file, data_file)
+
+    index = PackageIndex(data_file=data_file)
+    with open(index.index_file, 'wb') as f:
+        f.write(b'not an index')
+
+    assert index.load() is None
+    assert len(index.get_records()) == 6
+
+
+def test_search_index(tmpdir):
+    data_file = str(tmpdir.join('maps.json'))
+    shutil.copyfile(test_maps_file, data_file)
+
+    records = PackageIndex(data_file=data_file).get_records()
+    index = SearchIndex(data_file=data_file)
+
+    assert index.search(records, bsp_name='noteams') == {('bsp', 'noteams'): {1}}
+    assert index.search(records, pk3_name='nex_r3') == {('pk3', 'nex_r3'): {2, 3, 4}}
+    assert index.search(records, title='iron') == {('title', 'iron'): {2}}
+    assert index.search(records, author='Kid') == {('author', 'Kid'): {1}}
+    assert index.search(records, author='z') == {('author', 'z'): {5}}
+    assert index.search(records, gametype='vip') == {('gametype', 'vip'): {1}}
+    assert index.search(records, shasum='3df0143516f72269f465070373f165c8787964d5') == {
+        ('shasum', '3df0143516f72269f465070373f165c8787964d5'): {5}
+    }
+    assert index.search(records, bsp_name='nothing-here', gametype='nope') == {}
+    assert os.path.exists(index.index_file)
+
+    # a fresh instance loads the persisted postings
+    assert SearchIndex(data_file=data_file).load() == index.postings
+
+
+def test_search_index_reloads_when_stale(tmpdir):
+    data_file = str(tmpdir.join('maps.json'))
+    shutil.copyfile(test_maps_file, data_file)
+
+    package_index = PackageIndex(data_file=data_file)
+    index = SearchIndex(data_file=data_file)
+    assert index.search(package_index.get_records(), bsp_name='noteams') == {('bsp', 'noteams'): {1}}
+
+    # same number of packages in another order
+    with open(data_file) as f:
+        data = json.load(f)
+    data['data'].reverse()
+    with open(data_file, 'w') as f:
+        json.dump(data, f)
+    stat = os.stat(data_file)
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    assert index.search(package_index.get_records(), bsp_name='noteams') == {('bsp', 'noteams'): {4}}
+
+
+def test_index_from_seed(tmpdir):
+    seed_file = str(tmpdir.join('maps.json.zip'))
+    with zipfile.ZipFile(seed_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(test_maps_file, 'maps.json')
+
+    data_file = str(tmpdir.join('maps.json'))
+    index = PackageIndex(data_file=data_file, seed_file=seed_file)
+    assert index.get_source_file() == seed_file
+
+    records = index.get_records()
+    assert not os.path.exists(data_file)
+    assert not index.is_stale()
+
+    # same records as from the extracted file
+    shutil.copyfile(test_maps_file, str(tmpdir.join('extracted.json')))
+    assert records == PackageIndex(data_file=str(tmpdir.join('extracted.json'))).build()
+
+    # the data file takes over once it exists
+    shutil.copyfile(test_maps_file, data_file)
+    assert index.get_source_file() == data_file
+    assert index.is_stale()
+
+    # works without a writable index location
+    os.remove(data_file)
+    index = PackageIndex(data_file=data_file, index_file=str(tmpdir.join('missing', 'maps.json.idx')), seed_file=seed_file)
+    assert index.get_records() == records
+    assert index.load() == records
@@ -1,7 +1,13 @@
+import hashlib
+import http.server
 import json
 import os
 import pytest
+import threading
+from shutil import copyfile
 
+from xmm.exceptions import HashMismatchError
+from xmm.exceptions import PackageNotTrackedWarning
 from xmm.library import Library
 from xmm.map import MapPackage
 from xmm.repository import Repository
@@ -28,8 +34,10 @@ with open('{}/data/sources.json'.format(root_dir)) as f:
 repositories.add_repository(repository)
 
 
-def test_library_add_map_package():
-    library = Library(repositories=repositories, store=store, map_dir='{}/data/maps'.format(root_dir))
+def test_library_add_map_package(tmpdir):
+    copyfile(package_store_file, str(tmpdir.join('library.json')))
+    local_store = Store(package_store_file=str(tmpdir.join('library.json')))
+    library = Library(repositories=repositories, store=local_store, map_dir='{}/data/maps'.format(root_dir))
 
     with open('{}/data/map.json'.format(root_dir)) as f:
         data = f.read()
@@ -41,9 +49,15 @@ def test_library_add_map_package():
         if m.pk3_file == 'map-vapor_alpha_2.pk3':
             assert True
 
+    # the library and its store share one list
+    assert library.maps is local_store.data
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['dance.pk3', 'map-vapor_alpha_2.pk3']
 
-def test_library_remove_map():
-    library = Library(repositories=repositories, store=store, map_dir='{}/data/maps'.format(root_dir))
+
+def test_library_remove_map(tmpdir):
+    copyfile(package_store_file, str(tmpdir.join('library.json')))
+    local_store = Store(package_store_file=str(tmpdir.join('library.json')))
+    library = Library(repositories=repositories, store=local_store, map_dir='{}/data/maps'.format(root_dir))
 
     assert len(library.maps) == 1
 
@@ -67,3 +81,157 @@ def test_library_install_map():
             assert True
 
     library.remove_map(pk3_name='vinegar_v3.pk3')
+
+
+class PackageHandler(http.server.BaseHTTPRequestHandler):
+    packages = {
+        '/dance.pk3': b'dance' * 1000,
+        '/gasoline_02.pk3': b'gasoline' * 1000,
+    }
+
+    def do_GET(self):
+        body = self.packages.get(self.path)
+
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_library_install_maps(tmpdir):
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), PackageHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        # only dance.pk3 matches the shasum the repository has for it
+        with open('{}/data/maps.json'.format(root_dir)) as f:
+            maps = json.load(f)
+        for m in maps['data']:
+            if m['pk3'] == 'dance.pk3':
+                m['shasum'] = hashlib.sha1(PackageHandler.packages['/dance.pk3']).hexdigest()
+        tmpdir.join('maps.json').write(json.dumps(maps))
+
+        local_repositories = Collection()
+        local_repositories.add_repository(Repository(name='local',
+                                                     download_url='http://127.0.0.1:{}/'.format(httpd.server_port),
+                                                     api_data_url='http://127.0.0.1:{}/maps.json'.format(httpd.server_port),
+                                                     api_data_file=str(tmpdir.join('maps.json'))
+                                                     ))
+        map_dir = tmpdir.mkdir('maps')
+        local_store = Store(package_store_file=str(tmpdir.join('library.json')))
+        library = Library(repositories=local_repositories, store=local_store, map_dir=str(map_dir) + '/')
+
+        results = library.install_maps(pk3_names=['dance.pk3', 'gasoline_02.pk3', 'map-vapor_alpha_2.pk3', 'nothing-here.pk3', 'dance.pk3'])
+
+        assert [(r['pk3'], r['status']) for r in results] == [
+            ('dance.pk3', 'installed'),
+            ('gasoline_02.pk3', 'hash_mismatch'),
+            ('map-vapor_alpha_2.pk3', 'failed'),
+            ('nothing-here.pk3', 'not_found'),
+            ('dance.pk3', 'skipped'),
+        ]
+        assert map_dir.join('dance.pk3').read_binary() == PackageHandler.packages['/dance.pk3']
+        assert results[0]['size'] == len(PackageHandler.packages['/dance.pk3'])
+        assert not map_dir.join('gasoline_02.pk3').exists()
+        assert not map_dir.join('gasoline_02.pk3.part').exists()
+
+        assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['dance.pk3']
+
+        results = library.install_maps(pk3_names=['dance.pk3'])
+        assert results[0]['status'] == 'skipped'
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_library_discover_maps_hash_cache(tmpdir, monkeypatch):
+    dance = PackageHandler.packages['/dance.pk3']
+
+    with open('{}/data/maps.json'.format(root_dir)) as f:
+        maps = json.load(f)
+    for m in maps['data']:
+        if m['pk3'] == 'dance.pk3':
+            m['shasum'] = hashlib.sha1(dance).hexdigest()
+    tmpdir.join('maps.json').write(json.dumps(maps))
+
+    local_repositories = Collection()
+    local_repositories.add_repository(Repository(name='local',
+                                                 download_url='http://127.0.0.1/',
+                                                 api_data_url='http://127.0.0.1/maps.json',
+                                                 api_data_file=str(tmpdir.join('maps.json'))
+                                                 ))
+    map_dir = tmpdir.mkdir('maps')
+    map_dir.join('dance.pk3').write_binary(dance)
+    map_dir.join('unknown.pk3').write_binary(b'unknown')
+    local_store = Store(package_store_file=str(tmpdir.join('library.json')))
+    library = Library(repositories=local_repositories, store=local_store, map_dir=str(map_dir))
+
+    library.discover_maps(add=True, max_workers=2)
+
+    assert [m.pk3_file for m in local_store.data] == ['dance.pk3']
+    assert tmpdir.join('library.hashes.json').exists()
+    assert len(Library(repositories=local_repositories, store=local_store, map_dir=str(map_dir)).hash_cache) == 2
+
+    def fail(filename):
+        raise AssertionError('{} was hashed again'.format(filename))
+
+    monkeypatch.setattr('xmm.util.hash_file', fail)
+
+    library.discover_maps(add=True)
+    assert library.show_map('dance.pk3')
+
+    with pytest.raises(AssertionError):
+        library.discover_maps(rehash=True)
+
+
+def test_library_install_map_existing_file(tmpdir):
+    dance = PackageHandler.packages['/dance.pk3']
+
+    with open('{}/data/maps.json'.format(root_dir)) as f:
+        maps = json.load(f)
+    for m in maps['data']:
+        if m['pk3'] == 'dance.pk3':
+            m['shasum'] = hashlib.sha1(dance).hexdigest()
+    tmpdir.join('maps.json').write(json.dumps(maps))
+
+    local_repositories = Collection()
+    local_repositories.add_repository(Repository(name='local',
+                                                 download_url='http://127.0.0.1/',
+                                                 api_data_url='http://127.0.0.1/maps.json',
+                                                 api_data_file=str(tmpdir.join('maps.json'))
+                                                 ))
+    map_dir = tmpdir.mkdir('maps')
+    local_store = Store(package_store_file=str(tmpdir.join('library.json')))
+    library = Library(repositories=local_repositories, store=local_store, map_dir=str(map_dir) + '/')
+
+    # a pk3 that is not the repository's is neither cached under its shasum nor tracked
+    map_dir.join('dance.pk3').write_binary(b'bogus')
+
+    with pytest.raises(HashMismatchError):
+        library.install_map(pk3_name='dance.pk3')
+
+    assert library.hash_cache.hash_file(str(map_dir.join('dance.pk3'))) == hashlib.sha1(b'bogus').hexdigest()
+    assert not local_store.get_package('dance.pk3')
+
+    with pytest.raises(PackageNotTrackedWarning):
+        library.show_map('dance.pk3')
+
+    # the same pk3 as the repository's is tracked without downloading it
+    map_dir.join('dance.pk3').write_binary(dance)
+    library.install_map(pk3_name='dance.pk3')
+
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['dance.pk3']
+
+    # download locks are kept out of the map directory
+    assert map_dir.listdir() == [map_dir.join('dance.pk3')]
+    assert os.path.dirname(library.download_lock(str(map_dir.join('dance.pk3'))).filename) == os.path.expanduser('~/.xmm/locks')
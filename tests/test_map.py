@@ -1,7 +1,10 @@
+import json
 import os
 
+from xmm.index import PackageIndex
 from xmm.store import Store
 from xmm.map import MapPackage
+from xmm.map import PackageLookup
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
 package_store_file = os.path.join('{}/data/library.json'.format(root_dir))
@@ -13,3 +16,60 @@ def test_map_init():
         data = f.read()
         my_map = MapPackage(map_package_json=data)
     assert my_map.pk3_file == 'map-vapor_alpha_2.pk3'
+
+
+def test_package_lookup():
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+    lookup = PackageLookup(packages=store.data)
+    lookup.add(my_map)
+
+    assert 'map-vapor_alpha_2.pk3' in lookup
+    assert lookup.get_by_pk3('map-vapor_alpha_2.pk3') is my_map
+    assert lookup.get_by_shasum(my_map.shasum) == [my_map]
+    assert len(lookup) == 2
+
+    assert lookup.remove('map-vapor_alpha_2.pk3') is my_map
+    assert lookup.get_by_pk3('map-vapor_alpha_2.pk3') is None
+    assert lookup.get_by_shasum(my_map.shasum) == []
+    assert lookup.remove('map-vapor_alpha_2.pk3') is None
+
+
+def test_map_from_record():
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        data = f.read()
+        my_map = MapPackage(map_package_json=data)
+
+    record = PackageIndex.to_record(json.loads(data))
+    packed_map = MapPackage.from_record(record)
+
+    assert not hasattr(packed_map, '__dict__')
+    assert packed_map.bsps['vapor_alpha_2'].title == 'Vapor'
+    assert isinstance(packed_map.bsps['vapor_alpha_2']._entities, str)
+    assert packed_map.bsps['vapor_alpha_2'].entities['item_flag_team1'] == 1
+    assert packed_map.to_json() == my_map.to_json()
+
+
+def test_map_package_to_dict():
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        data = json.load(f)
+
+    package = MapPackage(map_package_json=data)
+    assert package.to_dict() == data
+    assert json.loads(package.to_json()) == data
+
+
+def test_map_package_replace_bsp():
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        data = json.load(f)
+
+    data['shasum'] = None
+    package = MapPackage(map_package_json=data)
+    assert package.shasum is None
+    assert list(package.bsps) == ['vapor_alpha_2']
+
+    package.bsp = {'other': dict(data['bsp']['vapor_alpha_2'], title='Other')}
+    assert package.bsps['other'].title == 'Other'
+
+    del package.bsp
+    assert package.bsps == {}
@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from xmm import cli
+from xmm.plugins import pluginloader
+
+
+def test_plugin_manifest(tmpdir, monkeypatch):
+    plugin_folder = tmpdir.mkdir('plugins')
+    shutil.copytree(os.path.join(pluginloader.plugin_folder, 'hello'), str(plugin_folder.join('hello')),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    monkeypatch.setattr(pluginloader, 'plugin_folder', str(plugin_folder))
+    manifest_file = str(tmpdir.join('plugins.json'))
+
+    plugins = pluginloader.get_manifest(filename=manifest_file)
+    assert [p['name'] for p in plugins] == ['hello']
+    assert plugins[0]['args'][0] == 'hello'
+    assert os.path.exists(manifest_file)
+
+    # a fresh manifest is used without importing plugins
+    loaded = []
+    load_plugin = pluginloader.load_plugin
+    monkeypatch.setattr(pluginloader, 'load_plugin', lambda plugin: loaded.append(plugin['name']) or load_plugin(plugin))
+
+    plugins = pluginloader.get_manifest(filename=manifest_file)
+    assert loaded == []
+    assert plugins[0]['args'][3]['type'] is int
+
+    # changing a plugin invalidates it
+    init_file = str(plugin_folder.join('hello', '__init__.py'))
+    stat = os.stat(init_file)
+    os.utime(init_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    pluginloader.get_manifest(filename=manifest_file)
+    assert loaded == ['hello']
+
+    # so does adding or changing any other module of it
+    plugin_folder.join('hello', 'extra.py').write('')
+    pluginloader.get_manifest(filename=manifest_file)
+    assert loaded == ['hello', 'hello']
+
+    pluginloader.get_manifest(filename=manifest_file)
+    assert loaded == ['hello', 'hello']
+
+
+def test_parse_args_reads_manifest_for_plugins(tmpdir, monkeypatch):
+    manifest_file = str(tmpdir.join('plugins.json'))
+    read = []
+    get_manifest = pluginloader.get_manifest
+    monkeypatch.setattr(pluginloader, 'get_manifest', lambda: read.append(True) or get_manifest(filename=manifest_file))
+
+    args = cli.parse_args(['search', 'dance'])
+    assert (args.command, args.string) == ('search', 'dance')
+    assert read == []
+
+    args = cli.parse_args(['hello', '-f', '3'])
+    assert (args.command, args.foo) == ('hello', 3)
+    assert read == [True]
+
+
+def test_version_skips_plugin_manifest(tmpdir):
+    tmpdir.mkdir('.xmm')
+    env = dict(os.environ, HOME=str(tmpdir), PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    xmm = os.path.join(env['PYTHONPATH'], 'bin', 'xmm')
+    output = subprocess.check_output([sys.executable, xmm, '--version'], env=env)
+
+    assert output.startswith(b'xmm ')
+    assert tmpdir.join('.xmm').listdir() == []
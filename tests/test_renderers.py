@@ -0,0 +1,85 @@
+import io
+import json
+import os
+
+import pytest
+
+from xmm.map import MapPackage
+from xmm.renderers import Renderer
+from xmm.repository import Repository
+from xmm.util import zcolors
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+
+with open(test_maps_file) as f:
+    maps = json.load(f)['data']
+
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def packages():
+    for m in maps:
+        yield MapPackage(map_package_json=m)
+
+
+def render(packages, **kwargs):
+    f = kwargs.pop('stream', None) or io.StringIO()
+    with Renderer(stream=f, **kwargs) as renderer:
+        for p in packages:
+            renderer.package(p)
+    return f.getvalue()
+
+
+def test_renderer_json():
+    assert json.loads(render(packages(), output='json')) == maps
+    assert json.loads(render([], output='json')) == []
+
+
+def test_renderer_ndjson_limit_offset():
+    output = render(packages(), output='ndjson', limit=2, offset=1)
+    assert [json.loads(line) for line in output.splitlines()] == maps[1:3]
+
+
+def test_renderer_table_color():
+    assert '\033[' not in render(packages(), detail='short')
+    assert render(packages(), detail='short').splitlines() == [m['pk3'] for m in maps]
+    assert zcolors.BOLD in render(packages(), stream=Terminal())
+    assert zcolors.BOLD in render(packages(), color=True)
+
+
+def test_renderer_table_only_lines():
+    f = io.StringIO()
+    with Renderer(output='ndjson', stream=f) as renderer:
+        renderer.line('header')
+        renderer.total(1)
+    assert f.getvalue() == ''
+
+
+def test_renderer_buffers():
+    f = io.StringIO()
+    renderer = Renderer(output='ndjson', stream=f)
+    renderer.package(next(packages()))
+    assert f.getvalue() == ''
+    renderer.close()
+    assert json.loads(f.getvalue()) == maps[0]
+
+
+def test_renderer_unknown_output():
+    with pytest.raises(ValueError):
+        Renderer(output='xml')
+
+
+def test_search_maps_renderer():
+    repository = Repository(name='default', download_url='http://dl.repo.url/', api_data_url='http://api.repo.url/maps.json',
+                            api_data_file=test_maps_file)
+    f = io.StringIO()
+    with Renderer(output='ndjson', stream=f, limit=1) as renderer:
+        found = repository.search_maps(bsp_name='dance', renderer=renderer)
+
+    lines = f.getvalue().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['pk3'] == found[0].pk3_file
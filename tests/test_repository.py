@@ -1,8 +1,12 @@
+import gzip
+import http.server
 import json
 import os
+import threading
 
 from xmm.repository import Repository
 from xmm.repository import Collection
+from xmm.exceptions import RepositoryUpdateError
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -55,3 +59,151 @@ def test_export_hashes():
         assert f.readline().strip() == '3df0143516f72269f465070373f165c8787964d5 map-vapor_alpha_2.pk3'
 
     os.remove(test_hash_file)
+
+
+def test_iter_packages():
+    test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+    repository = Repository(name='default', download_url='http://dl.repo.url/', api_data_url='http://api.repo.url/maps.json',
+                            api_data_file=test_maps_file)
+
+    with open(test_maps_file) as f:
+        maps = json.load(f)['data']
+
+    packages = repository.iter_packages()
+    assert not isinstance(packages, list)
+    assert [json.loads(m.to_json()) for m in packages] == maps
+    assert repository.get_hash_index()[0] == 'ef00d43838430b2d1673f03bbe1440eef100ece6 dance.pk3'
+
+
+def test_search_maps():
+    test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+    repository = Repository(name='default',
+                            download_url='http://dl.repo.url/',
+                            api_data_url='http://api.repo.url/maps.json',
+                            api_data_file=test_maps_file
+                            )
+
+    found = repository.search_maps(bsp_name='gasoline')
+    assert [m.pk3_file for m in found] == ['gasoline_02.pk3']
+
+    found = repository.search_maps(pk3_name='nex_r3', gametype='DM')
+    assert [m.pk3_file for m in found] == ['map-ctf-mikectf3_nex_r3_fix.pk3',
+                                           'map-ctf-moonstone_nex_r3.pk3',
+                                           'map-ctf-polo3ctf1_nex_r3_fix.pk3',
+                                           'map-vapor_alpha_2.pk3']
+
+    assert repository.search_maps(bsp_name='nothing-here') == []
+
+
+def test_get_package():
+    test_maps_file = os.path.join('{}/data/maps.json'.format(root_dir))
+    repository = Repository(name='default',
+                            download_url='http://dl.repo.url/',
+                            api_data_url='http://api.repo.url/maps.json',
+                            api_data_file=test_maps_file
+                            )
+
+    assert repository.get_package('dance.pk3').shasum == 'ef00d43838430b2d1673f03bbe1440eef100ece6'
+    assert repository.get_package('nothing-here.pk3') is None
+    assert [m.pk3_file for m in repository.get_packages_by_shasum('3df0143516f72269f465070373f165c8787964d5')] == ['map-vapor_alpha_2.pk3']
+
+
+class RepoDataHandler(http.server.BaseHTTPRequestHandler):
+    etag = '"v1"'
+    last_modified = 'Sat, 17 Dec 2016 00:00:00 GMT'
+    requests = []
+
+    def do_GET(self):
+        RepoDataHandler.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+
+        with open('{}/data/maps.json'.format(root_dir), 'rb') as f:
+            body = f.read()
+
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_update_repo_data(tmpdir):
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), RepoDataHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    RepoDataHandler.requests = []
+
+    try:
+        api_data_file = str(tmpdir.join('maps.json'))
+        repository = Repository(name='local',
+                                download_url='http://dl.repo.url/',
+                                api_data_url='http://127.0.0.1:{}/maps.json'.format(httpd.server_port),
+                                api_data_file=api_data_file
+                                )
+
+        assert repository.update_repo_data() is True
+        assert RepoDataHandler.requests[0]['Accept-Encoding'] == 'gzip'
+        assert 'If-None-Match' not in RepoDataHandler.requests[0]
+
+        with open(api_data_file) as f, open('{}/data/maps.json'.format(root_dir)) as expected:
+            assert f.read() == expected.read()
+
+        assert repository.get_cache_headers()['etag'] == '"v1"'
+        assert repository.get_cache_headers()['last_modified'] == RepoDataHandler.last_modified
+        assert not repository.index.is_stale()
+        assert len(repository.get_packages()) == 6
+
+        mtime = os.stat(api_data_file).st_mtime_ns
+
+        assert repository.update_repo_data() is False
+        assert RepoDataHandler.requests[1]['If-None-Match'] == '"v1"'
+        assert RepoDataHandler.requests[1]['If-Modified-Since'] == RepoDataHandler.last_modified
+        assert os.stat(api_data_file).st_mtime_ns == mtime
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_update_all(tmpdir):
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), RepoDataHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        repositories = Collection()
+        for name in ('one', 'two'):
+            repositories.add_repository(Repository(name=name,
+                                                   download_url='http://dl.repo.url/',
+                                                   api_data_url='http://127.0.0.1:{}/maps.json'.format(httpd.server_port),
+                                                   api_data_file=str(tmpdir.join('{}.maps.json'.format(name)))
+                                                   ))
+        repositories.add_repository(Repository(name='dead',
+                                               download_url='http://dl.repo.url/',
+                                               api_data_url='http://127.0.0.1:1/maps.json',
+                                               api_data_file=str(tmpdir.join('dead.maps.json'))
+                                               ))
+
+        results = repositories.update_all()
+        assert [(r['name'], r['status']) for r in results] == [('one', 'updated'), ('two', 'updated'), ('dead', 'failed')]
+        assert isinstance(results[2]['error'], RepositoryUpdateError)
+
+        results = repositories.update_all()
+        assert [r['status'] for r in results] == ['unchanged', 'unchanged', 'failed']
+        assert all(r['elapsed'] >= 0 for r in results)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -1,7 +1,13 @@
 import json
+import multiprocessing
 import os
+import pytest
 from shutil import copyfile
 
+from xmm.backends import get_backend
+from xmm.backends import JournalBackend
+from xmm.backends import SqliteBackend
+from xmm.backends import StoreBackend
 from xmm.store import Store
 from xmm.map import MapPackage
 
@@ -74,3 +80,287 @@ def test_store_export_packages():
         except ValueError as e:
             Exception("not json")
     os.remove(test_library_file)
+
+
+def test_store_get_package():
+    copyfile('{}/data/library.json'.format(root_dir), '{}/data/new.json'.format(root_dir))
+    test_library_file = os.path.join('{}/data/new.json'.format(root_dir))
+    store = Store(package_store_file=test_library_file)
+
+    assert store.get_package('dance.pk3').shasum == 'ef00d43838430b2d1673f03bbe1440eef100ece6'
+    assert store.get_package('map-vapor_alpha_2.pk3') is None
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+    store.add_package(my_map)
+    assert store.get_package('map-vapor_alpha_2.pk3') is my_map
+    assert store.get_packages_by_shasum(my_map.shasum) == [my_map]
+
+    store.remove_package(my_map)
+    assert store.get_package('map-vapor_alpha_2.pk3') is None
+    assert store.get_packages_by_shasum(my_map.shasum) == []
+    assert [m.pk3_file for m in store.data] == ['dance.pk3']
+    os.remove(test_library_file)
+
+
+def test_store_sqlite_backend(tmpdir):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+
+    # a new database imports the json library next to it once
+    store = Store(package_store_file=str(tmpdir.join('library.db')))
+    assert isinstance(store.backend, SqliteBackend)
+    assert [m.pk3_file for m in store.data] == ['dance.pk3']
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+    store.add_package(my_map)
+
+    store = Store(package_store_file=str(tmpdir.join('library.db')))
+    assert [m.pk3_file for m in store.data] == ['dance.pk3', 'map-vapor_alpha_2.pk3']
+    assert store.get_package('map-vapor_alpha_2.pk3').to_json() == my_map.to_json()
+
+    store.remove_package(store.get_package('dance.pk3'))
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.db'))).data] == ['map-vapor_alpha_2.pk3']
+
+    # the json library is left alone
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['dance.pk3']
+
+
+def test_store_sqlite_backend_json_library(tmpdir):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+
+    # store_backend = sqlite with the default library.json uses library.db next to it
+    backend = get_backend(str(tmpdir.join('library.json')), backend='sqlite')
+    assert isinstance(backend, SqliteBackend)
+    assert backend.data_file == str(tmpdir.join('library.db'))
+    assert [m.pk3_file for m in backend.load()] == ['dance.pk3']
+
+    with open('{}/data/library.json'.format(root_dir)) as f:
+        assert json.load(f) == json.loads(tmpdir.join('library.json').read())
+
+
+def test_store_batch(tmpdir, monkeypatch):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+    store = Store(package_store_file=str(tmpdir.join('library.json')))
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+
+    writes = []
+    write = store.backend.write
+    monkeypatch.setattr(store.backend, 'write', lambda operations, data: writes.append(operations) or write(operations, data))
+
+    with store.batch():
+        store.add_package(my_map)
+        store.remove_package(store.get_package('dance.pk3'))
+        assert writes == []
+        assert [m.pk3_file for m in store.data] == ['map-vapor_alpha_2.pk3']
+
+    assert [[op for op, _ in operations] for operations in writes] == [['add', 'remove']]
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['map-vapor_alpha_2.pk3']
+
+    # a failing batch writes nothing and restores the store
+    try:
+        with store.batch():
+            store.remove_package(my_map)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    assert len(writes) == 1
+    assert store.get_package('map-vapor_alpha_2.pk3').shasum == my_map.shasum
+
+
+def test_store_batch_failures(tmpdir, monkeypatch):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+    store = Store(package_store_file=str(tmpdir.join('library.json')))
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+
+    # a failing inner batch only discards its own changes, the outer batch carries on
+    with store.batch():
+        store.remove_package(store.get_package('dance.pk3'))
+        try:
+            with store.batch():
+                store.add_package(my_map)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert store.data == []
+        store.add_package(my_map)
+        assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['dance.pk3']
+
+    assert [m.pk3_file for m in Store(package_store_file=str(tmpdir.join('library.json'))).data] == ['map-vapor_alpha_2.pk3']
+
+    # a failing write leaves the store as it is on disk
+    def fail(operations, data):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(store.backend, 'write', fail)
+
+    with pytest.raises(OSError):
+        with store.batch():
+            store.remove_package(my_map)
+    assert [m.pk3_file for m in store.data] == ['map-vapor_alpha_2.pk3']
+
+    with pytest.raises(OSError):
+        store.remove_package(my_map)
+    assert [m.pk3_file for m in store.data] == ['map-vapor_alpha_2.pk3']
+
+
+def test_store_get_package_db_cache(tmpdir, monkeypatch):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+    store = Store(package_store_file=str(tmpdir.join('library.json')))
+    data = store.data
+
+    loads = []
+    load = store.backend.load
+    monkeypatch.setattr(store.backend, 'load', lambda: loads.append(1) or load())
+
+    # unchanged file, nothing is read
+    assert store.get_package_db() is data
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+    store.add_package(my_map)
+    assert store.get_package_db() is data
+    assert loads == []
+
+    # another process writing the file is picked up, in place
+    other = Store(package_store_file=str(tmpdir.join('library.json')))
+    other.remove_package(other.get_package('dance.pk3'))
+
+    assert store.get_package_db() is data
+    assert loads == [1]
+    assert [m.pk3_file for m in data] == ['map-vapor_alpha_2.pk3']
+    assert store.get_package('dance.pk3') is None
+
+
+def test_store_journal_backend(tmpdir):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+    backend = JournalBackend(data_file=str(tmpdir.join('library.json')), compact_size=None)
+    store = Store(package_store_file=str(tmpdir.join('library.json')), backend=backend)
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+    store.add_package(my_map)
+    store.remove_package(store.get_package('dance.pk3'))
+
+    # changes only go to the journal, the snapshot is untouched
+    with open('{}/data/library.json'.format(root_dir)) as f:
+        assert tmpdir.join('library.json').read() == f.read()
+    assert len(tmpdir.join('library.json.journal').readlines()) == 2
+
+    # a crash halfway through an append is skipped on replay
+    with open(str(tmpdir.join('library.json.journal')), 'a') as f:
+        f.write('{"op": "remove", "pk3"')
+
+    reloaded = JournalBackend(data_file=str(tmpdir.join('library.json')), compact_size=None)
+    assert [m.pk3_file for m in reloaded.load()] == ['map-vapor_alpha_2.pk3']
+
+    reloaded.compact()
+    assert tmpdir.join('library.json.journal').read() == ''
+    assert [m['pk3'] for m in json.loads(tmpdir.join('library.json').read())] == ['map-vapor_alpha_2.pk3']
+
+    # compaction starts on its own once the journal is large enough
+    store = Store(package_store_file=str(tmpdir.join('library.json')),
+                  backend=JournalBackend(data_file=str(tmpdir.join('library.json')), compact_size=1))
+    store.remove_package(my_map)
+    store.backend.wait()
+    assert tmpdir.join('library.json.journal').read() == ''
+    assert json.loads(tmpdir.join('library.json').read()) == []
+
+
+def test_store_iter_packages(tmpdir):
+    copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join('library.json')))
+    backend = JournalBackend(data_file=str(tmpdir.join('library.json')), compact_size=None)
+    store = Store(package_store_file=str(tmpdir.join('library.json')), backend=backend)
+
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        data = json.load(f)
+
+    with store.batch():
+        dance = store.get_package('dance.pk3')
+        store.remove_package(dance)
+        data['pk3'] = 'new.pk3'
+        data['shasum'] = 'new'
+        store.add_package(MapPackage(map_package_json=data))
+        store.add_package(dance)
+
+    # streamed from the snapshot and the journal without loading the store
+    other = Store(package_store_file=str(tmpdir.join('library.json')),
+                  backend=JournalBackend(data_file=str(tmpdir.join('library.json')), compact_size=None))
+    streamed = [m.pk3_file for m in other.iter_packages()]
+    assert other._data is None
+    assert streamed == [m.pk3_file for m in other.backend.load()]
+    assert streamed == ['new.pk3', 'dance.pk3']
+
+    # loaded packages are used while current
+    assert [m.pk3_file for m in store.iter_packages()] == [m.pk3_file for m in store.data]
+
+
+def _add_packages(package_store_file, names):
+    store = Store(package_store_file=package_store_file)
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        data = json.load(f)
+    for name in names:
+        data['pk3'] = name
+        data['shasum'] = name
+        store.add_package(MapPackage(map_package_json=data))
+
+
+def test_store_concurrent_processes(tmpdir):
+    package_store_file = str(tmpdir.join('library.json'))
+    copyfile('{}/data/library.json'.format(root_dir), package_store_file)
+    Store(package_store_file=package_store_file)
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_add_packages,
+                                 args=(package_store_file, ['{}-{}.pk3'.format(p, i) for i in range(5)]))
+                 for p in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # no process overwrote the others' adds
+    assert len(Store(package_store_file=package_store_file).data) == 21
+
+
+def test_store_add_package_replaces(tmpdir):
+    with open('{}/data/map.json'.format(root_dir)) as f:
+        my_map = MapPackage(map_package_json=f.read())
+
+    backends = {
+        'library.json': lambda data_file: None,
+        'journal.json': lambda data_file: JournalBackend(data_file=data_file, compact_size=None),
+        'library.db': lambda data_file: None,
+    }
+
+    for name, backend in backends.items():
+        data_file = str(tmpdir.join(name))
+        copyfile('{}/data/library.json'.format(root_dir), str(tmpdir.join(name.replace('.db', '.json'))))
+        store = Store(package_store_file=data_file, backend=backend(data_file))
+
+        dance = store.get_package('dance.pk3')
+        newer = MapPackage(map_package_json=dance.to_json())
+        newer.date = dance.date + 1
+
+        store.add_package(my_map)
+        store.add_package(newer)
+        with store.batch():
+            store.add_package(newer)
+
+        # the same pk3 is tracked once, in memory and once reloaded
+        for packages in (store.data, Store(package_store_file=data_file, backend=backend(data_file)).data):
+            assert [m.pk3_file for m in packages] == ['map-vapor_alpha_2.pk3', 'dance.pk3'], name
+            assert packages[1].date == newer.date
+
+
+def test_store_backend_is_abstract(tmpdir):
+    class ReadOnlyBackend(StoreBackend):
+        def load(self):
+            return []
+
+    with pytest.raises(TypeError):
+        ReadOnlyBackend(data_file=str(tmpdir.join('library.json')))
@@ -1,15 +1,43 @@
+import hashlib
+import http.server
+import io
+import json
 import os
+import pytest
+import threading
+import time
+from xmm.exceptions import HashMismatchError
+from xmm.exceptions import LockTimeoutError
+from xmm.util import FileLock
 from xmm.util import file_is_empty
+from xmm.util import hash_file
+from xmm.util import iter_json_array
 from xmm.util import convert_size
 from xmm.util import parse_config
 from xmm.util import check_if_not_create
 from xmm.util import replace_last
+from xmm.util import stream_download
 
 
 def test_file_is_empty():
     assert file_is_empty('README.md') is False
 
 
+def test_hash_file(tmpdir):
+    empty = tmpdir.join('empty.pk3')
+    empty.write_binary(b'')
+    assert hash_file(str(empty)) == hashlib.sha1(b'').hexdigest()
+    assert hash_file(str(empty), mmap_threshold=0) == hashlib.sha1(b'').hexdigest()
+
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    large = tmpdir.join('large.pk3')
+    large.write_binary(data)
+    expected = hashlib.sha1(data).hexdigest()
+    assert hash_file(str(large)) == expected
+    assert hash_file(str(large), buffer_size=4096, mmap_threshold=None) == expected
+    assert hash_file(str(large), mmap_threshold=1024) == expected
+
+
 def test_convert_size():
     assert convert_size(1) == '1B'
     assert convert_size(1023) == '1023B'
@@ -34,3 +62,168 @@ def test_parse_config():
 def test_replace_last():
     _string = replace_last('one, two, three,', ',', ';')
     assert _string == 'one, two, three;'
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    body = bytes(range(256)) * 400
+    etag = '"v1"'
+    requests = []
+    fail_first = True
+
+    def do_GET(self):
+        FlakyHandler.requests.append(self.headers.get('Range'))
+
+        start = 0
+        if_range = self.headers.get('If-Range')
+        if self.headers.get('Range') and (if_range is None or if_range == self.etag):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+
+        body = self.body[start:]
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if FlakyHandler.fail_first:
+            # drop the connection half way through
+            FlakyHandler.fail_first = False
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_stream_download_resumes(tmpdir):
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    FlakyHandler.requests = []
+    FlakyHandler.fail_first = True
+
+    try:
+        url = 'http://127.0.0.1:{}/map.pk3'.format(httpd.server_port)
+        filename = str(tmpdir.join('map.pk3'))
+        received = []
+
+        size = stream_download(filename, url, progress=lambda count, total: received.append(count), backoff=0)
+
+        assert size == len(FlakyHandler.body)
+        assert sum(received) == len(FlakyHandler.body)
+        assert FlakyHandler.requests == [None, 'bytes={}-'.format(len(FlakyHandler.body) // 2)]
+        assert tmpdir.join('map.pk3').read_binary() == FlakyHandler.body
+        assert not tmpdir.join('map.pk3.part').exists()
+        assert not tmpdir.join('map.pk3.part.validator').exists()
+
+        # resume a part file left behind by an earlier run
+        FlakyHandler.requests = []
+        tmpdir.join('other.pk3.part').write_binary(FlakyHandler.body[:1000])
+        tmpdir.join('other.pk3.part.validator').write(FlakyHandler.etag)
+        stream_download(str(tmpdir.join('other.pk3')), url, backoff=0)
+        assert FlakyHandler.requests == ['bytes=1000-']
+        assert tmpdir.join('other.pk3').read_binary() == FlakyHandler.body
+
+        # the file changed on the server since, it is downloaded again from the start
+        FlakyHandler.requests = []
+        tmpdir.join('changed.pk3.part').write_binary(b'old' * 1000)
+        tmpdir.join('changed.pk3.part.validator').write('"v0"')
+        stream_download(str(tmpdir.join('changed.pk3')), url, backoff=0)
+        assert FlakyHandler.requests == ['bytes=3000-']
+        assert tmpdir.join('changed.pk3').read_binary() == FlakyHandler.body
+
+        # a part file of unknown origin is not resumed without a shasum to check
+        FlakyHandler.requests = []
+        tmpdir.join('unknown.pk3.part').write_binary(b'old' * 1000)
+        stream_download(str(tmpdir.join('unknown.pk3')), url, backoff=0)
+        assert FlakyHandler.requests == [None]
+        assert tmpdir.join('unknown.pk3').read_binary() == FlakyHandler.body
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_stream_download_verifies_shasum(tmpdir):
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    FlakyHandler.fail_first = True
+
+    try:
+        url = 'http://127.0.0.1:{}/map.pk3'.format(httpd.server_port)
+        shasum = hashlib.sha1(FlakyHandler.body).hexdigest()
+
+        # hashed across an interrupted and resumed transfer
+        stream_download(str(tmpdir.join('map.pk3')), url, backoff=0, shasum=shasum)
+        assert tmpdir.join('map.pk3').read_binary() == FlakyHandler.body
+
+        with pytest.raises(HashMismatchError):
+            stream_download(str(tmpdir.join('bad.pk3')), url, backoff=0, shasum='0' * 40)
+        assert not tmpdir.join('bad.pk3').exists()
+        assert not tmpdir.join('bad.pk3.part').exists()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_file_lock(tmpdir):
+    lock_file = str(tmpdir.join('library.json.lock'))
+    lock = FileLock(lock_file, timeout=0)
+
+    with lock:
+        # re-entrant for the holder
+        with lock:
+            pass
+
+        # a second lock on the file behaves like another process
+        with pytest.raises(LockTimeoutError):
+            FileLock(lock_file, timeout=0.1).acquire()
+
+    with FileLock(lock_file, timeout=0):
+        pass
+
+
+def test_file_lock_remove(tmpdir):
+    lock_file = str(tmpdir.join('map.pk3.lock'))
+    held = []
+
+    def wait_for_lock():
+        with FileLock(lock_file, timeout=5, poll_interval=0.01, remove=True):
+            held.append(os.path.exists(lock_file))
+
+    with FileLock(lock_file, timeout=0, remove=True):
+        waiting = threading.Thread(target=wait_for_lock)
+        waiting.start()
+        time.sleep(0.1)
+
+    waiting.join(5)
+
+    # the waiting lock noticed the file it opened was removed and locked a new one
+    assert held == [True]
+    assert not os.path.exists(lock_file)
+
+
+def test_iter_json_array():
+    items = [1, -3e10, 'x', None, True, {'pk3': 'a' * 100, 'bsp': {'a': [1, 2]}}, [], 12345678901234567890]
+
+    for chunk_size in (1, 3, 64 * 1024):
+        assert list(iter_json_array(io.StringIO(json.dumps(items)), chunk_size=chunk_size)) == items
+
+        document = json.dumps({'meta': {'data': [0]}, 'count': 12345, 'data': items, 'after': 1}, indent=2)
+        assert list(iter_json_array(io.StringIO(document), key='data', chunk_size=chunk_size)) == items
+
+    assert list(iter_json_array(io.StringIO(' [ ] '))) == []
+
+    with pytest.raises(KeyError):
+        list(iter_json_array(io.StringIO('{"count": 1}'), key='data'))
+
+    for document in ('[1, 2', '[1 2]', ''):
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.StringIO(document), chunk_size=2))
@@ -0,0 +1,528 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from xmm.base import Base
+from xmm.config import conf
+from xmm.exceptions import LockTimeoutError
+from xmm.map import MapPackage
+from xmm import util
+
+
+sqlite_extensions = ('.db', '.sqlite', '.sqlite3')
+
+
+def get_backend(data_file, backend=None):
+    """
+    Picks the *Store* backend for a library file
+
+    With ``backend`` set to ``auto``, ``.db``, ``.sqlite`` and ``.sqlite3`` files use *SqliteBackend*
+    and anything else *JsonBackend*. A new **SQLite** library imports the **JSON** library with the
+    same name once, if there is one. With ``sqlite`` set for any other file, such as ``library.json``,
+    the database is ``library.db`` next to it.
+
+    :param data_file:
+        The file where the data is stored
+    :type data_file: ``str``
+
+    :param backend:
+        ``auto``, ``json``, ``journal`` or ``sqlite``, defaults to ``store_backend`` in ``~/.xmm.ini``
+    :type backend: ``str``
+
+    :returns: ``JsonBackend``, ``JournalBackend`` or ``SqliteBackend``
+
+    >>> from xmm.backends import get_backend
+    >>> backend = get_backend('~/.xmm/library.db')
+    """
+    data_file = os.path.expanduser(data_file)
+    name, extension = os.path.splitext(data_file)
+
+    if not backend:
+        backend = conf['default'].get('store_backend') or 'auto'
+
+    if backend == 'auto':
+        backend = 'sqlite' if extension.lower() in sqlite_extensions else 'json'
+
+    if backend == 'sqlite':
+        # a library configured as json, like the default ~/.xmm/library.json, gets a database next to it
+        if extension.lower() not in sqlite_extensions:
+            return SqliteBackend(data_file='{}.db'.format(name), migrate_from=data_file)
+        return SqliteBackend(data_file=data_file, migrate_from='{}.json'.format(name))
+
+    if backend == 'journal':
+        return JournalBackend(data_file=data_file)
+
+    if backend != 'json':
+        raise ValueError('Unknown store backend: {}'.format(backend))
+
+    return JsonBackend(data_file=data_file)
+
+
+class StoreBackend(Base, abc.ABC):
+    """
+    Base class for the persistence of a *Store*
+
+    The *Store* keeps every *MapPackage* in memory and hands changes to ``write`` as a list of
+    operations, ``('add', [MapPackage, ...])`` or ``('remove', MapPackage)``, along with the
+    resulting list of packages. A backend may persist either of them. An add replaces a package
+    with the same pk3 name.
+
+    ``lock`` is a *FileLock* on ``<data_file>.lock`` that the *Store* holds while changing the data,
+    so several processes can share one library.
+
+    Backends have to implement ``load`` and ``write``.
+
+    :param data_file:
+        The file where the data is stored
+    :type data_file: ``str``
+    """
+    def __init__(self, data_file):
+        super().__init__()
+        self.data_file = os.path.expanduser(data_file)
+        self.lock = util.FileLock('{}.lock'.format(self.data_file), timeout=self.conf['default'].get('lock_timeout', -1))
+
+    def __repr__(self):
+        return str(vars(self))
+
+    def __json__(self):
+        return {
+            'data_file': self.data_file,
+        }
+
+    def get_signature(self):
+        """
+        :returns: ``tuple`` of the data file size and modification time, or ``None`` if it does not exist
+        """
+        try:
+            stat = os.stat(self.data_file)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    @abc.abstractmethod
+    def load(self):
+        """
+        :returns: ``list`` of ``MapPackage``
+        """
+        raise NotImplementedError
+
+    def iter_packages(self):
+        """
+        Yields every stored *MapPackage* one at a time, backends override this to avoid loading them all
+
+        :returns: generator of ``MapPackage``
+        """
+        for package in self.load():
+            yield package
+
+    @abc.abstractmethod
+    def write(self, operations, data):
+        """
+        Persists ``operations`` in one atomic write
+
+        :param operations:
+            ``('add', packages)`` and ``('remove', package)`` tuples in the order they happened
+        :type operations: ``list``
+
+        :param data:
+            Every *MapPackage* in the *Store* after ``operations``
+        :type data: ``list``
+
+        :returns: False if fails
+        """
+        raise NotImplementedError
+
+    def add(self, packages, data):
+        """
+        :param packages:
+            MapPackages that were added
+        :type packages: ``list``
+
+        :param data:
+            Every *MapPackage* in the *Store*, including ``packages``
+        :type data: ``list``
+
+        :returns: False if fails
+        """
+        return self.write([('add', packages)], data)
+
+    def remove(self, package, data):
+        """
+        Removes every package with the pk3 name or shasum of ``package``
+
+        :param package:
+            MapPackage to remove
+        :type package: ``MapPackage``
+
+        :param data:
+            Every *MapPackage* left in the *Store*
+        :type data: ``list``
+
+        :returns: False if fails
+        """
+        return self.write([('remove', package)], data)
+
+
+class JsonBackend(StoreBackend):
+    """
+    Keeps a *Store* in a single **JSON** array, every write replaces the file
+
+    :param data_file:
+        The file where the data is stored
+    :type data_file: ``str``
+
+    :returns object: ``JsonBackend``
+    """
+    def __init__(self, data_file):
+        super().__init__(data_file=data_file)
+        util.create_if_not_exists(self.data_file, json.dumps([]))
+
+    def load(self):
+        """
+        :returns: ``list`` of ``MapPackage``
+        """
+        return list(self.iter_packages())
+
+    def iter_packages(self):
+        """
+        Yields every stored *MapPackage* one at a time, the file is parsed incrementally
+
+        :returns: generator of ``MapPackage``
+        """
+        for m in self._iter_snapshot():
+            yield MapPackage(map_package_json=m)
+
+    def _iter_snapshot(self):
+        util.create_if_not_exists(self.data_file, json.dumps([]))
+
+        if util.file_is_empty(self.data_file):
+            return
+
+        with open(self.data_file) as f:
+            for m in util.iter_json_array(f):
+                yield m
+
+    def write(self, operations, data):
+        # one dumps call is much faster than json.dump writing every token to the file
+        data_out = json.dumps([m.to_dict() for m in data])
+
+        tmp_file = '{}.tmp.{}'.format(self.data_file, os.getpid())
+
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(data_out)
+            os.replace(tmp_file, self.data_file)
+        except EnvironmentError as e:
+            self.logger.error(e)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+
+
+class JournalBackend(JsonBackend):
+    """
+    Keeps a *Store* as a **JSON** snapshot plus an append-only journal of changes
+
+    The snapshot has the same format as a *JsonBackend* library. Every write appends one **JSON**
+    line per add or remove to ``<data_file>.journal`` and syncs it to disk, so writes no longer
+    depend on the size of the library. Loading replays the journal over the snapshot. A write
+    that grows the journal past ``compact_size`` starts a background thread that folds the journal
+    into a new snapshot.
+
+    Replaying is idempotent, an add replaces packages with the same pk3 name, so a journal left
+    behind by an interrupted compaction is harmless. An incomplete line, left by a crash while
+    appending, is skipped.
+
+    :param data_file:
+        The snapshot file
+    :type data_file: ``str``
+
+    :param journal_file:
+        The journal, defaults to ``data_file`` with a ``.journal`` suffix
+    :type journal_file: ``str``
+
+    :param compact_size:
+        Journal size in bytes that triggers compaction, ``None`` to only compact by calling ``compact``
+    :type compact_size: ``int``
+
+    :returns object: ``JournalBackend``
+
+    >>> from xmm.backends import JournalBackend
+    >>> backend = JournalBackend(data_file='~/.xmm/library.json')
+    >>> packages = backend.load()
+    >>> backend.compact()
+    """
+    def __init__(self, data_file, journal_file=None, compact_size=1024 * 1024):
+        super().__init__(data_file=data_file)
+
+        if not journal_file:
+            journal_file = '{}.journal'.format(self.data_file)
+
+        self.journal_file = os.path.expanduser(journal_file)
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._compaction = None
+
+    def __json__(self):
+        return {
+            'data_file': self.data_file,
+            'journal_file': self.journal_file,
+        }
+
+    def get_signature(self):
+        """
+        :returns: ``tuple`` of the size and modification time of the snapshot and the journal
+        """
+        signature = super().get_signature()
+
+        if signature is None:
+            return None
+
+        try:
+            stat = os.stat(self.journal_file)
+        except FileNotFoundError:
+            return signature
+
+        return signature + (stat.st_size, stat.st_mtime_ns)
+
+    def iter_packages(self):
+        """
+        Yields every *MapPackage* of the snapshot with the journal replayed over it
+
+        Only the journal is read into memory, the snapshot is streamed. Packages from the snapshot that
+        the journal replaces or removes are skipped, packages added by the journal follow in the order
+        they were added.
+
+        :returns: generator of ``MapPackage``
+        """
+        entries = self._read_journal()
+
+        added = []
+        replaced = set()
+        removed_pk3s = set()
+        removed_shasums = set()
+
+        # walk backwards, an add only survives if no later entry replaces or removes it
+        for entry in reversed(entries):
+            if entry['op'] == 'add':
+                package = entry['package']
+                if package['pk3'] not in replaced and package['pk3'] not in removed_pk3s and package.get('shasum') not in removed_shasums:
+                    added.append(package)
+                replaced.add(package['pk3'])
+            elif entry['op'] == 'remove':
+                removed_pk3s.add(entry['pk3'])
+                removed_shasums.add(entry['shasum'])
+
+        for m in self._iter_snapshot():
+            if m.get('pk3') in replaced or m.get('pk3') in removed_pk3s or m.get('shasum') in removed_shasums:
+                continue
+            yield MapPackage(map_package_json=m)
+
+        for m in reversed(added):
+            yield MapPackage(map_package_json=m)
+
+    def _read_journal(self):
+        entries = []
+
+        if not os.path.exists(self.journal_file):
+            return entries
+
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    self.logger.warning('Ignoring incomplete journal entry in {}'.format(self.journal_file))
+
+        return entries
+
+    def write(self, operations, data):
+        lines = []
+        for operation, target in operations:
+            if operation == 'add':
+                for m in target:
+                    lines.append(json.dumps({'op': 'add', 'package': m.to_dict()}))
+            elif operation == 'remove':
+                lines.append(json.dumps({'op': 'remove', 'pk3': target.pk3_file, 'shasum': target.shasum}))
+
+        with self._lock:
+            try:
+                with open(self.journal_file, 'a+b') as f:
+                    # start on a new line if a crash left an incomplete entry behind
+                    if f.tell():
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            lines.insert(0, '')
+                    f.write(''.join('{}\n'.format(line) for line in lines).encode('utf-8'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                journal_size = os.path.getsize(self.journal_file)
+            except EnvironmentError as e:
+                self.logger.error(e)
+                return False
+
+            if self.compact_size is not None and journal_size >= self.compact_size and not self._compaction:
+                self._compaction = threading.Thread(target=self.compact)
+                self._compaction.start()
+
+    def compact(self):
+        """
+        Folds the journal into a new snapshot and empties it, while holding the library lock
+
+        :returns: False if fails
+        """
+        try:
+            self.lock.acquire()
+        except LockTimeoutError as e:
+            self.logger.warning('Not compacting {}, the library is locked: {}'.format(self.journal_file, e))
+            self._compaction = None
+            return False
+
+        try:
+            with self._lock:
+                return self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        try:
+            data = self.load()
+
+            self.logger.info('Compacting {} into {}'.format(self.journal_file, self.data_file))
+
+            if super().write([], data) is False:
+                return False
+
+            # the snapshot already holds every entry, replaying them again would be harmless
+            with open(self.journal_file, 'w'):
+                pass
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
+        finally:
+            self._compaction = None
+
+    def wait(self):
+        """
+        Waits for a running compaction to finish
+        """
+        compaction = self._compaction
+        if compaction:
+            compaction.join()
+
+
+class SqliteBackend(StoreBackend):
+    """
+    Keeps a *Store* in an **SQLite** database indexed on pk3 name and shasum
+
+    Every write is a single transaction touching only the affected rows.
+
+    :param data_file:
+        The database file
+    :type data_file: ``str``
+
+    :param migrate_from:
+        A **JSON** library to import when the database is created
+    :type migrate_from: ``str``
+
+    :returns object: ``SqliteBackend``
+
+    >>> from xmm.backends import SqliteBackend
+    >>> backend = SqliteBackend(data_file='~/.xmm/library.db', migrate_from='~/.xmm/library.json')
+    >>> packages = backend.load()
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS packages (
+            id INTEGER PRIMARY KEY,
+            pk3 TEXT NOT NULL,
+            shasum TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS packages_pk3 ON packages (pk3);
+        CREATE INDEX IF NOT EXISTS packages_shasum ON packages (shasum);
+    '''
+
+    def __init__(self, data_file, migrate_from=None):
+        super().__init__(data_file=data_file)
+
+        created = not os.path.exists(self.data_file)
+
+        directory = os.path.dirname(self.data_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.transaction() as connection:
+            connection.executescript(self.schema)
+
+        if created and migrate_from and os.path.exists(os.path.expanduser(migrate_from)):
+            self.import_json(migrate_from)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Opens a connection and commits when the block exits, or rolls back if it raises
+
+        >>> with backend.transaction() as connection:
+        >>>     connection.execute('DELETE FROM packages')
+        """
+        connection = sqlite3.connect(self.data_file)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def load(self):
+        """
+        :returns: ``list`` of ``MapPackage``
+        """
+        return list(self.iter_packages())
+
+    def iter_packages(self):
+        """
+        Yields every stored *MapPackage* one at a time from a cursor
+
+        :returns: generator of ``MapPackage``
+        """
+        with self.transaction() as connection:
+            for row in connection.execute('SELECT data FROM packages ORDER BY id'):
+                yield MapPackage(map_package_json=row[0])
+
+    def write(self, operations, data=None):
+        try:
+            with self.transaction() as connection:
+                for operation, target in operations:
+                    if operation == 'add':
+                        connection.executemany('DELETE FROM packages WHERE pk3 = ?', [(m.pk3_file,) for m in target])
+                        connection.executemany('INSERT INTO packages (pk3, shasum, data) VALUES (?, ?, ?)',
+                                               [(m.pk3_file, m.shasum, m.to_json()) for m in target])
+                    elif operation == 'remove':
+                        connection.execute('DELETE FROM packages WHERE pk3 = ? OR shasum = ?',
+                                           (target.pk3_file, target.shasum))
+        except sqlite3.Error as e:
+            self.logger.error(e)
+            return False
+
+    def import_json(self, json_file):
+        """
+        Imports a **JSON** library in one transaction
+
+        :param json_file:
+            A **JSON** library such as ``~/.xmm/library.json``
+        :type json_file: ``str``
+
+        :returns: ``int`` number of packages imported
+        """
+        json_file = os.path.expanduser(json_file)
+
+        self.logger.info('Importing {} into {}'.format(json_file, self.data_file))
+
+        packages = JsonBackend(data_file=json_file).load()
+        if self.add(packages, packages) is False:
+            return 0
+
+        return len(packages)
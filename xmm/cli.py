@@ -3,31 +3,20 @@
 # A tool to help manage Xonotic maps
 # z@xnz.me
 
-import argcomplete
 import argparse
 import logging
 import os
+import sys
 
 from xmm import __version__
+from xmm import config
 from xmm.config import conf
 
-from xmm.server import LocalServer
-from xmm.server import ServerCollection
-
-from xmm.exceptions import HashMismatchError
-from xmm.exceptions import PackageMetadataWarning
-from xmm.exceptions import PackageNotTrackedWarning
-from xmm.exceptions import PackageLookupError
-from xmm.exceptions import RepositoryLookupError
-from xmm.exceptions import RepositoryUpdateError
-from xmm.exceptions import ServerLookupError
 from xmm.plugins import pluginbase
 from xmm.plugins import pluginloader
 from xmm.logger import ClassPrefixAdapter
-from xmm.util import cprint
-from xmm.util import zcolors
-from xmm import util
 
+# xmm.util and xmm.exceptions are imported where they are used, --help and --version don't need them
 plugins = {}
 
 cli_logger = ClassPrefixAdapter(prefix='cli', logger=logging.getLogger(__name__))
@@ -35,10 +24,19 @@ cli_logger = ClassPrefixAdapter(prefix='cli', logger=logging.getLogger(__name__)
 
 def main():
 
-    pluginbase.set_config(conf)
     args = parse_args()
     server = None
 
+    from xmm.exceptions import ServerLookupError
+    from xmm.util import cprint
+    from xmm import util
+
+    config.init()
+
+    if args.command == 'daemon':
+        run_daemon(args)
+        return
+
     # Just install
     if args.target:
         if args.command != 'install':
@@ -52,18 +50,26 @@ def main():
             cprint("Target directory does not exist.", style='FAIL')
             raise SystemExit
 
-        filename_with_path = os.path.join(target_dir, args.pk3)
-        url_with_file = '{}/{}'.format(conf['default']['download_url'], args.pk3)
+        pk3s = args.pk3 if isinstance(args.pk3, list) else [args.pk3]
+
+        for pk3 in pk3s:
+            filename_with_path = os.path.join(target_dir, pk3)
+            url_with_file = '{}/{}'.format(conf['default']['download_url'], pk3)
 
-        success = util.download_file(filename_with_path=filename_with_path, url=url_with_file, use_curl=conf['default']['use_curl'])
+            success = util.download_file(filename_with_path=filename_with_path, url=url_with_file, use_curl=conf['default']['use_curl'])
 
-        if not success:
-            cli_logger.warning("{} already exists, not installing.".format(args.pk3))
+            if not success:
+                cli_logger.warning("{} already exists, not installing.".format(pk3))
 
         exit(0)
 
     # Use all source repositories
     else:
+        if not args.no_daemon and forward_to_daemon(args):
+            return
+
+        from xmm.server import LocalServer
+
         try:
             server = LocalServer(server_name=args.server)
         except NotADirectoryError as e:
@@ -76,6 +82,39 @@ def main():
         except ServerLookupError as e:
             cprint("server '{}' does not exist in ~/.xmm/servers.json".format(e), style='FAIL')
 
+    run_command(args, server)
+
+
+def run_command(args, server, stream=None):
+    """
+    Runs a subcommand against a *LocalServer*, used by the CLI and by the daemon
+
+    :param args:
+        Parsed arguments, ``args.interactive = False`` installs without prompting
+    :type args: ``argparse.Namespace``
+
+    :param server:
+        The server to run the command for
+    :type server: ``LocalServer``
+
+    :param stream:
+        Where to write the output of ``search``, ``install``, ``discover``, ``list`` and ``show``,
+        defaults to ``sys.stdout``
+    :type stream: ``file``
+
+    :returns: The result of the command for ``search``, ``install`` and ``list``, otherwise ``None``
+    """
+    from xmm.exceptions import HashMismatchError
+    from xmm.exceptions import LockTimeoutError
+    from xmm.exceptions import PackageMetadataWarning
+    from xmm.exceptions import PackageNotTrackedWarning
+    from xmm.exceptions import PackageLookupError
+    from xmm.exceptions import RepositoryLookupError
+    from xmm.util import cprint
+    from xmm.util import zcolors
+
+    result = None
+
     # Sort out defaults
     if 'long' in args and args.long:
         detail = 'long'
@@ -92,48 +131,79 @@ def main():
     if args.command == 'search':
 
         try:
-            server.repositories.search_all(bsp_name=args.string, gametype=args.gametype, author=args.author,
-                                           title=args.title, pk3_name=args.pk3, shasum=args.shasum, detail=detail,
-                                           highlight=highlight)
+            with get_renderer(args, detail=detail, highlight=highlight, stream=stream) as renderer:
+                result = server.repositories.search_all(bsp_name=args.string, gametype=args.gametype, author=args.author,
+                                                        title=args.title, pk3_name=args.pk3, shasum=args.shasum, renderer=renderer)
         except Exception:
-            cprint('Failed.', style='FAIL')
+            cprint('Failed.', style='FAIL', file=stream)
 
     elif args.command == 'install':
 
-        if not args.pk3:
-            cprint("package name not specified", style='FAIL')
+        pk3s = list(args.pk3)
+
+        if args.from_file:
+            try:
+                pk3s.extend(read_maplist(args.from_file))
+            except EnvironmentError as e:
+                cprint("unable to read {}: {}".format(args.from_file, e), style='FAIL', file=stream)
+                raise SystemExit
+
+        if not pk3s:
+            cprint("package name not specified", style='FAIL', file=stream)
             raise SystemExit
 
-        cprint("Installing map: {}".format(args.pk3), style='BOLD')
+        if len(pk3s) > 1 or args.from_file or not getattr(args, 'interactive', True):
+
+            cprint("Installing {} maps".format(len(pk3s)), style='BOLD', file=stream)
+
+            try:
+                result = server.library.install_maps(pk3_names=pk3s, repository_name=args.repository, max_workers=args.jobs, stream=stream)
+                print_install_results(result, stream=stream)
+            except NotADirectoryError as e:
+                cprint("package directory does not exist: {}".format(e), style='FAIL', file=stream)
+            except RepositoryLookupError:
+                cprint("Repository does not exist!", style='FAIL', file=stream)
+            except LockTimeoutError as e:
+                cprint("timed out waiting for another xmm process to release {}".format(e), style='FAIL', file=stream)
+
+            return result
+
+        cprint("Installing map: {}".format(pk3s[0]), style='BOLD', file=stream)
 
         try:
-            server.library.install_map(pk3_name=args.pk3, repository_name=args.repository)
+            server.library.install_map(pk3_name=pk3s[0], repository_name=args.repository)
         except SystemExit:
-            cprint("Canceled.", style='INFO')
+            cprint("Canceled.", style='INFO', file=stream)
         except NotADirectoryError as e:
-            cprint("package directory does not exist: {}".format(e), style='FAIL')
+            cprint("package directory does not exist: {}".format(e), style='FAIL', file=stream)
         except PackageMetadataWarning:
-            cprint("package does not exist in the repository it won't be tracked (xmm list).", style='WARNING')
+            cprint("package does not exist in the repository it won't be tracked (xmm list).", style='WARNING', file=stream)
         except RepositoryLookupError:
-            cprint("Repository does not exist!", style='FAIL')
+            cprint("Repository does not exist!", style='FAIL', file=stream)
         except PackageLookupError:
-            cprint("package does not exist in the repository. cannot install.", style='FAIL')
+            cprint("package does not exist in the repository. cannot install.", style='FAIL', file=stream)
+        except HashMismatchError:
+            cprint("\npackage does not match the repository's hash, it was not installed.", style='FAIL', file=stream)
+        except LockTimeoutError as e:
+            cprint("timed out waiting for another xmm process to release {}".format(e), style='FAIL', file=stream)
 
     elif args.command == 'remove':
 
         if not args.pk3:
-            cprint("package name not specified", style='FAIL')
+            cprint("package name not specified", style='FAIL', file=stream)
             raise SystemExit
 
-        cprint("Removing package: {}".format(args.pk3), style='BOLD')
+        cprint("Removing package: {}".format(args.pk3), style='BOLD', file=stream)
 
         try:
             server.library.remove_map(pk3_name=args.pk3)
-            cprint("Done.", style='INFO')
+            cprint("Done.", style='INFO', file=stream)
         except FileNotFoundError:
-            cprint("package does not exist or is not tracked. try removing using full path if not tracked.", style='FAIL')
+            cprint("package does not exist or is not tracked. try removing using full path if not tracked.", style='FAIL', file=stream)
         except NotADirectoryError as e:
-            cprint("package directory does not exist: {}".format(e), style='FAIL')
+            cprint("package directory does not exist: {}".format(e), style='FAIL', file=stream)
+        except LockTimeoutError as e:
+            cprint("timed out waiting for another xmm process to release {}".format(e), style='FAIL', file=stream)
 
     elif args.command == 'discover':
 
@@ -141,44 +211,59 @@ def main():
 
         if args.repository:
             repository_name = args.repository
-            cprint("Using repo '{}'".format(args.repository), style='HEADER')
+            cprint("Using repo '{}'".format(args.repository), style='HEADER', file=stream)
             try:
                 repo = server.repositories.get_repository(repository_name)
             except RepositoryLookupError:
-                cprint("Repository doesn't exist in sources.json", style="FAIL")
+                cprint("Repository doesn't exist in sources.json", style="FAIL", file=stream)
                 raise SystemExit
 
+        # without a stream every package is printed as soon as it is found
+        renderer = get_renderer(args, detail=detail, stream=stream) if stream else None
+
         try:
-            server.library.discover_maps(add=args.add, repository_name=repository_name, detail=detail)
+            server.library.discover_maps(add=args.add, repository_name=repository_name, detail=detail, rehash=args.rehash, max_workers=args.jobs,
+                                         renderer=renderer)
         except NotADirectoryError as e:
-            cprint("package directory does not exist: {}".format(e), style='FAIL')
+            cprint("package directory does not exist: {}".format(e), style='FAIL', file=stream)
+        except LockTimeoutError as e:
+            cprint("timed out waiting for another xmm process to release {}".format(e), style='FAIL', file=stream)
+        finally:
+            if renderer:
+                renderer.close()
 
     elif args.command == 'list':
 
         try:
-            total = server.library.list_installed(detail=detail)
-            print("\n{}Total packages found:{} {}{}{}".format(zcolors.INFO, zcolors.ENDC, zcolors.BOLD, str(total), zcolors.ENDC))
+            with get_renderer(args, detail=detail, stream=stream) as renderer:
+                total = result = server.library.list_installed(renderer=renderer)
+                renderer.line()
+                renderer.total(total)
         except Exception:
-            cprint("Failed.", style='FAIL')
+            cprint("Failed.", style='FAIL', file=stream)
 
     elif args.command == 'show':
 
         if not args.pk3:
-            cprint("package name not specified", style='FAIL')
+            cprint("package name not specified", style='FAIL', file=stream)
             raise SystemExit
 
         if not detail:
             detail = 'long'
 
+        renderer = get_renderer(args, detail=detail, highlight=highlight, stream=stream)
+
         # Use local package store for lookup
         if args.local:
 
             try:
-                server.library.show_map(pk3_name=args.pk3, detail=detail, highlight=highlight)
+                server.library.show_map(pk3_name=args.pk3, rehash=args.rehash, renderer=renderer)
             except HashMismatchError:
-                print("\n{}{}{} {}hash different from repositories{}".format(zcolors.BOLD, args.pk3, zcolors.ENDC, zcolors.WARNING, zcolors.ENDC))
+                renderer.flush()
+                print("\n{}{}{} {}hash different from repositories{}".format(zcolors.BOLD, args.pk3, zcolors.ENDC, zcolors.WARNING, zcolors.ENDC), file=stream)
             except PackageNotTrackedWarning:
-                print("\n{}{}{} {}package not currently tracked{}".format(zcolors.BOLD, args.pk3, zcolors.ENDC, zcolors.WARNING, zcolors.ENDC))
+                renderer.flush()
+                print("\n{}{}{} {}package not currently tracked{}".format(zcolors.BOLD, args.pk3, zcolors.ENDC, zcolors.WARNING, zcolors.ENDC), file=stream)
 
         # Use repositories for lookup
         else:
@@ -188,50 +273,55 @@ def main():
                 try:
                     repo = server.repositories.get_repository(args.repository)
                 except RepositoryLookupError:
-                    cprint("Repository doesn't exist in sources.json", style="FAIL")
+                    cprint("Repository doesn't exist in sources.json", style="FAIL", file=stream)
                     raise SystemExit
 
-                repo.show_map(pk3_name=args.pk3, detail=detail, highlight=highlight)
+                repo.show_map(pk3_name=args.pk3, renderer=renderer)
 
             else:
 
                 try:
                     for repo in server.repositories.sources:
-                        cprint("Using repo '{}'".format(repo.name), style='HEADER')
-                        map_found = repo.show_map(pk3_name=args.pk3, detail=detail, highlight=highlight)
+                        renderer.line("Using repo '{}'".format(repo.name), style='HEADER')
+                        map_found = repo.show_map(pk3_name=args.pk3, renderer=renderer)
                         if map_found:
                             break
                 except PackageLookupError:
-                    cprint("Map was not found in repository", style="FAIL")
+                    renderer.flush()
+                    cprint("Map was not found in repository", style="FAIL", file=stream)
+
+        renderer.close()
 
     elif args.command == 'export':
 
         repository_name = None
 
         if args.server and args.repository:
-            cprint("'-R' and '-S' flags are mutually exclusive on this command.", style="FAIL")
+            cprint("'-R' and '-S' flags are mutually exclusive on this command.", style="FAIL", file=stream)
             raise SystemExit
 
         if args.repository:
-            cprint("Using repo '{}'".format(args.repository), style='HEADER')
+            # keep stdout clean for the export itself
+            if args.filename != '-':
+                cprint("Using repo '{}'".format(args.repository), style='HEADER', file=stream)
             repository_name = args.repository
 
-        if args.format == 'json':
+        if args.format in ('json', 'ndjson', 'csv'):
 
             if args.subcommand == 'local':
 
-                server.library.export_map_packages(filename=args.filename)
+                server.library.export_map_packages(filename=args.filename, format=args.format)
 
             elif args.subcommand == 'repos':
 
                 if repository_name:
                     try:
-                        server.library.repositories.get_repository(repository_name).export_packages(filename=args.filename)
+                        server.library.repositories.get_repository(repository_name).export_packages(filename=args.filename, format=args.format)
                     except RepositoryLookupError:
-                        cprint("Repository doesn't exist in sources.json", style="FAIL")
+                        cprint("Repository doesn't exist in sources.json", style="FAIL", file=stream)
                         raise SystemExit
                 else:
-                    server.library.repositories.export_all_packages(filename=args.filename)
+                    server.library.repositories.export_all_packages(filename=args.filename, format=args.format)
 
         if args.format == 'maplist':
 
@@ -242,7 +332,7 @@ def main():
             elif args.subcommand == 'repos':
 
                 # TODO: implement
-                print('sorry exporting bsp names from repos is not supported yet')
+                print('sorry exporting bsp names from repos is not supported yet', file=stream)
                 exit(0)
 
         elif args.format == 'shasums':
@@ -253,7 +343,7 @@ def main():
                     server.library.export_hash_index(filename=args.filename)
                 else:
                     # TODO: limit export by repository name
-                    cprint('this combination is not yet possible')
+                    cprint('this combination is not yet possible', file=stream)
 
             elif args.subcommand == 'repos':
 
@@ -261,13 +351,15 @@ def main():
                     try:
                         server.library.repositories.get_repository(repository_name).export_hash_index(filename=args.filename)
                     except RepositoryLookupError:
-                        cprint("Repository doesn't exist in sources.json", style="FAIL")
+                        cprint("Repository doesn't exist in sources.json", style="FAIL", file=stream)
                         raise SystemExit
                 else:
                     server.library.repositories.export_all_hash_index(filename=args.filename)
 
     elif args.command == 'servers':
 
+        from xmm.server import ServerCollection
+
         servers = ServerCollection(servers=[])
 
         if args.subcommand == 'list':
@@ -280,30 +372,280 @@ def main():
 
     elif args.command == 'update':
 
-        try:
-            server.repositories.update_all()
-        except RepositoryUpdateError:
-            cprint('One or more repositories have failed to update.', style='FAIL')
+        results = server.repositories.update_all()
+
+        print('---', file=stream)
+        for result in results:
+            style = {'updated': 'SUCCESS', 'unchanged': 'INFO', 'failed': 'FAIL'}[result['status']]
+            print("{}{}{}: {}{}{} ({:.2f}s)".format(zcolors.BOLD, result['name'], zcolors.ENDC,
+                                                    getattr(zcolors, style), result['status'], zcolors.ENDC, result['elapsed']), file=stream)
+
+        if any(result['status'] == 'failed' for result in results):
+            cprint('One or more repositories have failed to update.', style='FAIL', file=stream)
 
     # Plugins
     for cmd, value in plugins.items():
         if args.command == cmd:
-            plugins[cmd].run()
+            load_plugin(plugins[cmd]).run()
             break
 
+    return result
+
+
+def run_daemon(args):
+    """
+    Starts, stops or checks on the daemon
+
+    :param args:
+        Parsed arguments of the ``daemon`` subcommand
+    :type args: ``argparse.Namespace``
+    """
+    from xmm import daemon
+    from xmm.util import cprint
+    from xmm.util import zcolors
+
+    socket_file = args.socket or conf['default']['daemon_socket']
+
+    if args.subcommand == 'start':
+        cprint("Listening on {}".format(socket_file), style='INFO')
+        try:
+            daemon.Daemon(socket_file=socket_file).serve_forever()
+        except OSError as e:
+            cprint(str(e), style='FAIL')
+        except KeyboardInterrupt:
+            pass
+
+    elif args.subcommand == 'stop':
+        try:
+            daemon.request({'command': 'stop'}, socket_file, timeout=5)
+            cprint("Stopped.", style='INFO')
+        except OSError:
+            cprint("xmm daemon is not running", style='WARNING')
+
+    elif args.subcommand == 'status':
+        try:
+            status = daemon.request({'command': 'ping'}, socket_file, timeout=5)['result']
+            print("{}running{} pid {}, up {:.0f}s, servers: {}".format(zcolors.SUCCESS, zcolors.ENDC, status['pid'], status['uptime'],
+                                                                       ', '.join(status['servers']) or '-'))
+        except OSError:
+            cprint("xmm daemon is not running", style='WARNING')
+
+
+def get_renderer(args, detail=None, highlight=False, stream=None):
+    """
+    Creates the *Renderer* for ``search``, ``list`` and ``show`` from ``--output``, ``--limit`` and ``--offset``
+
+    :param args:
+        Parsed arguments, ``args.tty`` is set by clients of the daemon
+    :type args: ``argparse.Namespace``
+
+    :param detail:
+        How much detail to show, [short, None, long]
+    :type detail: ``str``
+
+    :param highlight:
+        Whether to highlight the search string
+    :type highlight: ``bool``
+
+    :param stream:
+        Where to write, defaults to ``sys.stdout``
+    :type stream: ``file``
+
+    :returns: ``Renderer``
+    """
+    from xmm.renderers import Renderer
+
+    return Renderer(output=getattr(args, 'output', 'table'), stream=stream, color=getattr(args, 'tty', None), detail=detail,
+                    highlight=highlight, limit=getattr(args, 'limit', None), offset=getattr(args, 'offset', 0))
+
+
+def forward_to_daemon(args):
+    """
+    Runs a command in the daemon if one is listening on ``daemon_socket``
+
+    :param args:
+        Parsed arguments
+    :type args: ``argparse.Namespace``
+
+    :returns: ``bool`` whether the daemon handled the command
+
+    :raises SystemExit: with status 1 if the command failed in the daemon
+    """
+    socket_file = conf['default']['daemon_socket']
+
+    if not os.path.exists(socket_file):
+        return False
+
+    from xmm import daemon
+    from xmm.util import cprint
+
+    if args.command not in daemon.Daemon.commands:
+        return False
+
+    message_args = dict(vars(args))
+
+    # the daemon writes into a buffer, it has to know whether to format for a terminal
+    message_args['tty'] = sys.stdout.isatty()
+
+    # the daemon has another working directory, read the maplist here
+    if message_args.get('from_file'):
+        try:
+            message_args['pk3'] = list(message_args['pk3']) + read_maplist(message_args['from_file'])
+        except EnvironmentError:
+            return False
+        message_args['from_file'] = None
+
+    try:
+        response = daemon.request({'command': args.command, 'args': message_args}, socket_file)
+    except (OSError, ValueError) as e:
+        cli_logger.debug("Not using daemon: {}".format(e))
+        return False
+
+    if response.get('fallback'):
+        return False
+
+    print(response.get('output', ''), end='')
+
+    if not response.get('ok'):
+        cprint("xmm daemon failed: {}".format(response.get('error')), style='FAIL')
+        raise SystemExit(1)
+
+    return True
+
+
+def read_maplist(filename):
+    """
+    Reads pk3 names from a file, one per line, ignoring blank lines and ``#`` comments
+
+    :param filename:
+        filename with path of the maplist
+    :type filename: ``str``
+
+    :returns: ``list``
+    """
+    pk3s = []
+
+    with open(os.path.expanduser(filename)) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                pk3s.append(line)
+
+    return pk3s
+
+
+def print_install_results(results, stream=None):
+    """
+    Prints a table of the results of ``Library.install_maps``
+
+    :param results:
+        Results from ``Library.install_maps``
+    :type results: ``list``
+
+    :param stream:
+        Where to print, defaults to ``sys.stdout``
+    :type stream: ``file``
+    """
+    from xmm.util import zcolors
+    from xmm import util
+
+    styles = {
+        'installed': 'SUCCESS',
+        'untracked': 'WARNING',
+        'skipped': 'INFO',
+        'not_found': 'FAIL',
+        'hash_mismatch': 'FAIL',
+        'failed': 'FAIL',
+    }
+
+    width = max([len(r['pk3']) for r in results] + [3])
+
+    print('---', file=stream)
+    print('{}{:<{width}}  {:<13} {:<12} {}{}'.format(zcolors.BOLD, 'pk3', 'status', 'repository', 'size', zcolors.ENDC, width=width), file=stream)
+    for r in results:
+        print('{:<{width}}  {}{:<13}{} {:<12} {}'.format(r['pk3'], getattr(zcolors, styles[r['status']]), r['status'], zcolors.ENDC,
+                                                         r['repository'] or '-', util.convert_size(r['size']) if r['size'] else '-', width=width), file=stream)
+
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+
+    print('---', file=stream)
+    print(', '.join('{}: {}'.format(status, counts[status]) for status in styles if status in counts), file=stream)
+
+
+def load_plugin(plugin):
+    """
+    Imports a plugin, giving it the configuration first
+
+    :param plugin:
+        A plugin from ``pluginloader.get_plugins()``
+    :type plugin: ``dict``
+
+    :returns: ``module``
+    """
+    pluginbase.set_config(conf)
+
+    return pluginloader.load_plugin(plugin)
+
+
+def add_plugin_arguments(subparsers, names):
+    """
+    Adds the arguments of plugins to their subcommands, from the plugin manifest
+
+    :param subparsers:
+        The subcommands of the xmm parser
+    :type subparsers: ``argparse._SubParsersAction``
+
+    :param names:
+        Names of the plugins
+    :type names: ``list``
+    """
+    # a stale manifest imports every plugin, they read the configuration on import
+    pluginbase.set_config(conf)
+    manifest = {plugin['name']: plugin for plugin in pluginloader.get_manifest()}
+
+    for name in names:
+        cli_logger.debug("Loading plugin: " + name)
+        plugin = plugins[name] = manifest[name]
+        p = plugin['args'] or load_plugin(plugin).get_args()
+
+        parser_plugin = subparsers.choices[name]
+        parser_plugin.description = p[1].get('help')
+        parser_plugin.add_argument(*p[2], **p[3])
+
+
+class PluginSubParsersAction(argparse._SubParsersAction):
+    """
+    Subcommands which only add the arguments of a plugin once it is chosen, so the plugin manifest is not read
+    to answer ``--help`` or ``--version``
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values[0] in plugins and 'args' not in plugins[values[0]]:
+            add_plugin_arguments(self, [values[0]])
+
+        super().__call__(parser, namespace, values, option_string)
+
 
-def parse_args():
+def parse_args(argv=None):
+    """
+    Parses the command line
 
-    global plugins
+    :param argv:
+        Arguments to parse, defaults to ``sys.argv[1:]``
+    :type argv: ``list``
 
+    :returns: ``argparse.Namespace``
+    """
     parser = argparse.ArgumentParser(description='Xonotic Map Manager is a tool to help manage Xonotic maps')
 
     parser.add_argument('--version', action='version', version='%(prog)s {0}'.format(__version__))
     parser.add_argument("-S", '--server', nargs='?', help="target server as defined in servers.json", type=str)
     parser.add_argument("-T", '--target', nargs='?', help="target directory", type=str)
     parser.add_argument("-R", '--repository', nargs='?', help="repository to use (defaults to all available)", type=str, default=None)
+    parser.add_argument('--no-daemon', help="run the command here even if an xmm daemon is running", action='store_true')
 
-    subparsers = parser.add_subparsers(dest='command')
+    subparsers = parser.add_subparsers(dest='command', action=PluginSubParsersAction)
     subparsers.required = True
 
     parser_search = subparsers.add_parser('search', help='search for maps based on bsp names')
@@ -316,9 +658,14 @@ def parse_args():
     parser_search.add_argument('--long', '-l', help='show long format', action='store_true')
     parser_search.add_argument('--short', '-s', help='show short format', action='store_true')
     parser_search.add_argument('--color', '-c', help='highlight search term in results', action='store_true')
+    parser_search.add_argument('--output', '-o', choices=['table', 'json', 'ndjson'], help='output format (default: table)', default='table')
+    parser_search.add_argument('--limit', help='show at most this many packages', type=int)
+    parser_search.add_argument('--offset', help='skip this many packages first', type=int, default=0)
 
     parser_install = subparsers.add_parser('install', help='install a map from the repository, or specify a URL.')
-    parser_install.add_argument('pk3', nargs='?', help='use a pk3 name of map package, or specify a URL of a pk3.', type=str)
+    parser_install.add_argument('pk3', nargs='*', help='use a pk3 name of map package, or specify a URL of a pk3.', type=str)
+    parser_install.add_argument('--from-file', '-f', help='install every pk3 listed in a file, one per line', type=str)
+    parser_install.add_argument('--jobs', '-j', help='how many maps to download at once (default: 4)', type=int, default=4)
 
     parser_remove = subparsers.add_parser('remove', help='remove based on pk3 name')
     parser_remove.add_argument('pk3', nargs='?', help='pk3', type=str)
@@ -327,21 +674,30 @@ def parse_args():
     parser_discover.add_argument('--long', '-l', help='show long format', action='store_true')
     parser_discover.add_argument('--short', '-s', help='show short format', action='store_true')
     parser_discover.add_argument('--add', '-a', help='add discovered files to the db', action='store_true')
+    parser_discover.add_argument('--jobs', '-j', help='how many files to hash at once (default: number of CPUs)', type=int)
+    parser_discover.add_argument('--rehash', help='hash every file again instead of using the hash cache', action='store_true')
 
     parser_list = subparsers.add_parser('list', help='list locally installed packages')
     parser_list.add_argument('--long', '-l', help='show long format', action='store_true')
     parser_list.add_argument('--short', '-s', help='show short format', action='store_true')
+    parser_list.add_argument('--output', '-o', choices=['table', 'json', 'ndjson'], help='output format (default: table)', default='table')
+    parser_list.add_argument('--limit', help='show at most this many packages', type=int)
+    parser_list.add_argument('--offset', help='skip this many packages first', type=int, default=0)
 
     parser_show = subparsers.add_parser('show', help='show details of remote or locally installed packages')
     parser_show.add_argument('pk3', nargs='?', help='pk3 to show details for', type=str)
     parser_show.add_argument('--local', '-L', help='whether to show from local packages only or all repos', action='store_true')
     parser_show.add_argument('--long', '-l', help='show long format', action='store_true')
     parser_show.add_argument('--short', '-s', help='show short format', action='store_true')
+    parser_show.add_argument('--rehash', help='hash the local file again instead of using the hash cache', action='store_true')
+    parser_show.add_argument('--output', '-o', choices=['table', 'json', 'ndjson'], help='output format (default: table)', default='table')
+    parser_show.add_argument('--limit', help='show at most this many packages', type=int)
+    parser_show.add_argument('--offset', help='skip this many packages first', type=int, default=0)
 
     parser_export = subparsers.add_parser('export', help='export locally managed packages to a file')
     parser_export.add_argument('subcommand', choices=['local', 'repos'], help='what context to export?', default='local', type=str)
-    parser_export.add_argument('filename', nargs='?', help='filename to export to', type=str)
-    parser_export.add_argument('--format', '-f', choices=['json', 'shasums', 'maplist'], default='json')
+    parser_export.add_argument('filename', nargs='?', help='filename to export to, - for stdout', type=str)
+    parser_export.add_argument('--format', '-f', choices=['json', 'ndjson', 'csv', 'shasums', 'maplist'], default='json')
 
     parser_servers = subparsers.add_parser('servers', help='subcommands on servers described in servers.json')
     parser_servers.add_argument('subcommand', choices=['list'], help='list all servers in servers.json', type=str)
@@ -351,22 +707,23 @@ def parse_args():
 
     parser_update = subparsers.add_parser('update', help='update sources json')
 
-    # Handle plugins
-    for i in pluginloader.get_plugins():
-        cli_logger.debug("Loading plugin: " + i["name"])
-        command = i['name']
-        plugin = pluginloader.load_plugin(i)
-        plugin_args = [plugin.get_args()]
-        plugins[command] = plugin
+    parser_daemon = subparsers.add_parser('daemon', help='keep xmm loaded in the background to answer commands faster')
+    parser_daemon.add_argument('subcommand', choices=['start', 'stop', 'status'], help='start runs in the foreground', type=str)
+    parser_daemon.add_argument('--socket', help='unix socket to use (default: daemon_socket in ~/.xmm.ini)', type=str)
 
-        # Import args from plugins
-        for p in plugin_args:
-            parser_plugin = subparsers.add_parser(p[0], **p[1])
-            parser_plugin.add_argument(*p[2], **p[3])
+    # Handle plugins, their arguments are read from the manifest once the subcommand is chosen
+    plugins.clear()
+    for plugin in pluginloader.get_plugins():
+        plugins[plugin['name']] = plugin
+        subparsers.add_parser(plugin['name'], help='plugin, see xmm {} -h'.format(plugin['name']))
 
-    argcomplete.autocomplete(parser)
+    # Completion exits here, before any command module is imported
+    if '_ARGCOMPLETE' in os.environ:
+        import argcomplete
+        add_plugin_arguments(subparsers, list(plugins))
+        argcomplete.autocomplete(parser)
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
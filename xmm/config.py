@@ -1,59 +1,173 @@
-import xmm.util as util
-import json
-import logging.config
+import collections.abc
 import os
+import threading
 
 config_file = '.xmm.ini'
 logging_config_file = 'xmm.logging.ini'
 config_file_with_path = os.path.expanduser(os.path.join('~', config_file))
 logging_config_file_with_path = os.path.expanduser(os.path.join('~/.xmm/', logging_config_file))
 
-util.check_if_not_create(config_file_with_path, 'config/xmm.ini')
-util.check_if_not_create(logging_config_file_with_path, 'config/xmm.logging.ini')
-
-config = util.parse_config(config_file_with_path)
-
-conf = {
-    'default': {
-        'library': os.path.expanduser('~/.xmm/library.json'),
-        'target_dir': os.path.expanduser(config['target_dir']),
-        'download_url': os.path.expanduser(config['download_url']),
-        'api_data_file': os.path.expanduser(config['api_data_file']),
-        'api_data_url': os.path.expanduser(config['api_data_url']),
-        'api_data_file_seed': os.path.expanduser('~/.xmm/maps.json.zip'),
-        'use_curl': False,
-    },
-    'sources_config': os.path.expanduser(config['sources_config']),
-    'servers_config': os.path.expanduser(config['servers_config']),
-    'sources': {},
-    'servers': {},
-}
-
-# Overcome ini pitfalls
-if config['use_curl'].lower() == 'true':
-    conf['default']['use_curl'] = True
-
-util.check_if_not_create(conf['sources_config'], 'config/example.sources.json')
-util.check_if_not_create(conf['servers_config'], 'config/example.servers.json')
-
-# If maplist doesn't exist copy seed zip over
-util.check_if_not_create(conf['default']['api_data_file_seed'], 'resources/data/maps.json.zip')
-
-# Load JSON files are dicts
-with open(conf['sources_config']) as f:
-    data = f.read()
-    sources = json.loads(data)
-    conf['sources'] = sources
-
-with open(conf['servers_config']) as f:
-    data = f.read()
-    servers = json.loads(data)
-    conf['servers'] = servers
-
-# Make sure needed dirs exist
-for server in conf['servers']:
-    os.makedirs(os.path.expanduser(conf['servers'][server]['target_dir']), exist_ok=True)
-
-logging.config.fileConfig(logging_config_file_with_path, defaults={
-    'log_filename': os.path.expanduser('~/.xmm/xmm.log')
-})
+_init_lock = threading.RLock()
+_initialized = False
+
+
+def init(setup_logging=True):
+    """
+    Prepares the filesystem for xmm, creating ``~/.xmm.ini``, ``~/.xmm/xmm.logging.ini``, ``sources.json``,
+    ``servers.json`` and the seed map list from their templates when missing, and the ``target_dir`` of every server.
+    Only the first call does anything.
+
+    The CLI calls this before running a command, API users get it on the first access to ``conf``.
+
+    :param setup_logging:
+        Also configure logging from ``~/.xmm/xmm.logging.ini``
+    :type setup_logging: ``bool``
+
+    >>> from xmm import config
+    >>> config.init()
+    """
+    global _initialized
+
+    with _init_lock:
+        if _initialized:
+            return
+
+        import xmm.util as util
+
+        util.check_if_not_create(config_file_with_path, 'config/xmm.ini')
+        util.check_if_not_create(logging_config_file_with_path, 'config/xmm.logging.ini')
+
+        settings = _read_settings()
+
+        util.check_if_not_create(settings['sources_config'], 'config/example.sources.json')
+        util.check_if_not_create(settings['servers_config'], 'config/example.servers.json')
+
+        # If maplist doesn't exist copy seed zip over, it is read from the archive and never extracted.
+        # Templates are only found relative to the working directory, the copy keeps the seed usable from anywhere
+        util.check_if_not_create(settings['default']['api_data_file_seed'], 'resources/data/maps.json.zip')
+
+        # Make sure needed dirs exist
+        servers = _read_json(settings['servers_config'])
+        for server in servers:
+            os.makedirs(os.path.expanduser(servers[server]['target_dir']), exist_ok=True)
+
+        if setup_logging:
+            import logging.config
+
+            logging.config.fileConfig(logging_config_file_with_path, defaults={
+                'log_filename': os.path.expanduser('~/.xmm/xmm.log')
+            }, disable_existing_loggers=False)
+
+        _initialized = True
+
+
+def _read_settings():
+    import xmm.util as util
+
+    config = util.parse_config(config_file_with_path)
+
+    settings = {
+        'default': {
+            'library': os.path.expanduser('~/.xmm/library.json'),
+            'target_dir': os.path.expanduser(config['target_dir']),
+            'download_url': os.path.expanduser(config['download_url']),
+            'api_data_file': os.path.expanduser(config['api_data_file']),
+            'api_data_url': os.path.expanduser(config['api_data_url']),
+            'api_data_file_seed': os.path.expanduser('~/.xmm/maps.json.zip'),
+            'use_curl': False,
+            'store_backend': config.get('store_backend', 'auto'),
+            'lock_timeout': float(config.get('lock_timeout', '60')),
+            'download_lock_timeout': float(config.get('download_lock_timeout', '-1')),
+            'daemon_socket': os.path.expanduser(config.get('daemon_socket', '~/.xmm/xmm.sock')),
+        },
+        'sources_config': os.path.expanduser(config['sources_config']),
+        'servers_config': os.path.expanduser(config['servers_config']),
+        'sources': {},
+        'servers': {},
+    }
+
+    # Overcome ini pitfalls
+    if config['use_curl'].lower() == 'true':
+        settings['default']['use_curl'] = True
+
+    return settings
+
+
+def _read_json(filename):
+    import json
+
+    with open(filename) as f:
+        return json.loads(f.read())
+
+
+class Config(collections.abc.MutableMapping):
+    """
+    The configuration of xmm, built from ``~/.xmm.ini``, ``sources.json`` and ``servers.json`` the first time a
+    field is accessed. Importing xmm does not read or create any file.
+
+    :returns object: ``Config``
+
+    >>> from xmm.config import conf
+    >>> conf['default']['target_dir']
+    '/home/xonotic/.xonotic/data/maps'
+    """
+    def __init__(self):
+        self.data = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return repr(self.data) if self.loaded else '<Config not loaded>'
+
+    @property
+    def loaded(self):
+        """
+        :returns: ``bool`` whether the configuration has been read
+        """
+        return self.data is not None
+
+    def load(self):
+        """
+        Runs ``init()`` and reads the configuration, unless it was already read
+
+        :returns: ``dict``
+        """
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    init()
+
+                    settings = _read_settings()
+                    settings['sources'] = _read_json(settings['sources_config'])
+                    settings['servers'] = _read_json(settings['servers_config'])
+
+                    self.data = settings
+
+        return self.data
+
+    def reload(self):
+        """
+        Reads the configuration again
+
+        :returns: ``dict``
+        """
+        with self._lock:
+            self.data = None
+            return self.load()
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+conf = Config()
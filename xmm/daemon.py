@@ -0,0 +1,231 @@
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from xmm.base import Base
+from xmm.exceptions import ServerLookupError
+from xmm import util
+
+
+class ResultEncoder(util.ObjectEncoder):
+    """
+    *ObjectEncoder* that falls back to ``str()`` for anything else, such as exceptions in install results
+    """
+    def default(self, obj):
+        try:
+            return super().default(obj)
+        except TypeError:
+            return str(obj)
+
+
+class Daemon(Base):
+    """
+    A *Daemon* keeps *LocalServer* objects, their repositories, indexes and stores in memory and runs
+    CLI commands for clients connecting to a Unix socket
+
+    The protocol is one **JSON** object per line in each direction. A request names a command and
+    carries the parsed CLI arguments, the response holds what the command printed and its result:
+
+    .. code-block:: json
+
+        {"command": "search", "args": {"string": "dance", "server": null, ...}}
+        {"ok": true, "output": "...", "result": [...], "error": null}
+
+    ``ping`` returns the pid, uptime and warm servers of the daemon, ``stop`` shuts it down.
+    Commands run one at a time, repositories and stores reload themselves when their files change.
+
+    :param socket_file:
+        Where to listen, defaults to ``daemon_socket`` in ``~/.xmm.ini``
+    :type socket_file: ``str``
+
+    :returns object: ``Daemon``
+
+    >>> from xmm.daemon import Daemon
+    >>> daemon = Daemon(socket_file='~/.xmm/xmm.sock')
+    >>> daemon.serve_forever()
+    """
+    commands = ('search', 'show', 'install', 'discover', 'list')
+
+    def __init__(self, socket_file=None):
+        super().__init__()
+        self.socket_file = os.path.expanduser(socket_file or self.conf['default']['daemon_socket'])
+        self.servers = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.start_time = time.time()
+
+    def __repr__(self):
+        return str(vars(self))
+
+    def get_server(self, server_name=None):
+        """
+        Returns the warm *LocalServer* for a server name, creating it on first use
+
+        :param server_name:
+            A server from ``servers.json``, ``None`` for the default server
+        :type server_name: ``str``
+
+        :returns: ``LocalServer``
+        """
+        from xmm.server import LocalServer
+
+        key = server_name or 'default'
+
+        if key not in self.servers:
+            self.logger.info('Loading server: {}'.format(key))
+            self.servers[key] = LocalServer(server_name=key)
+
+        return self.servers[key]
+
+    def handle(self, request):
+        """
+        Runs one request
+
+        :param request:
+            A decoded request
+        :type request: ``dict``
+
+        :returns: ``dict`` response
+        """
+        from xmm import cli
+
+        command = request.get('command')
+
+        if command == 'ping':
+            return {'ok': True, 'output': '', 'error': None, 'result': {
+                'pid': os.getpid(),
+                'uptime': time.time() - self.start_time,
+                'servers': sorted(self.servers),
+            }}
+
+        if command == 'stop':
+            threading.Thread(target=self.server.shutdown).start()
+            return {'ok': True, 'output': '', 'error': None, 'result': None}
+
+        if command not in self.commands:
+            return {'ok': False, 'output': '', 'error': 'unknown command: {}'.format(command), 'result': None}
+
+        args = argparse.Namespace(**request.get('args', {}))
+        args.command = command
+        args.interactive = False
+
+        output = io.StringIO()
+        result = None
+
+        with self.lock:
+            try:
+                server = self.get_server(getattr(args, 'server', None))
+            except (NotADirectoryError, ServerLookupError) as e:
+                # let the client handle these, it can prompt
+                return {'ok': False, 'output': '', 'error': repr(e), 'result': None, 'fallback': True}
+
+            try:
+                result = cli.run_command(args, server, stream=output)
+            except SystemExit:
+                pass
+            except Exception as e:
+                self.logger.exception('{} failed'.format(command))
+                return {'ok': False, 'output': output.getvalue(), 'error': repr(e), 'result': None}
+
+        return {'ok': True, 'output': output.getvalue(), 'error': None, 'result': result}
+
+    def serve_forever(self):
+        """
+        Listens on ``socket_file`` until stopped
+
+        :raises OSError: if another daemon is already listening
+        """
+        if os.path.exists(self.socket_file):
+            if is_running(self.socket_file):
+                raise OSError('xmm daemon already running on {}'.format(self.socket_file))
+            os.remove(self.socket_file)
+
+        os.makedirs(os.path.dirname(self.socket_file), exist_ok=True)
+
+        # the socket is only usable by this user from the moment it exists
+        umask = os.umask(0o077)
+        try:
+            self.server = _UnixServer(self.socket_file, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+        self.logger.info('Listening on {}'.format(self.socket_file))
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.daemon.handle(request)
+            except ValueError as e:
+                response = {'ok': False, 'output': '', 'error': 'invalid request: {}'.format(e), 'result': None}
+
+            self.wfile.write('{}\n'.format(json.dumps(response, cls=ResultEncoder)).encode('utf-8'))
+            self.wfile.flush()
+
+
+def request(message, socket_file, timeout=None):
+    """
+    Sends one request to a running *Daemon*
+
+    :param message:
+        The request, such as ``{'command': 'ping'}``
+    :type message: ``dict``
+
+    :param socket_file:
+        The socket of the daemon
+    :type socket_file: ``str``
+
+    :param timeout:
+        Seconds to wait for the response, ``None`` to wait forever
+    :type timeout: ``float``
+
+    :returns: ``dict`` response
+
+    :raises OSError: if no daemon is listening
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(os.path.expanduser(socket_file))
+        client.sendall('{}\n'.format(json.dumps(message)).encode('utf-8'))
+
+        with client.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError('xmm daemon closed the connection')
+
+    return json.loads(line.decode('utf-8'))
+
+
+def is_running(socket_file):
+    """
+    :param socket_file:
+        The socket of the daemon
+    :type socket_file: ``str``
+
+    :returns: ``bool`` whether a daemon answers on ``socket_file``
+    """
+    try:
+        return request({'command': 'ping'}, socket_file, timeout=1).get('ok', False)
+    except (OSError, ValueError):
+        return False
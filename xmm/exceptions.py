@@ -7,6 +7,12 @@ class HashMismatchError(ValueError):
     """
 
 
+class LockTimeoutError(TimeoutError):
+    """
+    Raise when a lock could not be acquired in time
+    """
+
+
 class PackageLookupError(LookupError):
     """
     Raise when Package does not exist in Repository
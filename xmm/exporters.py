@@ -0,0 +1,123 @@
+import csv
+import json
+import os
+import sys
+from contextlib import contextmanager
+
+
+formats = ('json', 'ndjson', 'csv', 'shasums', 'maplist')
+csv_fields = ('pk3', 'shasum', 'filesize', 'date', 'bsp')
+
+
+@contextmanager
+def open_output(filename):
+    """
+    Opens an export target for writing, ``-`` writes to stdout
+
+    :param filename:
+        The file to write to
+    :type filename: ``str``
+
+    :returns: text file object
+    """
+    if filename == '-':
+        try:
+            yield sys.stdout
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # the reader went away, e.g. ``| head``, send what is left to /dev/null
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+        return
+
+    # csv does its own line endings
+    with open(os.path.expanduser(filename), 'w', newline='') as f:
+        yield f
+
+
+def write_packages(packages, f, format='json'):
+    """
+    Writes *MapPackage* objects to ``f`` as they are produced, the output is never built in memory
+
+    ``json`` writes one array like ``xmm export`` always did, ``ndjson`` one package per line,
+    ``csv`` a header and one row per package with the bsp names separated by spaces, ``shasums``
+    ``<shasum> <pk3>`` lines and ``maplist`` the bsp names of every package. Every format ends with
+    a newline, no packages give an empty document such as ``[]`` or an empty file.
+
+    :param packages:
+        The packages to write, e.g. ``Repository.iter_packages()``
+    :type packages: ``iterable``
+
+    :param f:
+        A text file object
+    :type f: ``file``
+
+    :param format:
+        One of ``formats``
+    :type format: ``str``
+
+    :returns: ``int`` number of packages written
+
+    >>> from xmm.exporters import write_packages
+    >>> with open('maps.ndjson', 'w') as f:
+    >>>     write_packages(repository.iter_packages(), f, format='ndjson')
+    """
+    if format not in formats:
+        raise ValueError('Unknown export format: {}'.format(format))
+
+    count = 0
+
+    if format == 'json':
+        f.write('[')
+        for m in packages:
+            f.write('{}{}'.format(', ' if count else '', json.dumps(m.to_dict())))
+            count += 1
+        f.write(']\n')
+
+    elif format == 'ndjson':
+        for m in packages:
+            f.write('{}\n'.format(json.dumps(m.to_dict())))
+            count += 1
+
+    elif format == 'csv':
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(csv_fields)
+        for m in packages:
+            writer.writerow([m.pk3_file, m.shasum, m.filesize, m.date, ' '.join(sorted(m.bsp))])
+            count += 1
+
+    elif format == 'shasums':
+        for m in packages:
+            f.write('{} {}\n'.format(m.shasum, m.pk3_file))
+            count += 1
+
+    elif format == 'maplist':
+        for m in packages:
+            for bsp_name in sorted(m.bsp):
+                f.write('{}\n'.format(bsp_name))
+            count += 1
+
+    return count
+
+
+def export_packages(packages, filename, format='json'):
+    """
+    Writes *MapPackage* objects to a file or stdout, see ``write_packages``
+
+    :param packages:
+        The packages to write
+    :type packages: ``iterable``
+
+    :param filename:
+        The file to write to, ``-`` for stdout
+    :type filename: ``str``
+
+    :param format:
+        One of ``formats``
+    :type format: ``str``
+
+    :returns: ``int`` number of packages written
+    """
+    with open_output(filename) as f:
+        return write_packages(packages, f, format=format)
@@ -0,0 +1,158 @@
+import json
+import os
+
+from xmm.base import Base
+from xmm import util
+
+
+class HashCache(Base):
+    """
+    A *HashCache* remembers the SHA-1 of files in a *Library*'s map directory
+
+    Entries are keyed by the ``(device, inode, size, mtime_ns)`` signature of a file, so a file is only
+    hashed again after it has been replaced or modified. Renaming a file keeps its signature and its entry.
+
+    :param cache_file:
+        Where to persist the cache, ``None`` to only keep it in memory
+    :type cache_file: ``str``
+
+    :returns object: ``HashCache``
+
+    >>> from xmm.hashcache import HashCache
+    >>> cache = HashCache(cache_file='~/.xmm/library.hashes.json')
+    >>> cache.hash_file('~/.xonotic/data/maps/vinegar_v3.pk3')
+    >>> cache.save()
+    """
+    version = 1
+
+    def __init__(self, cache_file=None):
+        super().__init__()
+        self.cache_file = os.path.expanduser(cache_file) if cache_file else None
+        self.hashes = self._load()
+        self.dirty = False
+
+    def __repr__(self):
+        return str(vars(self))
+
+    def __json__(self):
+        return {
+            'cache_file': self.cache_file,
+        }
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def get_signature(filename):
+        """
+        :param filename:
+            Path to a file
+        :type filename: ``str``
+
+        :returns: ``str`` signature of the file built from its device, inode, size and modification time
+        """
+        stat = os.stat(filename)
+        return '{}:{}:{}:{}'.format(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, signature):
+        """
+        :param signature:
+            A signature from ``get_signature``
+        :type signature: ``str``
+
+        :returns: ``str`` cached shasum or ``None``
+        """
+        return self.hashes.get(signature)
+
+    def add(self, signature, shasum):
+        """
+        Remembers the shasum for a file signature
+
+        :param signature:
+            A signature from ``get_signature``
+        :type signature: ``str``
+
+        :param shasum:
+            The SHA-1 of the file
+        :type shasum: ``str``
+        """
+        if self.hashes.get(signature) != shasum:
+            self.hashes[signature] = shasum
+            self.dirty = True
+
+    def hash_file(self, filename, rehash=False):
+        """
+        Returns the SHA-1 of a file, only reading the file when its signature is not cached
+
+        :param filename:
+            Path to a file
+        :type filename: ``str``
+
+        :param rehash:
+            Ignore the cached shasum and read the file again
+        :type rehash: ``bool``
+
+        :returns: ``str``
+        """
+        signature = self.get_signature(filename)
+        shasum = None if rehash else self.get(signature)
+
+        if shasum is None:
+            self.logger.debug('Hashing {}'.format(filename))
+            shasum = util.hash_file(filename)
+            self.add(signature, shasum)
+
+        return shasum
+
+    def prune(self, signatures):
+        """
+        Drops every entry whose signature is not in ``signatures``
+
+        :param signatures:
+            Signatures of the files still present
+        :type signatures: ``set``
+        """
+        stale = [s for s in self.hashes if s not in signatures]
+        for signature in stale:
+            del self.hashes[signature]
+
+        if stale:
+            self.dirty = True
+
+    def save(self):
+        """
+        Writes the cache if it changed
+
+        :returns: False if fails
+        """
+        if not self.cache_file or not self.dirty:
+            return
+
+        tmp_file = '{}.tmp.{}'.format(self.cache_file, os.getpid())
+
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': self.version, 'hashes': self.hashes}, f)
+            os.replace(tmp_file, self.cache_file)
+            self.dirty = False
+        except EnvironmentError as e:
+            self.logger.warning('Unable to write hash cache {}: {}'.format(self.cache_file, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (EnvironmentError, ValueError) as e:
+            self.logger.warning('Unable to read hash cache {}: {}'.format(self.cache_file, e))
+            return {}
+
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return {}
+
+        return data.get('hashes') or {}
@@ -0,0 +1,426 @@
+import contextlib
+import io
+import os
+import pickle
+
+from xmm.base import Base
+from xmm.map import MapPackage
+from xmm import util
+
+
+class BinaryIndex(Base):
+    """
+    A *BinaryIndex* is a binary file derived from a **JSON** data file
+
+    The **JSON** data file remains the source of truth, the index is keyed by the size and
+    modification time of that file and is considered stale whenever they no longer match.
+
+    :param data_file:
+        The **JSON** data file this index is built from
+    :type data_file: ``str``
+
+    :param index_file:
+        Where to store the index, defaults to ``data_file`` with the ``suffix`` of the index
+    :type index_file: ``str``
+
+    :param seed_file:
+        A zip archive holding a copy of the data file as ``seed_member``, used while ``data_file`` does not exist
+    :type seed_file: ``str``
+
+    :returns object: ``BinaryIndex``
+    """
+    version = 1
+    suffix = '.idx'
+    seed_member = 'maps.json'
+
+    def __init__(self, data_file, index_file=None, seed_file=None):
+        super().__init__()
+        self.data_file = os.path.expanduser(data_file)
+        self.seed_file = os.path.expanduser(seed_file) if seed_file else None
+
+        if not index_file:
+            index_file = '{}{}'.format(self.data_file, self.suffix)
+
+        self.index_file = os.path.expanduser(index_file)
+        self._loaded = None
+
+    def __repr__(self):
+        return str(vars(self))
+
+    def __json__(self):
+        return {
+            'data_file': self.data_file,
+            'index_file': self.index_file,
+            'seed_file': self.seed_file,
+        }
+
+    def get_source_file(self):
+        """
+        :returns: ``str`` the data file, or the seed archive while the data file does not exist
+        """
+        if self.seed_file and not os.path.exists(self.data_file):
+            return self.seed_file
+
+        return self.data_file
+
+    def get_signature(self):
+        """
+        :returns: ``tuple`` of the source file size and modification time, or ``None`` if it does not exist
+        """
+        try:
+            stat = os.stat(self.get_source_file())
+        except FileNotFoundError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    @contextlib.contextmanager
+    def open_data(self):
+        """
+        Opens the data file for reading, the seed is read straight out of its archive without extracting it
+
+        :returns: text file object
+
+        >>> with index.open_data() as f:
+        >>>     packages = json.load(f)['data']
+        """
+        source_file = self.get_source_file()
+
+        if source_file != self.seed_file:
+            with open(source_file) as f:
+                yield f
+            return
+
+        import zipfile
+
+        self.logger.debug('Reading {} from {}'.format(self.seed_member, source_file))
+
+        with zipfile.ZipFile(source_file) as archive:
+            with archive.open(self.seed_member) as member:
+                yield io.TextIOWrapper(member, encoding='utf-8')
+
+    def is_stale(self):
+        """
+        Checks the header of the index against the current data file
+
+        :returns: ``bool``
+        """
+        return self._read(header_only=True) is None
+
+    def load(self):
+        """
+        Loads the contents of the index if it is current
+
+        The contents are kept in memory and only read again once the data file changes.
+
+        :returns: The indexed data or ``None`` if the index is missing or stale
+        """
+        signature = self.get_signature()
+
+        if self._loaded is not None and signature is not None and self._loaded[0] == signature:
+            return self._loaded[1]
+
+        payload = self._read()
+
+        if payload is not None:
+            self._loaded = (signature, payload)
+
+        return payload
+
+    def _write(self, payload, signature):
+        self.logger.debug('Building index: {}'.format(self.index_file))
+
+        header = {
+            'version': self.version,
+            'signature': signature,
+        }
+
+        # keep it in memory even if it can not be written, e.g. on a read-only image
+        self._loaded = (signature, payload)
+
+        tmp_file = '{}.tmp.{}'.format(self.index_file, os.getpid())
+
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.index_file)
+        except EnvironmentError as e:
+            self.logger.warning('Unable to write index {}: {}'.format(self.index_file, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _read(self, header_only=False):
+        signature = self.get_signature()
+
+        if signature is None or not os.path.exists(self.index_file):
+            return None
+
+        try:
+            with open(self.index_file, 'rb') as f:
+                header = pickle.load(f)
+
+                if header.get('version') != self.version or tuple(header.get('signature') or ()) != signature:
+                    self.logger.debug('Index is stale: {}'.format(self.index_file))
+                    return None
+
+                if header_only:
+                    return header
+
+                return pickle.load(f)
+
+        except (EnvironmentError, EOFError, pickle.UnpicklingError, AttributeError, ValueError) as e:
+            self.logger.warning('Unable to read index {}: {}'.format(self.index_file, e))
+            return None
+
+
+class PackageIndex(BinaryIndex):
+    """
+    A *PackageIndex* is a compact binary snapshot of a *Repository* data file
+
+    Each package is stored as a ``(pk3, shasum, date, filesize, bsp)`` record where ``bsp`` is
+    kept as **JSON** text packed by ``MapPackage.pack_bsp``, so loading the index does not have
+    to rebuild every nested bsp dict up front.
+
+    :param data_file:
+        The **JSON** data file this index is built from
+    :type data_file: ``str``
+
+    :param index_file:
+        Where to store the index, defaults to ``data_file`` with an ``.idx`` suffix
+    :type index_file: ``str``
+
+    :returns object: ``PackageIndex``
+
+    >>> from xmm.index import PackageIndex
+    >>> index = PackageIndex(data_file='~/.xmm/maps.json')
+    >>> records = index.get_records()
+    """
+    version = 2
+    suffix = '.idx'
+
+    def build(self, packages=None):
+        """
+        Writes a new index for the data file
+
+        :param packages:
+            Package dicts as found in the ``data`` list of the data file, parsed from the data file if not given
+        :type packages: ``list``
+
+        :returns: ``list`` of records
+        """
+        signature = self.get_signature()
+
+        if packages is None:
+            # only the records are kept, each package dict is dropped once converted
+            with self.open_data() as f:
+                records = [self.to_record(m) for m in util.iter_json_array(f, key='data')]
+        else:
+            records = [self.to_record(m) for m in packages]
+
+        self._write(records, signature)
+
+        return records
+
+    def get_records(self):
+        """
+        Loads the records from the index, rebuilding it from the data file first if needed
+
+        :returns: ``list`` of records
+        """
+        records = self.load()
+
+        if records is None:
+            records = self.build()
+
+        return records
+
+    @staticmethod
+    def to_record(package):
+        """
+        :param package:
+            A package dict as found in the ``data`` list of the data file
+        :type package: ``dict``
+
+        :returns: ``tuple``
+        """
+        return (
+            package['pk3'],
+            package['shasum'],
+            package['date'],
+            package['filesize'],
+            MapPackage.pack_bsp(package['bsp']),
+        )
+
+
+class SearchIndex(BinaryIndex):
+    """
+    A *SearchIndex* is an inverted index over the records of a *PackageIndex*
+
+    Packages are referenced by their position in the records. Substring fields (bsp, pk3, title
+    and author) have trigram postings which narrow a query down to candidate packages before the
+    values themselves are compared. Gametypes and shasums have exact postings.
+
+    :param data_file:
+        The **JSON** data file this index is built from
+    :type data_file: ``str``
+
+    :param index_file:
+        Where to store the index, defaults to ``data_file`` with a ``.search.idx`` suffix
+    :type index_file: ``str``
+
+    :returns object: ``SearchIndex``
+
+    >>> from xmm.index import PackageIndex
+    >>> from xmm.index import SearchIndex
+    >>> records = PackageIndex(data_file='~/.xmm/maps.json').get_records()
+    >>> index = SearchIndex(data_file='~/.xmm/maps.json')
+    >>> index.search(records, bsp_name='dance', gametype='ctf')
+    """
+    suffix = '.search.idx'
+    gram_size = 3
+    text_fields = ('bsp', 'pk3', 'title', 'author')
+    exact_fields = ('gametype', 'shasum')
+
+    def __init__(self, data_file, index_file=None, seed_file=None):
+        super().__init__(data_file=data_file, index_file=index_file, seed_file=seed_file)
+        self.postings = None
+        self.postings_signature = None
+
+    def build(self, records):
+        """
+        Writes a new index for the records
+
+        :param records:
+            Records from the *PackageIndex* of the same data file
+        :type records: ``list``
+
+        :returns: ``dict`` postings
+        """
+        signature = self.get_signature()
+
+        values = {field: [] for field in self.text_fields}
+        grams = {field: {} for field in self.text_fields}
+        exact = {field: {} for field in self.exact_fields}
+
+        for i, record in enumerate(records):
+            package = MapPackage.from_record(record)
+            bsps = package.bsps
+
+            fields = {
+                'bsp': sorted(bsps),
+                'pk3': [package.pk3_file],
+                'title': sorted(set(str(b.title) for b in bsps.values())),
+                'author': sorted(set(str(b.author) for b in bsps.values())),
+            }
+
+            for field, strings in fields.items():
+                values[field].append(tuple(strings))
+                for gram in set(g for s in strings for g in self._get_grams(s)):
+                    grams[field].setdefault(gram, []).append(i)
+
+            for gametype in set(g for b in bsps.values() for g in b.gametypes or ()):
+                exact['gametype'].setdefault(gametype, []).append(i)
+
+            exact['shasum'].setdefault(package.shasum, []).append(i)
+
+        postings = {
+            'count': len(records),
+            'values': values,
+            'grams': grams,
+            'exact': exact,
+        }
+
+        self._write(postings, signature)
+        self.postings = postings
+        self.postings_signature = signature
+
+        return postings
+
+    def get_postings(self, records):
+        """
+        Loads the postings from the index, rebuilding it from the records first if needed
+
+        The postings are kept in memory until the data file changes.
+
+        :param records:
+            Records from the *PackageIndex* of the same data file
+        :type records: ``list``
+
+        :returns: ``dict`` postings
+        """
+        signature = self.get_signature()
+
+        current = self.postings is not None and signature is not None and self.postings_signature == signature
+
+        if not current or self.postings['count'] != len(records):
+            postings = self.load()
+            if postings is None or postings['count'] != len(records):
+                return self.build(records)
+            self.postings = postings
+            self.postings_signature = signature
+
+        return self.postings
+
+    def search(self, records, bsp_name=False, gametype=False, author=False, title=False, pk3_name=False, shasum=False):
+        """
+        Finds the packages matching each of the criteria
+
+        Text criteria match as case-sensitive substrings, gametype and shasum match exactly.
+
+        :param records:
+            Records from the *PackageIndex* of the same data file
+        :type records: ``list``
+
+        :returns: ``dict`` of ``(criterion, term)`` to a ``set`` of record positions, only criteria with matches are included
+        """
+        postings = self.get_postings(records)
+
+        criteria = (
+            ('bsp', 'bsp', bsp_name),
+            ('pk3', 'pk3', pk3_name),
+            ('title', 'title', title),
+            ('author', 'author', author),
+        )
+
+        results = {}
+
+        for criterion, field, term in criteria:
+            if term:
+                found = self._find_substring(postings, field, str(term))
+                if found:
+                    results[(criterion, term)] = found
+
+        if gametype:
+            found = set(postings['exact']['gametype'].get(gametype, ()))
+            if found:
+                results[('gametype', gametype)] = found
+
+        if shasum:
+            found = set(postings['exact']['shasum'].get(shasum, ()))
+            if found:
+                results[('shasum', shasum)] = found
+
+        return results
+
+    def _find_substring(self, postings, field, term):
+        values = postings['values'][field]
+        grams = self._get_grams(term)
+
+        if grams:
+            candidates = None
+            for gram in sorted(grams, key=lambda g: len(postings['grams'][field].get(g, ()))):
+                ids = postings['grams'][field].get(gram)
+                if not ids:
+                    return set()
+                candidates = set(ids) if candidates is None else candidates.intersection(ids)
+                if not candidates:
+                    return set()
+        else:
+            candidates = range(len(values))
+
+        return set(i for i in candidates if any(term in s for s in values[i]))
+
+    def _get_grams(self, string):
+        size = self.gram_size
+        return set(string[i:i + size] for i in range(len(string) - size + 1))
@@ -1,6 +1,9 @@
+import hashlib
 import os
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 
 from xmm.exceptions import PackageMetadataWarning
 from xmm.exceptions import PackageNotTrackedWarning
@@ -8,9 +11,14 @@ from xmm.exceptions import PackageLookupError
 from xmm.exceptions import RepositoryLookupError
 from xmm.exceptions import HashMismatchError
 from xmm.base import Base
+from xmm.hashcache import HashCache
+from xmm.renderers import Renderer
 from xmm.util import cprint
+from xmm import exporters
 from xmm import util
 
+download_lock_dir = os.path.expanduser('~/.xmm/locks')
+
 
 class Library(Base):
     """
@@ -28,19 +36,47 @@ class Library(Base):
         The directory this *Library* is associated with
     :type map_dir: ``str``
 
+    :param hash_cache:
+        A *HashCache* for the files in ``map_dir``, defaults to ``<store>.hashes.json`` next to the *Store*
+    :type hash_cache: ``HashCache``
+
     :returns object: ``Library``
 
     """
-    def __init__(self, repositories, store, map_dir):
+    def __init__(self, repositories, store, map_dir, hash_cache=None):
         super().__init__()
-        self.maps = store.get_package_db()
         self.repositories = repositories
         self.store = store
         self.map_dir = os.path.expanduser(map_dir)
 
+        if not hash_cache:
+            cache_file = None
+            if store.data_file:
+                cache_file = '{}.hashes.json'.format(os.path.splitext(store.data_file)[0])
+            hash_cache = HashCache(cache_file=cache_file)
+
+        self.hash_cache = hash_cache
+
     def __repr__(self):
         return str(vars(self))
 
+    @property
+    def maps(self):
+        """
+        The *MapPackage* objects tracked by the *Library*, this is ``Store.data``
+
+        :returns: ``list`` of ``MapPackage``
+        """
+        return self.store.get_package_db()
+
+    @property
+    def lookup(self):
+        """
+        :returns: The ``PackageLookup`` of the *Store*
+        """
+        self.store.get_package_db()
+        return self.store.lookup
+
     def __json__(self):
         return {
             'maps': self.maps,
@@ -57,13 +93,31 @@ class Library(Base):
 
     def add_map_package(self, package):
         """
-        Adds a *MapPackage* object to ``self.maps``
+        Tracks a *MapPackage* object in the *Store*, unless a package with the same pk3 name is tracked already
 
         :param package:
             A *MapPackage* object for the *Library*
         :type package: ``MapPackage``
+
+        :returns: False if fails
+        """
+        if not self.store.get_package(package.pk3_file):
+            return self.store.add_package(package)
+
+    def remove_map_package(self, pk3_name):
         """
-        self.maps.append(package)
+        Stops tracking a *MapPackage* object in the *Store*
+
+        :param pk3_name:
+            The name of a pk3, such as ``vinegar_v3.pk3``
+        :type pk3_name: ``str``
+
+        :returns: False if fails
+        """
+        package = self.store.get_package(pk3_name)
+
+        if package:
+            return self.store.remove_package(package)
 
     def get_repository_sources(self, server_name):
         """
@@ -88,10 +142,33 @@ class Library(Base):
 
         return repo_sources
 
+    def download_lock(self, pk3_with_path):
+        """
+        Returns the lock an xmm process holds while downloading a pk3
+
+        There is one lock file per pk3 path in ``~/.xmm/locks``, so processes installing different maps into
+        the same directory do not wait on each other and nothing is left behind in the game's directories.
+        Lock files are removed again once released.
+
+        :param pk3_with_path:
+            Where the pk3 is downloaded to
+        :type pk3_with_path: ``str``
+
+        :returns: ``FileLock``
+        """
+        pk3_with_path = os.path.abspath(pk3_with_path)
+        key = hashlib.sha1(pk3_with_path.encode('utf-8')).hexdigest()
+        lock_file = os.path.join(download_lock_dir, '{}.{}.lock'.format(os.path.basename(pk3_with_path), key[:16]))
+        return util.FileLock(lock_file, timeout=self.conf['default'].get('download_lock_timeout', -1), remove=True)
+
     def install_map(self, pk3_name, repository_name=None, overwrite=False, add_to_store=True):
         """
         Install a *MapPackage* from a *Repository*
 
+        Maps from a *Repository* are checked against their shasum while downloading, a mismatching
+        download is discarded and ``HashMismatchError`` is raised. A pk3 that is already there and not
+        overwritten is hashed instead and raises ``HashMismatchError`` if it does not match.
+
         :param pk3_name:
             A pk3 name such as ``vinegar_v3.pk3``, to install from the repository.'
             Optionally prefixed with a URL to install map not in the repository.
@@ -118,7 +195,6 @@ class Library(Base):
         self.logger.info('Installing map: {}.'.format(pk3_name))
 
         map_dir = self.map_dir
-        installed_packages = self.store.get_package_db()
         map_found_in_repo = False
         found_map = None
         installed = False
@@ -136,19 +212,16 @@ class Library(Base):
         else:
             sources = self.repositories.sources
 
-        if installed_packages and not overwrite:
-            for m in installed_packages:
-                if m.pk3_file == pk3_name:
-                    cprint("{} already exists.".format(pk3_name), style='WARNING')
-                    self.logger.warning("{} already exists.".format(pk3_name))
-                    install = util.query_yes_no('continue?', 'no')
-                    if not install:
-                        raise SystemExit
-                    else:
-                        self.logger.info("overwriting {}.".format(pk3_name))
-                        overwrite = True
-                        add_to_store = False
-                    break
+        if not overwrite and self.store.get_package(pk3_name):
+            cprint("{} already exists.".format(pk3_name), style='WARNING')
+            self.logger.warning("{} already exists.".format(pk3_name))
+            install = util.query_yes_no('continue?', 'no')
+            if not install:
+                raise SystemExit
+            else:
+                self.logger.info("overwriting {}.".format(pk3_name))
+                overwrite = True
+                add_to_store = False
 
         if re.match('^(ht|f)tp(s)?://', pk3_name):
             self.logger.info("{} downloading from non-repository link.".format(pk3_name))
@@ -163,22 +236,36 @@ class Library(Base):
         pk3_with_path = os.path.join(os.path.dirname(map_dir), pk3)
 
         for repo in sources:
-            if not map_found_in_repo:
-                maps_json = repo.get_packages()
-                for m in maps_json:
-                    if m.pk3_file == pk3:
-                        found_map = m
-                        self.add_map_package(found_map)
-                        map_found_in_repo = True
-                        cprint("Found in: {}".format(repo.name))
-                        break
+            found_map = repo.get_package(pk3)
+            if found_map:
+                map_found_in_repo = True
+                cprint("Found in: {}".format(repo.name))
+                break
 
         if map_found_in_repo or is_url:
-            util.download_file(filename_with_path=pk3_with_path, url=url, use_curl=self.conf['default']['use_curl'], overwrite=overwrite)
-            installed = True
+            shasum = found_map.shasum if found_map else None
+            with self.download_lock(pk3_with_path):
+                downloaded = util.download_file(filename_with_path=pk3_with_path, url=url, use_curl=self.conf['default']['use_curl'], overwrite=overwrite, shasum=shasum)
+
+            if downloaded:
+                installed = True
+                if shasum:
+                    self.hash_cache.add(self.hash_cache.get_signature(pk3_with_path), shasum)
+                    self.hash_cache.save()
+            elif shasum:
+                # nothing was downloaded, the file already there has to match the repository
+                local_shasum = self.hash_cache.hash_file(pk3_with_path)
+                self.hash_cache.save()
+                if local_shasum != shasum:
+                    self.logger.error("{} already exists and does not match the repository's hash".format(pk3_with_path))
+                    raise HashMismatchError(pk3_with_path)
+                installed = True
+            else:
+                self.logger.warning("{} already exists, not installing.".format(pk3_with_path))
+                return
 
         if installed and add_to_store and found_map:
-            self.store.add_package(found_map)
+            self.add_map_package(found_map)
 
         if not map_found_in_repo:
             if installed:
@@ -188,6 +275,140 @@ class Library(Base):
                 self.logger.error("Unable to find package: {}".format(pk3_name))
                 raise PackageLookupError
 
+    def install_maps(self, pk3_names, repository_name=None, overwrite=False, add_to_store=True, max_workers=4, stream=None):
+        """
+        Install many *MapPackage* objects from the *Repository* *Collection* at once
+
+        All packages are resolved up front, downloaded concurrently and added to the *Store* with a
+        single write once the downloads have finished. Unlike ``install_map`` this never prompts,
+        packages already tracked by the *Library* or present in the map directory are skipped unless
+        ``overwrite`` is set.
+
+        :param pk3_names:
+            pk3 names such as ``vinegar_v3.pk3``, or URLs of pk3s not in the repository
+        :type pk3_names: ``list``
+
+        :param repository_name:
+            A name of a repository in the repository *Collection*
+        :type repository_name: ``str``
+
+        :param overwrite:
+            Whether to overwrite files on the file system and reinstall tracked packages
+        :type overwrite: ``bool``
+
+        :param add_to_store:
+            Whether to add the maps to the store (tracked)
+        :type add_to_store: ``bool``
+
+        :param max_workers:
+            How many packages to download at once
+        :type max_workers: ``int``
+
+        :param stream:
+            Where to draw the download progress, defaults to ``sys.stdout``
+        :type stream: ``file``
+
+        :returns: ``list`` of ``dict`` with the ``pk3``, ``status`` (``installed``, ``untracked``, ``skipped``,
+                  ``not_found``, ``hash_mismatch`` or ``failed``), ``repository``, ``size`` and ``error`` of each package
+
+        >>> from xmm.server import LocalServer
+        >>> server = LocalServer(server_name='myserver1')
+        >>> server.library.install_maps(pk3_names=['vinegar_v3.pk3', 'dance.pk3'], max_workers=8)
+        """
+        self.logger.info('Installing {} maps.'.format(len(pk3_names)))
+
+        map_dir = self.map_dir
+
+        if not os.path.exists(map_dir):
+            raise NotADirectoryError(map_dir)
+
+        if repository_name:
+            sources = [self.repositories.get_repository(repository_name)]
+        else:
+            sources = self.repositories.sources
+
+        results = []
+        downloads = []
+        seen = set()
+
+        for pk3_name in pk3_names:
+            result = {'pk3': pk3_name, 'status': None, 'repository': None, 'size': 0, 'error': None}
+            results.append(result)
+
+            if re.match('^(ht|f)tp(s)?://', pk3_name):
+                pk3 = os.path.basename(pk3_name)
+                url = pk3_name
+                found_map = None
+            else:
+                pk3 = pk3_name
+                found_map = None
+                for repo in sources:
+                    found_map = repo.get_package(pk3)
+                    if found_map:
+                        result['repository'] = repo.name
+                        url = repo.download_url + pk3
+                        break
+
+                if not found_map:
+                    self.logger.error("Unable to find package: {}".format(pk3_name))
+                    result['status'] = 'not_found'
+                    continue
+
+            pk3_with_path = os.path.join(os.path.dirname(map_dir), pk3)
+
+            if pk3 in seen or (not overwrite and (self.store.get_package(pk3) or os.path.exists(pk3_with_path))):
+                self.logger.info("{} already exists, skipping.".format(pk3))
+                result['status'] = 'skipped'
+                continue
+
+            seen.add(pk3)
+            downloads.append((result, found_map, pk3_with_path, url))
+
+        progress = util.DownloadProgress(total=len(downloads), stream=stream)
+
+        def download(item):
+            result, found_map, pk3_with_path, url = item
+            try:
+                shasum = found_map.shasum if found_map else None
+                with self.download_lock(pk3_with_path):
+                    # another process may have installed it while we waited
+                    if not overwrite and os.path.exists(pk3_with_path):
+                        self.logger.info("{} already exists, skipping.".format(pk3_with_path))
+                        result['status'] = 'skipped'
+                    else:
+                        result['size'] = util.stream_download(pk3_with_path, url, progress=progress.update, shasum=shasum)
+                        result['status'] = 'installed' if found_map else 'untracked'
+            except HashMismatchError as e:
+                self.logger.error("Hash mismatch for {}: {}".format(url, e))
+                result['status'] = 'hash_mismatch'
+                result['error'] = e
+            except Exception as e:
+                self.logger.error("Failed to download {}: {}".format(url, e))
+                result['status'] = 'failed'
+                result['error'] = e
+            progress.finish_file()
+
+        if downloads:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(download, downloads))
+            progress.close()
+
+        installed = []
+        for result, found_map, pk3_with_path, url in downloads:
+            if result['status'] == 'installed':
+                self.hash_cache.add(self.hash_cache.get_signature(pk3_with_path), found_map.shasum)
+                if add_to_store and not self.store.get_package(found_map.pk3_file):
+                    installed.append(found_map)
+            elif result['status'] == 'untracked':
+                self.logger.warning("{} was not installed through a repository and has no metadata.".format(result['pk3']))
+
+        if installed:
+            self.store.add_packages(installed)
+
+        self.hash_cache.save()
+
+        return results
+
     def remove_map(self, pk3_name):
         """
         Removes a map from the *Library* and the package from the file system
@@ -209,21 +430,22 @@ class Library(Base):
         map_dir = os.path.expanduser(self.map_dir)
         pk3_with_path = os.path.join(os.path.dirname(map_dir), pk3_name)
 
-        installed_packages = self.store.get_package_db()
-
-        for m in installed_packages:
-            if m.pk3_file == pk3_name:
-                self.store.remove_package(m)
+        self.remove_map_package(pk3_name)
 
         if os.path.exists(pk3_with_path):
             os.remove(pk3_with_path)
         else:
             raise FileNotFoundError(pk3_with_path)
 
-    def discover_maps(self, add=False, repository_name=None, detail=None):
+    def discover_maps(self, add=False, repository_name=None, detail=None, rehash=False, max_workers=None, renderer=None):
         """
         Searches the *Server*'s map_dir for map packages known by the *Repository*
 
+        Shasums are taken from the *HashCache*, only new or modified files are read. Those are hashed
+        concurrently and matched against the repositories as they finish, so the order of the output
+        follows the order files finish hashing in. Maps that are added are written to the *Store* in
+        a single batch.
+
         :param add:
             Whether to add the discovered maps or not
         :type add: ``bool``
@@ -236,17 +458,24 @@ class Library(Base):
             How much detail to show, [short, None, long]
         :type detail: ``str``
 
-        :param highlight:
-            Whether to highlight the results
-        :type highlight: ``bool``
+        :param rehash:
+            Whether to hash every file again instead of trusting the *HashCache*
+        :type rehash: ``bool``
+
+        :param max_workers:
+            How many files to hash at once, defaults to the number of CPUs
+        :type max_workers: ``int``
+
+        :param renderer:
+            Render into this *Renderer*, by default every map is printed as soon as it is found
+        :type renderer: ``Renderer``
 
         >>> from xmm.server import LocalServer
         >>> server = LocalServer()
-        >>> server.library.discover_maps(add=False)
+        >>> server.library.discover_maps(add=False, max_workers=8)
         """
 
         self.logger.debug("discovering maps")
-        local_maps = self.store.get_package_db()
 
         if repository_name:
             repo = self.repositories.get_repository(repository_name)
@@ -262,43 +491,73 @@ class Library(Base):
             self.logger.error("{} does not exists.".format(self.map_dir))
             raise NotADirectoryError(self.map_dir)
 
-        for pk3_file in os.listdir(self.map_dir):
+        signatures = set()
+        hashed = []
+        pending = {}
+
+        # every map added is written to the store at once when discovery finishes
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor, self.store.batch():
+
+            for pk3_file in os.listdir(self.map_dir):
+                if pk3_file.endswith('.pk3'):
+                    pk3_with_path = os.path.join(self.map_dir, pk3_file)
+                    signature = self.hash_cache.get_signature(pk3_with_path)
+                    signatures.add(signature)
+                    shasum = None if rehash else self.hash_cache.get(signature)
 
-            map_found = False
-            hash_match = False
+                    if shasum:
+                        hashed.append((pk3_file, shasum))
+                    else:
+                        self.logger.debug('Hashing {}'.format(pk3_with_path))
+                        pending[executor.submit(util.hash_file, pk3_with_path)] = (pk3_file, signature)
+
+            for pk3_file, shasum in hashed:
+                self._discover_package(pk3_file, shasum, sources, add=add, detail=detail, renderer=renderer)
 
-            if pk3_file.endswith('.pk3'):
-                shasum = util.hash_file(os.path.join(self.map_dir, pk3_file))
+            # hashes come back in completion order, matching and store updates stay on this thread
+            for future in as_completed(pending):
+                pk3_file, signature = pending[future]
+                shasum = future.result()
+                self.hash_cache.add(signature, shasum)
+                self._discover_package(pk3_file, shasum, sources, add=add, detail=detail, renderer=renderer)
 
-                try:
-                    for repo in sources:
-                        map_found = repo.show_map(pk3_file, detail=detail)
-                        if map_found:
-                            break
-                except PackageLookupError:
-                    pass
+        self.hash_cache.prune(signatures)
+        self.hash_cache.save()
 
+    def _discover_package(self, pk3_file, shasum, sources, add=False, detail=None, renderer=None):
+        map_found = False
+
+        try:
+            for repo in sources:
+                map_found = repo.show_map(pk3_file, detail=detail, renderer=renderer)
                 if map_found:
+                    break
+        except PackageLookupError:
+            pass
 
-                    if map_found.shasum == shasum:
-                        hash_match = True
-                    else:
-                        self.logger.warning("{} hash does not match repository's".format(shasum))
-                        cprint("{} hash does not match repository's".format(pk3_file), style='WARNING')
+        if not map_found:
+            return
 
-                    if hash_match and add:
-                        map_already_installed = False
-                        for m in local_maps:
-                            if m.pk3_file == pk3_file and m.shasum == shasum:
-                                self.logger.info("map already installed, not installing: {}".format(pk3_file))
-                                map_already_installed = True
+        if map_found.shasum != shasum:
+            self.logger.warning("{} hash does not match repository's".format(shasum))
+            if renderer is None:
+                cprint("{} hash does not match repository's".format(pk3_file), style='WARNING')
+            else:
+                renderer.line("{} hash does not match repository's".format(pk3_file), style='WARNING')
+            return
 
-                        if not map_already_installed:
-                            self.logger.info("installing map: {}".format(pk3_file))
-                            self.store.add_package(map_found)
+        if add:
+            installed_package = self.store.get_package(pk3_file)
+            map_already_installed = installed_package is not None and installed_package.shasum == shasum
+
+            if map_already_installed:
+                self.logger.info("map already installed, not installing: {}".format(pk3_file))
+            else:
+                self.logger.info("installing map: {}".format(pk3_file))
+                self.store.add_package(map_found)
 
     # local data
-    def list_installed(self, detail=None):
+    def list_installed(self, detail=None, renderer=None):
         """
         List maps currently tracked by the *Library*
 
@@ -306,6 +565,10 @@ class Library(Base):
             How much detail to show, [short, None, long]
         :type detail: ``str``
 
+        :param renderer:
+            Render into this *Renderer*, by default maps are printed as a table
+        :type renderer: ``Renderer``
+
         :returns: ``int`` total count
 
         >>> from xmm.server import LocalServer
@@ -313,19 +576,20 @@ class Library(Base):
         >>> server.library.list_installed()
         """
 
-        self.logger.debug("listing maps")
+        if renderer is None:
+            with Renderer(detail=detail) as renderer:
+                return self.list_installed(renderer=renderer)
 
-        packages = self.store.data
+        self.logger.debug("listing maps")
 
         total = 0
-        if packages:
-            for m in packages:
-                m.show_map_details(detail=detail)
-                total += 1
+        for m in self.store.iter_packages():
+            m.show_map_details(renderer=renderer)
+            total += 1
 
         return total
 
-    def show_map(self, pk3_name, detail=None, highlight=False):
+    def show_map(self, pk3_name, detail=None, highlight=False, rehash=False, renderer=None):
         """
         Convenience function to use the show_map_details helper
 
@@ -341,6 +605,14 @@ class Library(Base):
             Whether to highlight the results
         :type highlight: ``bool``
 
+        :param rehash:
+            Whether to hash the file again instead of trusting the *HashCache*
+        :type rehash: ``bool``
+
+        :param renderer:
+            Render into this *Renderer* instead of printing right away
+        :type renderer: ``Renderer``
+
         :returns: ``MapPackage``
 
         >>> from xmm.server import LocalServer
@@ -349,21 +621,21 @@ class Library(Base):
         """
         self.logger.debug("showing map: {}".format(pk3_name))
 
-        packages = self.store.get_package_db()
+        p = self.store.get_package(pk3_name)
 
         found_map = False
         hash_match = False
 
-        for p in packages:
-            if p.pk3_file == pk3_name:
-                shasum = util.hash_file(os.path.join(self.map_dir, pk3_name))
-                if p.shasum == shasum:
-                    hash_match = True
-                    p.show_map_details(search_string=pk3_name, detail=detail, highlight=highlight)
-                    found_map = p
-                else:
-                    self.logger.warning("Hash for this map does not match repository's: {}".format(pk3_name))
-                    raise HashMismatchError
+        if p:
+            shasum = self.hash_cache.hash_file(os.path.join(self.map_dir, pk3_name), rehash=rehash)
+            self.hash_cache.save()
+            if p.shasum == shasum:
+                hash_match = True
+                p.show_map_details(search_string=pk3_name, detail=detail, highlight=highlight, renderer=renderer)
+                found_map = p
+            else:
+                self.logger.warning("Hash for this map does not match repository's: {}".format(pk3_name))
+                raise HashMismatchError
 
         if not found_map and not hash_match:
             self.logger.warning("Map is not being tracked in the library: {}.".format(pk3_name))
@@ -371,7 +643,7 @@ class Library(Base):
 
         return found_map
 
-    def export_map_packages(self, filename=None):
+    def export_map_packages(self, filename=None, format='json'):
         """
         Exports all *MapPackage* objects from the *Library* *Store*
 
@@ -379,6 +651,10 @@ class Library(Base):
             Name for the exported json file, default ``xmm-export.json``
         :type filename: ``str``
 
+        :param format:
+            ``json``, ``ndjson`` or ``csv``, see ``xmm.exporters.write_packages``
+        :type format: ``str``
+
         :returns: False if fails
 
         >>> from xmm.server import LocalServer
@@ -387,17 +663,12 @@ class Library(Base):
         >>> server.library.export_packages(filename='test.maps.json')
         """
         if not filename:
-            filename = 'xmm-export.maps.json'
-
-        data_out = []
-        for m in self.maps:
-            data_out.append(json.loads(m.to_json()))
+            filename = 'xmm-export.maps.{}'.format(format)
 
         self.logger.info('exporting maps as: {}'.format(filename))
 
         try:
-            with open(filename, 'w') as f:
-                f.write(json.dumps(data_out))
+            exporters.export_packages(self.store.iter_packages(), filename, format=format)
         except EnvironmentError as e:
             self.logger.error(e)
             return False
@@ -420,17 +691,11 @@ class Library(Base):
 
         self.logger.info("exporting shasums from all sources to file: {}".format(filename))
 
-        data_out = []
-        for m in self.maps:
-            data_out.append("{} {}".format(m.shasum, m.pk3_file))
-
-        if data_out:
-            try:
-                with open(filename, 'w') as f:
-                    f.write('\n'.join(data_out))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(self.store.iter_packages(), filename, format='shasums')
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
 
     def export_maplist(self, filename=None):
         """
@@ -450,17 +715,8 @@ class Library(Base):
 
         self.logger.info("exporting maplist to file: {}".format(filename))
 
-        data = []
-        for m in self.maps:
-            bsps = m.bsp
-            bsp_names = list(bsps)
-            bsp_names.sort()
-            data.extend(bsp_names)
-
-        if data:
-            try:
-                with open(filename, 'w') as f:
-                    f.write('\n'.join(data))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(self.store.iter_packages(), filename, format='maplist')
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
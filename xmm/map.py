@@ -1,12 +1,20 @@
-import time
+import logging
+import sys
 import json
 
-from xmm.base import Base
-from xmm.util import zcolors
+from xmm.config import conf
+from xmm.logger import ClassPrefixAdapter
+from xmm.renderers import Renderer
 from xmm import util
 
 
-class MapPackage(Base):
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+class MapPackage(object):
     """
     *MapPackage* contains top-level metadata about a pk3 file and list of *Bsp* objects inside this package
 
@@ -82,36 +90,125 @@ class MapPackage(Base):
     >>>     my_map = MapPackage(map_package_json=data)
 
     """
-    def __init__(self, map_package_json):
-        super().__init__()
+    __slots__ = ('pk3_file', 'shasum', 'date', 'filesize', '_bsp', '_bsps')
 
+    conf = conf
+    logger = ClassPrefixAdapter(prefix='MapPackage', logger=logging.getLogger(__name__))
+
+    def __init__(self, map_package_json):
         if not isinstance(map_package_json, dict):
             map_package = json.loads(map_package_json)
         else:
             map_package = map_package_json
 
-        self.pk3_file = map_package['pk3']
-        self.shasum = map_package['shasum']
+        self.pk3_file = _intern(map_package['pk3'])
+        self.shasum = _intern(map_package['shasum'])
         self._bsp = map_package['bsp']
+        self._bsps = None
         self.date = map_package['date']
         self.filesize = map_package['filesize']
 
+    @classmethod
+    def from_record(cls, record):
+        """
+        Creates a *MapPackage* from a *PackageIndex* record
+
+        :param record:
+            A ``(pk3, shasum, date, filesize, bsp)`` tuple, ``bsp`` being packed with ``MapPackage.pack_bsp``
+        :type record: ``tuple``
+
+        :returns: ``MapPackage``
+        """
+        pk3, shasum, date, filesize, bsp = record
+        return cls(map_package_json={
+            'pk3': pk3,
+            'shasum': shasum,
+            'date': date,
+            'filesize': filesize,
+            'bsp': bsp,
+        })
+
+    @staticmethod
+    def pack_bsp(bsp):
+        """
+        Packs the bsp dict of a package for a *PackageIndex* record
+
+        Entities are kept as separate **JSON** text so they are only decoded when used.
+
+        :param bsp:
+            The ``bsp`` dict of a package
+        :type bsp: ``dict``
+
+        :returns: ``str``
+        """
+        packed = {}
+        for bsp_name, data in bsp.items():
+            keys = list(data)
+            meta = dict(data)
+            position = keys.index('entities') if 'entities' in meta else -1
+            entities = json.dumps(meta.pop('entities', None), separators=(',', ':'))
+            packed[bsp_name] = [meta, position, entities]
+
+        return json.dumps(packed, separators=(',', ':'))
+
     @property
     def bsp(self):
+        """
+        The bsp data of this package keyed by bsp name, as found in the repository
+
+        Treat the dict as read-only, ``bsps`` does not see changes made to it. Assign a new dict to replace it.
+        """
+        # packed bsp data from a *PackageIndex* record is restored on first access
+        if isinstance(self._bsp, str):
+            bsp = {}
+            for bsp_name, (meta, position, entities) in json.loads(self._bsp).items():
+                items = list(meta.items())
+                if position >= 0:
+                    items.insert(position, ('entities', json.loads(entities)))
+                bsp[bsp_name] = dict(items)
+            self._bsp = bsp
         return self._bsp
 
     @bsp.setter
-    def bsp(self, key, value):
-        self._bsp[key] = value
+    def bsp(self, value):
+        self._bsp = value
+        self._bsps = None
 
     @bsp.deleter
-    def bsp(self, key):
-        del self._bsp[key]
+    def bsp(self):
+        self._bsp = {}
+        self._bsps = None
+
+    @property
+    def bsps(self):
+        """
+        The *Bsp* objects in this package keyed by bsp name, created on first access
+        """
+        if self._bsps is None:
+            bsps = {}
+            if isinstance(self._bsp, str):
+                for bsp_name, (meta, position, entities) in json.loads(self._bsp).items():
+                    bsps[bsp_name] = Bsp.from_json(self.pk3_file, bsp_name, meta, entities=entities)
+            else:
+                for bsp_name, data in self._bsp.items():
+                    bsps[bsp_name] = Bsp.from_json(self.pk3_file, bsp_name, data)
+            self._bsps = bsps
+        return self._bsps
 
     def __repr__(self):
         return 'MapPackage(pk3=%s, shasum=%s, bsp=%s, date=%s, filesize=%s)' % (self.pk3_file, self.shasum, repr(self.bsp), self.date, self.filesize)
 
     def __json__(self):
+        return self.to_dict()
+
+    def to_dict(self):
+        """
+        The package as found in the ``data`` list of a repository, ready for ``json.dumps``
+
+        The bsp data is shared with this *MapPackage*, not copied.
+
+        :returns: ``dict``
+        """
         return {
             'pk3': self.pk3_file,
             'shasum': self.shasum,
@@ -124,9 +221,9 @@ class MapPackage(Base):
         """
         :returns: A **JSON** encoded version of this object
         """
-        return json.dumps(self, cls=util.ObjectEncoder)
+        return json.dumps(self.to_dict())
 
-    def show_map_details(self, detail=None, search_string='', highlight=False):
+    def show_map_details(self, detail=None, search_string='', highlight=False, renderer=None):
         """
         Helper function for pretty printing details about a *MapPackage*
 
@@ -144,60 +241,20 @@ class MapPackage(Base):
             Whether to highlight the results
         :type highlight: ``bool``
 
-        :returns: ``MapPackage``
+        :param renderer:
+            Render into this *Renderer* instead of printing right away
+        :type renderer: ``Renderer``
+
+        :returns: ``bool`` whether the package was rendered
         """
 
         self.logger.debug('Showing details for map: {}'.format(self.pk3_file))
 
-        bsps = self.bsp
-        keys = list(bsps)
-        keys.sort()
-        search_string = str(search_string)
-
-        # Long view
-        if detail == 'long':
-            print('')
-            print('         pk3: {}{}{}'.format(zcolors.BOLD, str(self.pk3_file), zcolors.ENDC))
-
-            for bsp in keys:
-                # Handle highlight
-                string_highlighted = '{}{}{}{}{}'.format(zcolors.ENDC, zcolors.SUCCESS, search_string, zcolors.ENDC, zcolors.INFO)
-                bsp_highlighted = bsp.replace(search_string, string_highlighted)
-                if search_string and highlight:
-                    print('         bsp: {}{}{}'.format(zcolors.INFO, bsp_highlighted, zcolors.ENDC))
-                else:
-                    print('         bsp: {}{}{}'.format(zcolors.INFO, bsp, zcolors.ENDC))
-
-                # bsp specific
-                print('       title:  {}'.format(str(self.bsp[bsp]['title'])))
-                print(' description:  {}'.format(str(self.bsp[bsp]['description'])))
-                print('      author:  {}'.format(str(self.bsp[bsp]['author'])))
-
-            # pk3 specific
-            print('      shasum: {}'.format(str(self.shasum)))
-            print('      shasum: {}'.format(str(self.pk3_file)))
-            print('        date: {}'.format(time.strftime('%Y-%m-%d', time.localtime(self.date))))
-            print('        size: {}'.format(util.convert_size(self.filesize).strip()))
-            print('          dl: {}'.format(self.conf['default']['download_url'] + self.pk3_file))
-
-        # Short detail view
-        elif detail == 'short':
-            print(str(self.pk3_file))
-        # Default view
-        else:
-            bsp_string = '\n{}{}{} ['.format(zcolors.BOLD, str(self.pk3_file), zcolors.ENDC)
-            for bsp in keys:
-                # Handle highlight
-                string_highlighted = '{}{}{}{}{}'.format(zcolors.ENDC, zcolors.SUCCESS, search_string, zcolors.ENDC, zcolors.INFO)
-                bsp_highlighted = bsp.replace(search_string, string_highlighted)
-                if search_string and highlight:
-                    bsp_string += '{}{}{}, '.format(zcolors.INFO, bsp_highlighted, zcolors.ENDC)
-                else:
-                    bsp_string += '{}{}{}, '.format(zcolors.INFO, bsp, zcolors.ENDC)
-            bsp_string = util.replace_last(bsp_string, ', ', '')
-            bsp_string += ']'.format(zcolors.ENDC)
-            print(bsp_string)
-            print('{}{}'.format(self.conf['default']['download_url'], str(self.pk3_file)))
+        if renderer is not None:
+            return renderer.package(self, search_string=search_string)
+
+        with Renderer(detail=detail, highlight=highlight) as renderer:
+            return renderer.package(self, search_string=search_string)
 
 
 class Bsp(object):
@@ -245,8 +302,8 @@ class Bsp(object):
     :type gametypes: ``list``
 
     :param entities:
-        The entities for the bsp_file if they exists
-    :type entities: ``str``
+        The entities for the bsp_file if they exists, as a dict or **JSON** text decoded on first access
+    :type entities: ``dict|str``
 
     :param waypoints:
         The waypoints for the bsp_file if it exists
@@ -259,6 +316,9 @@ class Bsp(object):
     :returns object: ``Bsp``
 
     """
+    __slots__ = ('pk3_file', 'bsp_name', 'bsp_file', 'map_file', 'mapshot', 'radar', 'title', 'description',
+                 'mapinfo', 'author', 'gametypes', '_entities', 'waypoints', 'license')
+
     def __init__(self, pk3_file='', bsp_name='', bsp_file='', map_file='', mapshot='', radar='', title='', description='', mapinfo='', author='', gametypes=None, entities=None, waypoints='', license=False):
         self.pk3_file = pk3_file
         self.bsp_name = bsp_name
@@ -271,10 +331,62 @@ class Bsp(object):
         self.mapinfo = mapinfo
         self.author = author
         self.gametypes = gametypes
-        self.entities = entities
+        self._entities = entities
         self.waypoints = waypoints
         self.license = license
 
+    @classmethod
+    def from_json(cls, pk3_file, bsp_name, data, entities=None):
+        """
+        Creates a *Bsp* from a bsp entry of the package **JSON**
+
+        :param pk3_file:
+            The pk3_file name of the package this bsp is in
+        :type pk3_file: ``str``
+
+        :param bsp_name:
+            The bsp_name of the bsp_file
+        :type bsp_name: ``str``
+
+        :param data:
+            The bsp entry
+        :type data: ``dict``
+
+        :param entities:
+            Entities as **JSON** text, used when ``data`` has no entities
+        :type entities: ``str``
+
+        :returns: ``Bsp``
+        """
+        gametypes = data.get('gametypes')
+        if gametypes is not None:
+            gametypes = [_intern(g) for g in gametypes]
+
+        return cls(pk3_file=pk3_file,
+                   bsp_name=bsp_name,
+                   map_file=data.get('map', ''),
+                   mapshot=data.get('mapshot', ''),
+                   radar=data.get('radar', ''),
+                   title=data.get('title', ''),
+                   description=data.get('description', ''),
+                   mapinfo=data.get('mapinfo', ''),
+                   author=_intern(data.get('author', '')),
+                   gametypes=gametypes,
+                   entities=data.get('entities', entities),
+                   waypoints=data.get('waypoints', ''),
+                   license=data.get('license', False),
+                   )
+
+    @property
+    def entities(self):
+        if isinstance(self._entities, str):
+            self._entities = json.loads(self._entities)
+        return self._entities
+
+    @entities.setter
+    def entities(self, value):
+        self._entities = value
+
     def __repr__(self):
         return 'Bsp(pk3_file=%s, bsp_name=%s, bsp_file=%s, map_file=%s, mapshot=%s, radar=%s, title=%s, description=%s, mapinfo=%s, author=%s, gametypes=%s,entities=%s, waypoints=%s, license=%s)' % (self.pk3_file, self.bsp_name, self.bsp_file, self.map_file, self.mapshot, self.radar, self.title, self.description, self.mapinfo, self.author, self.gametypes, self.entities, self.waypoints, self.license)
 
@@ -298,3 +410,82 @@ class Bsp(object):
         :returns: A **JSON** encoded version of this object
         """
         return json.dumps(self, cls=util.ObjectEncoder)
+
+
+class PackageLookup(object):
+    """
+    *PackageLookup* keeps dict indexes of *MapPackage* objects keyed by pk3 name and by shasum
+
+    :param packages:
+        *MapPackage* objects to index
+    :type packages: ``list``
+
+    :returns object: ``PackageLookup``
+
+    >>> from xmm.map import PackageLookup
+    >>> lookup = PackageLookup(packages=repository.get_packages())
+    >>> lookup.get_by_pk3('vinegar_v3.pk3')
+    """
+    def __init__(self, packages=None):
+        self.pk3s = {}
+        self.shasums = {}
+
+        for package in packages or []:
+            self.add(package)
+
+    def __repr__(self):
+        return 'PackageLookup(pk3s=%s, shasums=%s)' % (len(self.pk3s), len(self.shasums))
+
+    def __len__(self):
+        return len(self.pk3s)
+
+    def __contains__(self, pk3_name):
+        return pk3_name in self.pk3s
+
+    def add(self, package):
+        """
+        :param package:
+            *MapPackage* to index, replaces a package with the same pk3 name
+        :type package: ``MapPackage``
+        """
+        self.remove(package.pk3_file)
+        self.pk3s[package.pk3_file] = package
+        self.shasums.setdefault(package.shasum, []).append(package)
+
+    def remove(self, pk3_name):
+        """
+        :param pk3_name:
+            The name of a pk3, such as ``vinegar_v3.pk3``
+        :type pk3_name: ``str``
+
+        :returns: The removed ``MapPackage`` or ``None``
+        """
+        package = self.pk3s.pop(pk3_name, None)
+
+        if package is not None:
+            packages = self.shasums.get(package.shasum, [])
+            packages[:] = [p for p in packages if p is not package]
+            if not packages:
+                self.shasums.pop(package.shasum, None)
+
+        return package
+
+    def get_by_pk3(self, pk3_name):
+        """
+        :param pk3_name:
+            The name of a pk3, such as ``vinegar_v3.pk3``
+        :type pk3_name: ``str``
+
+        :returns: ``MapPackage`` or ``None``
+        """
+        return self.pk3s.get(pk3_name)
+
+    def get_by_shasum(self, shasum):
+        """
+        :param shasum:
+            The SHA-1 of a pk3
+        :type shasum: ``str``
+
+        :returns: ``list`` of ``MapPackage``
+        """
+        return list(self.shasums.get(shasum, []))
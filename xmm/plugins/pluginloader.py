@@ -1,8 +1,16 @@
-import imp
+import builtins
+import importlib.machinery
 import os
+import sys
+import types
 
 plugin_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 main_module = '__init__'
+manifest_file = os.path.expanduser('~/.xmm/plugins.json')
+manifest_version = 2
+
+# argument types that survive a round trip through the manifest
+manifest_types = (int, float, str)
 
 
 def get_plugins():
@@ -10,12 +18,146 @@ def get_plugins():
     possible_plugins = os.listdir(plugin_folder)
     for i in possible_plugins:
         location = os.path.join(plugin_folder, i)
-        if not os.path.isdir(location) or not main_module + '.py' in os.listdir(location):
+        path = os.path.join(location, main_module + '.py')
+        if not os.path.isdir(location) or not os.path.isfile(path):
             continue
-        info = imp.find_module(main_module, [location])
-        plugins.append({'name': i, 'info': info})
+        plugins.append({'name': i, 'location': location, 'path': path})
     return plugins
 
 
 def load_plugin(plugin):
-    return imp.load_module(plugin['name'], *plugin['info'])
+    if plugin['name'] in sys.modules and getattr(sys.modules[plugin['name']], '__file__', None) == plugin['path']:
+        return sys.modules[plugin['name']]
+
+    loader = importlib.machinery.SourceFileLoader(plugin['name'], plugin['path'])
+    module = types.ModuleType(loader.name)
+    module.__file__ = plugin['path']
+    module.__path__ = [plugin['location']]
+    module.__package__ = plugin['name']
+    module.__loader__ = loader
+
+    sys.modules[loader.name] = module
+    try:
+        loader.exec_module(module)
+    except BaseException:
+        del sys.modules[loader.name]
+        raise
+
+    return module
+
+
+def get_signature(plugins):
+    """
+    :returns: ``dict`` modification times of the plugin folder and of every module of every plugin
+    """
+    return {
+        'folder': os.stat(plugin_folder).st_mtime_ns,
+        'plugins': {p['name']: _get_module_times(p['location']) for p in plugins},
+    }
+
+
+def _get_module_times(location):
+    times = {}
+
+    for root, dirs, files in os.walk(location):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for name in files:
+            if name.endswith('.py'):
+                path = os.path.join(root, name)
+                times[os.path.relpath(path, location)] = os.stat(path).st_mtime_ns
+
+    return times
+
+
+def get_manifest(filename=manifest_file):
+    """
+    Returns every plugin with the arguments from its ``get_args()``. Plugins are only imported when the manifest
+    in ``filename`` is missing or the plugin folder changed since it was written.
+
+    ``args`` is ``None`` for a plugin whose arguments can not be cached, ``load_plugin`` it to get them.
+
+    :param filename:
+        Where to cache the manifest, it is only written if its directory exists
+    :type filename: ``str``
+
+    :returns: ``list`` of ``dict``
+    """
+    plugins = get_plugins()
+    signature = get_signature(plugins)
+
+    manifest = _read_manifest(filename)
+    if manifest and manifest.get('version') == manifest_version and manifest.get('signature') == signature:
+        cached = {p['name']: p['args'] for p in manifest['plugins']}
+        if set(cached) == set(p['name'] for p in plugins):
+            for plugin in plugins:
+                plugin['args'] = _decode_args(cached[plugin['name']])
+            return plugins
+
+    entries = []
+    for plugin in plugins:
+        plugin['args'] = load_plugin(plugin).get_args()
+        entries.append({'name': plugin['name'], 'args': _encode_args(plugin['args'])})
+
+    _write_manifest(filename, {'version': manifest_version, 'signature': signature, 'plugins': entries})
+
+    return plugins
+
+
+def _encode_args(args):
+    command, command_help, arg_names, kwargs = args
+    kwargs = dict(kwargs)
+
+    if 'type' in kwargs:
+        if kwargs['type'] not in manifest_types:
+            return None
+        kwargs['type'] = kwargs['type'].__name__
+
+    encoded = [command, command_help, list(arg_names), kwargs]
+
+    import json
+
+    try:
+        json.dumps(encoded)
+    except (TypeError, ValueError):
+        return None
+
+    return encoded
+
+
+def _decode_args(args):
+    if args is None:
+        return None
+
+    command, command_help, arg_names, kwargs = args
+
+    if 'type' in kwargs:
+        kwargs['type'] = getattr(builtins, kwargs['type'])
+
+    return command, command_help, arg_names, kwargs
+
+
+def _read_manifest(filename):
+    import json
+
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _write_manifest(filename, manifest):
+    if not os.path.isdir(os.path.dirname(filename)):
+        return
+
+    import json
+
+    tmp_file = '{}.tmp.{}'.format(filename, os.getpid())
+
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, filename)
+    except EnvironmentError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
@@ -0,0 +1,260 @@
+import json
+import sys
+import time
+
+from xmm.base import Base
+from xmm.util import zcolors
+from xmm import util
+
+outputs = ('table', 'json', 'ndjson')
+
+
+class nocolors:
+    """
+    *zcolors* without any formatting, used when output does not go to a terminal
+    """
+    HEADER = ''
+    INFO = ''
+    SUCCESS = ''
+    WARNING = ''
+    FAIL = ''
+    ENDC = ''
+    BOLD = ''
+    UNDERLINE = ''
+
+
+class Renderer(Base):
+    """
+    A *Renderer* formats *MapPackage* objects for ``search``, ``list`` and ``show`` into one buffered writer
+
+    ``table`` is the human readable output xmm always had, ``json`` writes one array and ``ndjson`` one
+    package per line, both leave out headers and totals. Text is collected and written in blocks of
+    ``buffer_size`` characters instead of one write per line.
+
+    :param output:
+        ``table``, ``json`` or ``ndjson``
+    :type output: ``str``
+
+    :param stream:
+        Where to write, defaults to ``sys.stdout``
+    :type stream: ``file``
+
+    :param color:
+        Use terminal formatting, ``None`` to only use it when ``stream`` is a terminal
+    :type color: ``bool``
+
+    :param detail:
+        How much detail to show in a table, [short, None, long]
+    :type detail: ``str``
+
+    :param highlight:
+        Whether to highlight the search string in a table
+    :type highlight: ``bool``
+
+    :param limit:
+        Render at most this many packages, ``None`` for all
+    :type limit: ``int``
+
+    :param offset:
+        Skip this many packages first
+    :type offset: ``int``
+
+    :returns object: ``Renderer``
+
+    >>> from xmm.renderers import Renderer
+    >>> with Renderer(output='ndjson', limit=10) as renderer:
+    >>>     for package in repository.iter_packages():
+    >>>         renderer.package(package)
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, output='table', stream=None, color=None, detail=None, highlight=False, limit=None, offset=0):
+        super().__init__()
+
+        if output not in outputs:
+            raise ValueError('Unknown output: {}'.format(output))
+
+        self.output = output
+        self.stream = stream or sys.stdout
+        self.detail = detail
+        self.highlight = highlight
+        self.limit = limit
+        self.offset = offset or 0
+
+        if color is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            color = bool(isatty and isatty())
+
+        self.colors = zcolors if color else nocolors
+        self.seen = 0
+        self.rendered = 0
+        self._parts = []
+        self._size = 0
+
+    def __repr__(self):
+        return str(vars(self))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def is_table(self):
+        """
+        :returns: ``bool`` whether headers and totals are shown
+        """
+        return self.output == 'table'
+
+    def write(self, text):
+        """
+        Adds text to the buffer, writing the buffer once it is full
+
+        :param text:
+            Text to write
+        :type text: ``str``
+        """
+        self._parts.append(text)
+        self._size += len(text)
+
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffer to ``stream``
+        """
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+        self.stream.flush()
+
+    def close(self):
+        """
+        Finishes the output and flushes it
+        """
+        if self.output == 'json':
+            self.write('[]\n' if not self.rendered else ']\n')
+        self.flush()
+
+    def line(self, text='', style=None):
+        """
+        Writes a line in ``table`` output, other outputs ignore it
+
+        :param text:
+            The line
+        :type text: ``str``
+
+        :param style:
+            A *zcolors* style such as ``INFO``
+        :type style: ``str``
+        """
+        if not self.is_table:
+            return
+
+        if style:
+            text = '{}{}{}'.format(getattr(self.colors, style), text, self.colors.ENDC)
+
+        self.write('{}\n'.format(text))
+
+    def field(self, name, value):
+        """
+        Writes a bold ``name: value`` line in ``table`` output
+
+        :param name:
+            The name of the field
+        :type name: ``str``
+
+        :param value:
+            The value of the field
+        :type value: ``str``
+        """
+        self.line('{}{}{}: {}'.format(self.colors.BOLD, name, self.colors.ENDC, value))
+
+    def total(self, total):
+        """
+        Writes the total number of packages found in ``table`` output
+
+        :param total:
+            The number of packages
+        :type total: ``int``
+        """
+        self.line('{}Total packages found:{} {}{}{}'.format(self.colors.INFO, self.colors.ENDC, self.colors.BOLD,
+                                                            total, self.colors.ENDC))
+
+    def package(self, package, search_string=''):
+        """
+        Renders a *MapPackage* unless it falls outside ``offset`` and ``limit``
+
+        :param package:
+            The package to render
+        :type package: ``MapPackage``
+
+        :param search_string:
+            A string to highlight with ``highlight=True``
+        :type search_string: ``str``
+
+        :returns: ``bool`` whether the package was rendered
+        """
+        self.seen += 1
+
+        if self.seen <= self.offset or (self.limit is not None and self.rendered >= self.limit):
+            return False
+
+        if self.output == 'json':
+            self.write('{}{}'.format(', ' if self.rendered else '[', json.dumps(package.to_dict())))
+        elif self.output == 'ndjson':
+            self.write('{}\n'.format(json.dumps(package.to_dict())))
+        else:
+            self._table(package, str(search_string or ''))
+
+        self.rendered += 1
+
+        return True
+
+    def _table(self, package, search_string):
+        c = self.colors
+        bsps = package.bsps
+        keys = sorted(bsps)
+
+        def bsp_name(bsp):
+            if search_string and self.highlight:
+                return bsp.replace(search_string, '{}{}{}{}{}'.format(c.ENDC, c.SUCCESS, search_string, c.ENDC, c.INFO))
+            return bsp
+
+        lines = []
+
+        # Long view
+        if self.detail == 'long':
+            lines.append('')
+            lines.append('         pk3: {}{}{}'.format(c.BOLD, package.pk3_file, c.ENDC))
+
+            for bsp in keys:
+                lines.append('         bsp: {}{}{}'.format(c.INFO, bsp_name(bsp), c.ENDC))
+
+                # bsp specific
+                lines.append('       title:  {}'.format(bsps[bsp].title))
+                lines.append(' description:  {}'.format(bsps[bsp].description))
+                lines.append('      author:  {}'.format(bsps[bsp].author))
+
+            # pk3 specific
+            lines.append('      shasum: {}'.format(package.shasum))
+            lines.append('      shasum: {}'.format(package.pk3_file))
+            lines.append('        date: {}'.format(time.strftime('%Y-%m-%d', time.localtime(package.date))))
+            lines.append('        size: {}'.format(util.convert_size(package.filesize).strip()))
+            lines.append('          dl: {}'.format(self.conf['default']['download_url'] + package.pk3_file))
+
+        # Short detail view
+        elif self.detail == 'short':
+            lines.append(package.pk3_file)
+
+        # Default view
+        else:
+            names = ', '.join('{}{}{}'.format(c.INFO, bsp_name(bsp), c.ENDC) for bsp in keys)
+            lines.append('')
+            lines.append('{}{}{} [{}]'.format(c.BOLD, package.pk3_file, c.ENDC, names))
+            lines.append('{}{}'.format(self.conf['default']['download_url'], package.pk3_file))
+
+        self.write('{}\n'.format('\n'.join(lines)))
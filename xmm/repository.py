@@ -1,17 +1,23 @@
 import json
 import os
-import re
+import sys
+import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import URLError
 
+from xmm.index import PackageIndex
+from xmm.index import SearchIndex
 from xmm.map import MapPackage
+from xmm.map import PackageLookup
 
 from xmm.exceptions import PackageLookupError
 from xmm.exceptions import RepositoryLookupError
 from xmm.exceptions import RepositoryUpdateError
 from xmm.base import Base
-from xmm.util import zcolors
+from xmm.renderers import Renderer
 from xmm.util import cprint
+from xmm import exporters
 from xmm import util
 
 
@@ -98,7 +104,7 @@ class Collection(Base):
         """
         self.sources.append(repository)
 
-    def search_all(self, bsp_name=False, gametype=False, author=False, title=False, pk3_name=False, shasum=False, detail=None, highlight=False):
+    def search_all(self, bsp_name=False, gametype=False, author=False, title=False, pk3_name=False, shasum=False, detail=None, highlight=False, renderer=None):
         """
         Searches all *Repository* objects in the *Collection* for maps matching criteria
 
@@ -134,6 +140,12 @@ class Collection(Base):
             Whether to highlight the search string
         :type highlight: ``bool``
 
+        :param renderer:
+            Render into this *Renderer*, by default results are printed as a table
+        :type renderer: ``Renderer``
+
+        :returns: ``list`` of matching *MapPackage* objects from every *Repository*
+
         >>> from xmm.repository import Collection
         >>> from xmm.repository import Repository
         >>> repositories = Collection()
@@ -143,15 +155,33 @@ class Collection(Base):
         >>> print(repositories.search_all(bsp_name='vinegar_v3'))
         """
 
+        if renderer is None:
+            with Renderer(detail=detail, highlight=highlight) as renderer:
+                return self.search_all(bsp_name=bsp_name, gametype=gametype, author=author, title=title,
+                                       pk3_name=pk3_name, shasum=shasum, renderer=renderer)
+
         self.logger.info("Searching all repositories.")
 
+        found = []
         for repo in self.sources:
-            repo.search_maps(bsp_name=bsp_name, gametype=gametype, author=author, title=title, pk3_name=pk3_name, shasum=shasum, detail=detail, highlight=highlight)
+            found.extend(repo.search_maps(bsp_name=bsp_name, gametype=gametype, author=author, title=title, pk3_name=pk3_name, shasum=shasum, renderer=renderer))
+
+        return found
 
-    def update_all(self):
+    def update_all(self, max_workers=None):
         """
         Update the data for all *Repository* objects in the *Collection*
 
+        Repositories are updated concurrently on a bounded thread pool, a failing *Repository*
+        does not stop the others from updating.
+
+        :param max_workers:
+            How many repositories to update at once, defaults to one thread per *Repository* up to ``8``
+        :type max_workers: ``int``
+
+        :returns: ``list`` of ``dict`` with the ``name``, ``status`` (``updated``, ``unchanged`` or ``failed``),
+                  ``elapsed`` seconds and ``error`` of each *Repository*, in the order of ``self.sources``
+
         >>> from xmm.repository import Collection
         >>> from xmm.repository import Repository
         >>> repositories = Collection()
@@ -162,9 +192,36 @@ class Collection(Base):
 
         self.logger.info("Updating all sources.")
 
-        for repo in self.sources:
-            self.logger.debug("Updating source: {}".format(repo.name))
-            repo.update_repo_data()
+        if not self.sources:
+            return []
+
+        if not max_workers:
+            max_workers = min(8, len(self.sources))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self._update_repository, self.sources))
+
+        return results
+
+    def _update_repository(self, repo):
+        self.logger.debug("Updating source: {}".format(repo.name))
+
+        start_time = time.time()
+        error = None
+
+        try:
+            status = 'updated' if repo.update_repo_data() else 'unchanged'
+        except Exception as e:
+            self.logger.error("Failed to update source {}: {}".format(repo.name, e))
+            status = 'failed'
+            error = e
+
+        return {
+            'name': repo.name,
+            'status': status,
+            'elapsed': time.time() - start_time,
+            'error': error,
+        }
 
     def export_all_hash_index(self, filename=None):
         """
@@ -186,25 +243,24 @@ class Collection(Base):
 
         self.logger.info("exporting shasums from all sources to file: {}".format(filename))
 
-        data = []
-        for repo in self.sources:
-            lines = repo.get_hash_index()
-            data.extend(lines)
+        packages = (m for repo in self.sources for m in repo.iter_packages())
 
-        if data:
-            try:
-                with open(filename, 'w') as f:
-                    f.write('\n'.join(data))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(packages, filename, format='shasums')
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
 
-    def export_all_packages(self, filename=None):
+    def export_all_packages(self, filename=None, format='json'):
         """
         :param filename:
             Name for the exported json file, default ``maps.json``
         :type filename: ``str``
 
+        :param format:
+            ``json``, ``ndjson`` or ``csv``, see ``xmm.exporters.write_packages``
+        :type format: ``str``
+
         :returns: False if fails
 
         >>> from xmm.repository import Collection
@@ -215,22 +271,17 @@ class Collection(Base):
         >>> repositories.export_all_packages()
         """
         if not filename:
-            filename = 'all-repos-maps.json'
+            filename = 'all-repos-maps.{}'.format(format)
 
         self.logger.info("exporting maps as: {}".format(filename))
 
-        data = []
-        for repo in self.sources:
-            lines = repo.get_packages()
-            data.extend(lines)
+        packages = (m for repo in self.sources for m in repo.iter_packages())
 
-        if data:
-            try:
-                with open(filename, 'w') as f:
-                    f.write(json.dumps(data, cls=util.ObjectEncoder))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(packages, filename, format=format)
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
 
 
 class Repository(Base):
@@ -268,7 +319,13 @@ class Repository(Base):
         self.download_url = download_url
         self.api_data = None
         self.api_data_file = os.path.expanduser(api_data_file)
+        self.api_data_meta_file = '{}.meta.json'.format(self.api_data_file)
         self.repo_data = {}
+        self.repo_data_signature = None
+        self.lookup = PackageLookup()
+        self.api_data_file_seed = self.conf['default']['api_data_file_seed']
+        self.index = PackageIndex(data_file=self.api_data_file, seed_file=self.api_data_file_seed)
+        self.search_index = SearchIndex(data_file=self.api_data_file, seed_file=self.api_data_file_seed)
 
     def __repr__(self):
         return str(vars(self))
@@ -287,10 +344,13 @@ class Repository(Base):
         """
         return json.dumps(self, cls=util.ObjectEncoder)
 
-    def search_maps(self, bsp_name=False, gametype=False, author=False, title=False, pk3_name=False, shasum=False, detail=None, highlight=False):
+    def search_maps(self, bsp_name=False, gametype=False, author=False, title=False, pk3_name=False, shasum=False, detail=None, highlight=False, renderer=None):
         """
         Searches the repository for maps matching criteria
 
+        Uses the *SearchIndex* of the repository, text criteria match as case-sensitive substrings.
+        A package is included if it matches any of the criteria.
+
         :param bsp_name:
             Search by bsp name
         :type bsp_name: ``str``
@@ -323,88 +383,68 @@ class Repository(Base):
             Whether to highlight the search string
         :type highlight: ``bool``
 
+        :param renderer:
+            Render into this *Renderer*, by default results are printed as a table
+        :type renderer: ``Renderer``
+
+        :returns: ``list`` of matching *MapPackage* objects
+
         >>> from xmm.repository import Repository
         >>> repository = Repository(name='default', download_url='http://dl.repo.url/',
         >>>                         api_data_url='http://api.repo.url/maps.json', api_data_file='~/.xmm/maps.json')
         >>> repository.search_maps(bsp_name='dance' gametype='ctf')
         """
 
-        self.logger.info("Searching maps.")
+        if renderer is None:
+            with Renderer(detail=detail, highlight=highlight) as renderer:
+                return self.search_maps(bsp_name=bsp_name, gametype=gametype, author=author, title=title,
+                                        pk3_name=pk3_name, shasum=shasum, renderer=renderer)
 
-        maps_json = self.get_packages()
-        fmaps_json = []
-        criteria = []
+        self.logger.info("Searching maps.")
 
         if not bsp_name:
             bsp_name = ''
 
         # Filter based on args
-        total = 0
-        for m in maps_json:
-
-            show = False
-            for bsp in m.bsp:
-                if bsp_name and re.search('^.*' + bsp_name + '.*$', bsp):
-                    criteria.append(('bsp', bsp_name))
-                    show = True
-
-                if gametype in m.bsp[bsp]['gametypes']:
-                    criteria.append(('gametype', gametype))
-                    show = True
-
-                if re.search('^.*' + str(author) + '.*$', m.bsp[bsp]['author']):
-                    criteria.append(('author', author))
-                    show = True
-
-                if re.search('^.*' + str(title) + '.*$', m.bsp[bsp]['title']):
-                    criteria.append(('title', title))
-                    show = True
-
-            if pk3_name and re.search('^.*' + pk3_name + '.*$', m.pk3_file):
-                criteria.append(('pk3', pk3_name))
-                show = True
+        records = self.index.get_records()
+        results = self.search_index.search(records, bsp_name=bsp_name, gametype=gametype,
+                                           author=author, title=title, pk3_name=pk3_name, shasum=shasum)
 
-            if shasum == m.shasum:
-                criteria.append(('shasum', shasum))
-                show = True
+        criteria = list(results)
+        found = set()
+        for ids in results.values():
+            found.update(ids)
 
-            if show:
-                total += 1
-                fmaps_json.append(m)
-
-        criteria = list(set(criteria))
+        # only matches become MapPackage objects
+        fmaps_json = [MapPackage.from_record(records[i]) for i in sorted(found)]
+        total = len(fmaps_json)
 
         if len(criteria) > 0:
-            cprint("Using repo '{}'".format(self.name), style="HEADER")
-            cprint("Searching for packages with the following criteria:", style='INFO')
+            renderer.line("Using repo '{}'".format(self.name), style='HEADER')
+            renderer.line("Searching for packages with the following criteria:", style='INFO')
             for c in criteria:
-                print("{}{}{}: {}".format(zcolors.BOLD, str(c[0]), zcolors.ENDC, str(c[1])))
-            print('---')
+                renderer.field(str(c[0]), str(c[1]))
+            renderer.line('---')
 
         for m in fmaps_json:
-            bsps = m.bsp
-            keys = list(bsps)
-            keys.sort()
-
-            shown = False
-            for bsp in keys:
-                if re.search('^.*' + bsp_name + '.*$', bsp) and not shown:
-                    if bsp_name:
-                        m.show_map_details(search_string=bsp_name, detail=detail, highlight=highlight)
-                    elif pk3_name != '':
-                        m.show_map_details(search_string=pk3_name, detail=detail, highlight=highlight)
-                    else:
-                        m.show_map_details(detail=detail, highlight=highlight)
-
-                    shown = True
-        print('---')
-        print("{}Total packages found:{} {}{}{}".format(zcolors.INFO, zcolors.ENDC, zcolors.BOLD, str(total), zcolors.ENDC))
+            if any(bsp_name in bsp for bsp in m.bsps):
+                m.show_map_details(search_string=bsp_name or pk3_name, renderer=renderer)
+
+        renderer.line('---')
+        renderer.total(total)
+
+        return fmaps_json
 
     # remote data
     def update_repo_data(self):
         """
         Updates sources cache with latest maps from *Repository*
 
+        The request is conditional on the ETag and Last-Modified of the last update, if the data
+        has not changed upstream, neither the data file nor the indexes are touched.
+
+        :returns: ``bool`` whether the data changed
+
         >>> from xmm.repository import Repository
         >>> repository = Repository(name='default', download_url='http://dl.repo.url/',
         >>>                         api_data_url='http://api.repo.url/maps.json', api_data_file='~/.xmm/maps.json')
@@ -413,15 +453,83 @@ class Repository(Base):
         try:
             cprint("Updating {} sources json...".format(self.name), style='INFO')
             self.logger.info("Updating {} sources json...".format(self.name))
-            util.download_file(self.api_data_file, url=self.api_data_url, use_curl=self.conf['default']['use_curl'], overwrite=True)
+
+            if self.conf['default']['use_curl']:
+                util.download_file(self.api_data_file, url=self.api_data_url, use_curl=True, overwrite=True)
+                cache_headers = {}
+            else:
+                cache_headers = self.get_cache_headers()
+                response = util.fetch_file(self.api_data_file, url=self.api_data_url,
+                                           etag=cache_headers.get('etag'), last_modified=cache_headers.get('last_modified'))
+
+                cache_headers = {
+                    'url': self.api_data_url,
+                    'etag': response['etag'],
+                    'last_modified': response['last_modified'],
+                }
+
+                if not response['modified']:
+                    cprint("{} sources json is up to date.".format(self.name), style='INFO')
+                    self.logger.info("{} sources json is up to date.".format(self.name))
+                    return False
+
+                cprint("Done.", style='INFO')
+
         except URLError as e:
             self.logger.debug('Error updating repo data: {}'.format(e))
-            raise RepositoryUpdateError
+            raise RepositoryUpdateError(e.reason)
+
+        self.repo_data = {}
+        self.lookup = PackageLookup()
+        self.search_index.build(self.index.build())
+        self.set_cache_headers(cache_headers)
+
+        return True
+
+    def get_cache_headers(self):
+        """
+        Gets the ETag and Last-Modified stored for the current data file of this *Repository*
+
+        :returns: ``dict``
+        """
+        if not os.path.exists(self.api_data_file) or not os.path.exists(self.api_data_meta_file):
+            return {}
+
+        try:
+            with open(self.api_data_meta_file) as f:
+                cache_headers = json.load(f)
+        except (EnvironmentError, ValueError) as e:
+            self.logger.warning('Unable to read {}: {}'.format(self.api_data_meta_file, e))
+            return {}
+
+        if cache_headers.get('url') != self.api_data_url:
+            return {}
+
+        return cache_headers
+
+    def set_cache_headers(self, cache_headers):
+        """
+        Stores the ETag and Last-Modified for the current data file of this *Repository*
+
+        :param cache_headers:
+            ``url``, ``etag`` and ``last_modified`` of the response
+        :type cache_headers: ``dict``
+        """
+        try:
+            if cache_headers:
+                with open(self.api_data_meta_file, 'w') as f:
+                    json.dump(cache_headers, f)
+            elif os.path.exists(self.api_data_meta_file):
+                os.remove(self.api_data_meta_file)
+        except EnvironmentError as e:
+            self.logger.warning('Unable to write {}: {}'.format(self.api_data_meta_file, e))
 
     def get_packages(self):
         """
         Gets the cached map list from *Repository* or reads from file if cache not available
 
+        The cache is dropped when the data file changes on disk, e.g. after ``xmm update`` in another process.
+
         :returns: ``json``
 
         >>> from xmm.repository import Repository
@@ -432,37 +540,89 @@ class Repository(Base):
 
         self.logger.debug("getting repo data")
 
+        if self.repo_data and self.index.get_signature() != self.repo_data_signature:
+            self.logger.debug("repo data changed on disk, reloading")
+            self.repo_data = {}
+
         if not self.repo_data:
 
             repo_data = []
 
             if not os.path.exists(self.api_data_file):
-                cprint("Could not find a repo file. Using maplist shipped with release. For the latest maps, run xmm update.".format(self.name), style='WARNING')
+                cprint("Could not find a repo file. Using maplist shipped with release. For the latest maps, run xmm update.".format(self.name), style='WARNING', file=sys.stderr)
                 self.logger.info("Could not find a repo file. Using maplist shipped with release. For the latest maps, run xmm update.".format(self.name))
 
-                import zipfile
-                zip_ref = zipfile.ZipFile(self.conf['default']['api_data_file_seed'], 'r')
-                zip_ref.extract('maps.json', os.path.dirname(self.api_data_file))
-                zip_ref.close()
+            self.repo_data_signature = self.index.get_signature()
 
-            with open(self.api_data_file) as f:
-                data = f.read()
-                maps = json.loads(data)['data']
-
-            for m in maps:
-                new_map = MapPackage(map_package_json=m)
+            for record in self.index.get_records():
+                new_map = MapPackage.from_record(record)
                 repo_data.append(new_map)
 
             self.repo_data = repo_data
+            self.lookup = PackageLookup(packages=repo_data)
 
         return self.repo_data
 
-    def export_packages(self, filename=None):
+    def iter_packages(self):
+        """
+        Yields every *MapPackage* in the *Repository* one at a time
+
+        The data file, or the seed while there is none, is parsed incrementally so only one package is
+        held in memory at a time, regardless of the size of the repository.
+
+        :returns: generator of ``MapPackage``
+
+        >>> from xmm.repository import Repository
+        >>> repository = Repository(name='default', download_url='http://dl.repo.url/',
+        >>>                         api_data_url='http://api.repo.url/maps.json', api_data_file='~/.xmm/maps.json')
+        >>> for package in repository.iter_packages():
+        >>>     print(package.pk3_file)
+        """
+        with self.index.open_data() as f:
+            for package in util.iter_json_array(f, key='data'):
+                yield MapPackage(map_package_json=package)
+
+    def get_package(self, pk3_name):
+        """
+        Looks up a *MapPackage* in the *Repository* by pk3 name
+
+        :param pk3_name:
+            The name of a pk3, such as ``vinegar_v3.pk3``
+        :type pk3_name: ``str``
+
+        :returns: ``MapPackage`` or ``None`` if not found
+
+        >>> from xmm.repository import Repository
+        >>> repository = Repository(name='default', download_url='http://dl.repo.url/',
+        >>>                         api_data_url='http://api.repo.url/maps.json', api_data_file='~/.xmm/maps.json')
+        >>> print(repository.get_package('vinegar_v3.pk3'))
+        """
+        self.get_packages()
+        return self.lookup.get_by_pk3(pk3_name)
+
+    def get_packages_by_shasum(self, shasum):
+        """
+        Looks up *MapPackage* objects in the *Repository* by shasum
+
+        :param shasum:
+            The SHA-1 of a pk3
+        :type shasum: ``str``
+
+        :returns: ``list`` of ``MapPackage``
+        """
+        self.get_packages()
+        return self.lookup.get_by_shasum(shasum)
+
+    def export_packages(self, filename=None, format='json'):
         """
         :param filename:
             Name for the exported json file, default ``maps.json``
         :type filename: ``str``
 
+        :param format:
+            ``json``, ``ndjson`` or ``csv``, see ``xmm.exporters.write_packages``
+        :type format: ``str``
+
         :returns: False if fails
 
         >>> from xmm.repository import Repository
@@ -471,19 +631,15 @@ class Repository(Base):
         >>> repository.export_packages('test.json')
         """
         if not filename:
-            filename = 'xmm-export.maps.json'
+            filename = 'xmm-export.maps.{}'.format(format)
 
         self.logger.info("exporting maps as: {}".format(filename))
 
-        data = self.get_packages()
-
-        if data:
-            try:
-                with open(filename, 'w') as f:
-                    f.write(json.dumps(data, cls=util.ObjectEncoder))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(self.iter_packages(), filename, format=format)
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
 
     def get_hash_index(self):
         """
@@ -496,12 +652,16 @@ class Repository(Base):
         >>>                         api_data_url='http://api.repo.url/maps.json', api_data_file='~/.xmm/maps.json')
         >>> print(repository.get_hash_index())
         """
-        maps_json = self.get_packages()
-        lines = []
-        for m in maps_json:
-            lines.append("{} {}".format(m.shasum, m.pk3_file))
+        return list(self.iter_hash_index())
+
+    def iter_hash_index(self):
+        """
+        Yields ``"<shasum> <pk3>"`` for every package, streamed from the data file
 
-        return lines
+        :returns: generator of ``str``
+        """
+        for m in self.iter_packages():
+            yield "{} {}".format(m.shasum, m.pk3_file)
 
     def export_hash_index(self, filename=None):
         """
@@ -521,17 +681,13 @@ class Repository(Base):
 
         self.logger.info("exporting shasums to file: {}".format(filename))
 
-        lines = self.get_hash_index()
-
-        if lines:
-            try:
-                with open(filename, 'w') as f:
-                    f.write('\n'.join(lines))
-            except EnvironmentError as e:
-                self.logger.error(e)
-                return False
+        try:
+            exporters.export_packages(self.iter_packages(), filename, format='shasums')
+        except EnvironmentError as e:
+            self.logger.error(e)
+            return False
 
-    def show_map(self, pk3_name, detail=None, highlight=False):
+    def show_map(self, pk3_name, detail=None, highlight=False, renderer=None):
         """
         Convenience function to use the show_map_details helper
 
@@ -547,6 +703,10 @@ class Repository(Base):
             Whether to highlight the results
         :type highlight: ``bool``
 
+        :param renderer:
+            Render into this *Renderer* instead of printing right away
+        :type renderer: ``Renderer``
+
         :returns: ``MapPackage``
 
         >>> from xmm.repository import Repository
@@ -557,15 +717,11 @@ class Repository(Base):
 
         self.logger.debug("Showing map with helper")
 
-        packages = self.get_packages()
-        found_map = False
-
-        for p in packages:
-            if p.pk3_file == pk3_name:
-                p.show_map_details(search_string=pk3_name, detail=detail, highlight=highlight)
-                found_map = p
+        found_map = self.get_package(pk3_name)
 
         if not found_map:
             raise PackageLookupError
 
+        found_map.show_map_details(search_string=pk3_name, detail=detail, highlight=highlight, renderer=renderer)
+
         return found_map
@@ -1,8 +1,11 @@
 import json
+from contextlib import contextmanager
 
-from xmm.map import MapPackage
+from xmm.map import PackageLookup
 
+from xmm.backends import get_backend
 from xmm.base import Base
+from xmm import exporters
 from xmm import util
 
 
@@ -10,10 +13,16 @@ class Store(Base):
     """
     *Store* is for interacting with the datastore for a *Library*
 
+    The backend is picked from the extension of ``package_store_file``, see ``xmm.backends.get_backend``.
+
     :param package_store_file:
         The file where the data is stored
     :type package_store_file: ``str``
 
+    :param backend:
+        Use this backend instead of picking one from ``package_store_file``
+    :type backend: ``JsonBackend|SqliteBackend``
+
     >>> import os
     >>> from xmm.store import Store
     >>> package_store_file = os.path.expanduser('~/.xmm/library.json')
@@ -22,14 +31,17 @@ class Store(Base):
     :returns object: ``Store``
 
     """
-    def __init__(self, package_store_file):
+    def __init__(self, package_store_file, backend=None):
         super().__init__()
 
-        if package_store_file:
-            util.create_if_not_exists(package_store_file, json.dumps([]))
-
         self.data_file = package_store_file
-        self.data = self.get_package_db()
+        self.backend = backend or get_backend(package_store_file)
+        self._data = None
+        self.lookup = None
+        self._signature = None
+        self._batch_depth = 0
+        self._operations = []
+        self._savepoints = []
 
     def __repr__(self):
         return str(vars(self))
@@ -46,9 +58,21 @@ class Store(Base):
         """
         return json.dumps(self, cls=util.ObjectEncoder)
 
+    @property
+    def data(self):
+        """
+        Every *MapPackage* in the *Store*, loaded on first use
+
+        :returns: ``list`` of ``MapPackage``
+        """
+        return self.get_package_db()
+
     def get_package_db(self):
         """
-        Searches the repository for maps matching criteria
+        Returns every *MapPackage* in the *Store*
+
+        ``data`` is the one copy kept in memory, it is only loaded again when the signature of the
+        backing file changed since it was last read or written, e.g. by another process.
 
         >>> import os
         >>> from xmm.store import Store
@@ -56,32 +80,93 @@ class Store(Base):
         >>> store = Store(package_store_file=package_store_file)
         >>> store.get_package_db()
 
-        :returns: ``dict``
+        :returns: ``list`` of ``MapPackage``
         """
+        if self._data is not None and self._batch_depth:
+            return self._data
+
+        signature = self.backend.get_signature()
+
+        if self._data is not None and signature is not None and signature == self._signature:
+            return self._data
 
         self.logger.debug('Getting package db')
 
-        package_data = []
-        repo_data = []
+        packages = self.backend.load()
+
+        if signature is None:
+            # the backend may have just created the file
+            signature = self.backend.get_signature()
+
+        if self._data is None:
+            self._data = packages
+        else:
+            self._data[:] = packages
+
+        self.lookup = PackageLookup(packages=self._data)
+        self._signature = signature
+
+        return self._data
+
+    def iter_packages(self):
+        """
+        Yields every *MapPackage* in the *Store* one at a time
+
+        The loaded packages are used while they are current, otherwise they are streamed from the backend
+        without loading the whole *Store*.
+
+        >>> import os
+        >>> from xmm.store import Store
+        >>> package_store_file = os.path.expanduser('~/.xmm/library.json')
+        >>> store = Store(package_store_file=package_store_file)
+        >>> for package in store.iter_packages():
+        >>>     print(package.pk3_file)
+
+        :returns: generator of ``MapPackage``
+        """
+        if self._data is not None and (self._batch_depth or self._signature == self.backend.get_signature()):
+            packages = list(self._data)
+        else:
+            packages = self.backend.iter_packages()
 
-        util.create_if_not_exists(self.data_file, json.dumps(package_data))
+        for package in packages:
+            yield package
 
-        if not util.file_is_empty(self.data_file):
-            repo_data = []
+    def get_package(self, pk3_name):
+        """
+        Looks up a tracked *MapPackage* by pk3 name
 
-            with open(self.data_file) as f:
-                data = f.read()
-                package_data = json.loads(data)
+        :param pk3_name:
+            The name of a pk3, such as ``vinegar_v3.pk3``
+        :type pk3_name: ``str``
 
-            for m in package_data:
-                new_map = MapPackage(map_package_json=m)
-                repo_data.append(new_map)
+        :returns: ``MapPackage`` or ``None`` if not tracked
 
-        return repo_data
+        >>> import os
+        >>> from xmm.store import Store
+        >>> package_store_file = os.path.expanduser('~/.xmm/library.json')
+        >>> store = Store(package_store_file=package_store_file)
+        >>> store.get_package('vinegar_v3.pk3')
+        """
+        self.get_package_db()
+        return self.lookup.get_by_pk3(pk3_name)
+
+    def get_packages_by_shasum(self, shasum):
+        """
+        Looks up tracked *MapPackage* objects by shasum
+
+        :param shasum:
+            The SHA-1 of a pk3
+        :type shasum: ``str``
+
+        :returns: ``list`` of ``MapPackage``
+        """
+        self.get_package_db()
+        return self.lookup.get_by_shasum(shasum)
 
     def add_package(self, package):
         """
-        Adds a *MapPackage* to the *Library* *Store*
+        Adds a *MapPackage* to the *Library* *Store*, replacing a package with the same pk3 name
 
         :param package:
             MapPackage to add
@@ -109,20 +194,27 @@ class Store(Base):
                                  )
                          )
 
-        package_data = self.data
-        package_data.append(package)
+        return self._write(('add', [package]))
+
+    def add_packages(self, packages):
+        """
+        Adds many *MapPackage* objects to the *Library* *Store* with a single write
 
-        # fix this
-        data_out = []
-        for m in package_data:
-            data_out.append(json.loads(m.to_json()))
+        :param packages:
+            MapPackages to add
+        :type packages: ``list``
 
+        :returns: False if fails
+        """
+        self.begin()
         try:
-            with open(self.data_file, 'w+') as f:
-                json.dump(data_out, f)
-        except EnvironmentError as e:
-            self.logger.error(e)
-            return False
+            for package in packages:
+                self.add_package(package)
+        except BaseException:
+            self.rollback()
+            raise
+
+        return self.commit()
 
     def remove_package(self, package):
         """
@@ -153,21 +245,142 @@ class Store(Base):
                                  )
                          )
 
-        package_store = []
+        return self._write(('remove', package))
 
-        if not util.file_is_empty(self.data_file):
-            with open(self.data_file, 'r+') as f:
-                package_store = json.load(f)
-                package_store[:] = [m for m in package_store if (m.get('shasum') != package.shasum and m.get('pk3') != package.pk3_file)]
+    def begin(self):
+        """
+        Starts a batch, adds and removes are only applied in memory until ``commit``
+
+        Batches can be nested, only the outermost ``commit`` writes. The library is not locked during
+        the batch, if another process changed it in the meantime ``commit`` applies the batch on top.
+        """
+        self._savepoints.append(len(self._operations))
+        self._batch_depth += 1
+
+    def commit(self):
+        """
+        Ends a batch, writing every add and remove since ``begin`` at once while holding the library lock
 
+        If the write fails the batch is discarded and the *Store* is read again on next use.
+
+        :returns: False if fails
+        """
+        if not self._batch_depth:
+            return
+
+        self._savepoints.pop()
+        self._batch_depth -= 1
+
+        if not self._batch_depth and self._operations:
+            operations, self._operations = self._operations, []
+
+            try:
+                with self.backend.lock:
+                    # another process changed the library during the batch, apply the batch to its version
+                    if self.backend.get_signature() != self._signature:
+                        self.get_package_db()
+                        for operation in operations:
+                            self._apply(operation)
+
+                    return self._flush(operations)
+            except BaseException:
+                # the batch is only in memory, forget it so the library is read again
+                self._signature = None
+                raise
+
+    def rollback(self):
+        """
+        Ends a batch, discarding every add and remove since its ``begin``
+
+        The *Store* is read again and the changes of enclosing batches are applied on top, they are
+        still written by the outermost ``commit``.
+        """
+        if not self._batch_depth:
+            return
+
+        del self._operations[self._savepoints.pop():]
+        self._batch_depth -= 1
+
+        depth, self._batch_depth = self._batch_depth, 0
+        self._signature = None
         try:
-            with open(self.data_file, 'w+') as f:
-                json.dump(package_store, f)
-        except EnvironmentError as e:
-            self.logger.error(e)
-            return False
+            self.get_package_db()
+        finally:
+            self._batch_depth = depth
+
+        for operation in self._operations:
+            self._apply(operation)
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups adds and removes into a single write, rolled back if the block raises
+
+        >>> import os
+        >>> from xmm.store import Store
+        >>> package_store_file = os.path.expanduser('~/.xmm/library.json')
+        >>> store = Store(package_store_file=package_store_file)
+        >>> with store.batch():
+        >>>     for package in packages:
+        >>>         store.add_package(package)
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _write(self, operation):
+        if self._batch_depth:
+            self.get_package_db()
+            self._apply(operation)
+            self._operations.append(operation)
+            return
+
+        # reload, change and write while holding the lock so no other process' changes get lost
+        with self.backend.lock:
+            self.get_package_db()
+            self._apply(operation)
+            return self._flush([operation])
+
+    def _apply(self, operation):
+        action, target = operation
+
+        if action == 'add':
+            for package in target:
+                # a package with the same pk3 name is replaced, the same as when a journal is replayed
+                if self.lookup.get_by_pk3(package.pk3_file):
+                    self._data[:] = [m for m in self._data if m.pk3_file != package.pk3_file]
+                self._data.append(package)
+                self.lookup.add(package)
+
+        elif action == 'remove':
+            self._data[:] = [m for m in self._data if (m.shasum != target.shasum and m.pk3_file != target.pk3_file)]
+            for m in self.lookup.get_by_shasum(target.shasum):
+                self.lookup.remove(m.pk3_file)
+            self.lookup.remove(target.pk3_file)
+
+    def _flush(self, operations):
+        # only keep treating self._data as current if nobody else wrote since it was loaded
+        current = self._signature is not None and self._signature == self.backend.get_signature()
+
+        try:
+            result = self.backend.write(operations, self._data)
+        except BaseException:
+            # the changes are only in memory, read the library again on next use
+            self._signature = None
+            raise
 
-    def export_packages(self, filename=None):
+        if current and result is not False:
+            self._signature = self.backend.get_signature()
+        else:
+            self._signature = None
+
+        return result
+
+    def export_packages(self, filename=None, format='json'):
         """
         Exports all *MapPackage* objects from the *Library* *Store*
 
@@ -175,6 +388,10 @@ class Store(Base):
             Name for the exported json file, default ``xmm-export.json``
         :type filename: ``str``
 
+        :param format:
+            ``json``, ``ndjson`` or ``csv``, see ``xmm.exporters.write_packages``
+        :type format: ``str``
+
         :returns: False if fails
 
         >>> from xmm.server import LocalServer
@@ -183,17 +400,12 @@ class Store(Base):
         >>> server.library.store.export_packages(filename='test.json')
         """
         if not filename:
-            filename = 'xmm-export.maps.json'
-
-        data_out = []
-        for m in self.data:
-            data_out.append(json.loads(m.to_json()))
+            filename = 'xmm-export.maps.{}'.format(format)
 
         self.logger.info('exporting maps as: {}'.format(filename))
 
         try:
-            with open(filename, 'w') as f:
-                f.write(json.dumps(data_out))
+            exporters.export_packages(self.iter_packages(), filename, format=format)
         except EnvironmentError as e:
             self.logger.error(e)
             return False